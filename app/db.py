@@ -1,12 +1,16 @@
-"""SQLite persistence. One connection guarded by a lock, as before -- the write volume
-here is a handful of rows per user per minute.
+"""SQLite persistence. One writer connection guarded by a lock, as before -- the write
+volume here is a handful of rows per user per minute. Reads go through a small pool of
+read-only connections instead, so a slow stats page or history search never holds up
+the tracker's writes, and a burst of writes never holds up a page.
 
 `listens` is the one table meant to grow without bound: it is the permanent history and
 is never pruned. Everything that reads it does so through an index -- keyset pagination
 rather than OFFSET, FTS5 rather than LIKE -- so a decade of plays costs the same per
-page as a week of them.
+page as a week of them. Its rows are integers: the strings a play would repeat live once
+in `tracks` and `contexts`, which keeps the table, and every page read from it, small.
 """
 
+import itertools
 import json
 import logging
 import os
@@ -14,18 +18,53 @@ import re
 import sqlite3
 import time
 import urllib.parse
-from threading import Lock
-from typing import Any, Optional
+from contextlib import contextmanager
+from pathlib import Path
+from threading import BoundedSemaphore, Event, Lock, Thread
+from typing import IO, Any, Callable, Iterable, Iterator, Optional
 
 from cryptography.fernet import Fernet, InvalidToken
 
+from . import importer, stats, tally
+
 log = logging.getLogger(__name__)
 
 HISTORY_PAGE_LIMIT = 200
 
+# Rows read per query by `export_history`. Big enough that a decade of plays is a few
+# hundred short reads; small enough that one chunk is never much memory.
+EXPORT_CHUNK_ROWS = 1000
+
+# Read-only connections kept open beside the writer. WAL lets each of them read a
+# consistent snapshot while a commit is in flight, so they neither wait for the writer
+# nor make it wait. A handful is plenty: the read paths are the browser's, and there
+# are at most a few people using this.
+READER_POOL_SIZE = 4
+
+# How often the progress of open listens is written out. Open rows are only a restart's
+# safety net -- closing a listen is what records it, and that commits straight away --
+# so the per-poll rewrites are merged and committed together once per tick rather than
+# costing one fsync per user per poll. A crash loses at most one tick of progress on a
+# listen still playing, which `close_orphaned_listens` already treats as a floor.
+OPEN_LISTEN_FLUSH_SECONDS = 5.0
+
+# Ids bound per `IN (...)` list, well under SQLite's host-parameter limit.
+SQL_VARIABLE_CHUNK = 500
+
 # Bumped whenever the shape of the data changes. 1 = the recently-played ledger,
-# 2 = measured listens alongside backfilled ones, 3 = measured listens only.
-SCHEMA_VERSION = 3
+# 2 = measured listens alongside backfilled ones, 3 = measured listens only,
+# 4 = the stats rollup in app/stats.py, 5 = its per-user count of distinct tracks,
+# 6 = track and context strings moved out of `listens` into `tracks` and `contexts`,
+# 7 = each listen's local day and hour stored, and the time index covering the stats,
+# 8 = `origin` on listens, for plays imported from a streaming-history export.
+SCHEMA_VERSION = 8
+
+# A playlist as mirrored: the snapshot it was read at, and its tracks in order.
+MirroredPlaylist = tuple[Optional[str], list[dict[str, str]]]
+
+# The parts of the browser's state that change independently, each with its own version
+# so a change to one leaves the others' cached copies standing; see `touch_state`.
+STATE_SECTIONS = ("user", "status", "settings", "favorites", "stats", "discovery")
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS meta (
@@ -71,35 +110,33 @@ CREATE TABLE IF NOT EXISTS settings (
     tracker_running       INTEGER NOT NULL DEFAULT 1
 );
 
--- The permanent listening history. Exactly one thing writes here: the live playback
--- poll in app/tracker.py. Every row is therefore a measured listen with a real
--- `completion_ratio`, and there is no second path that could add a play we cannot
--- judge -- if it isn't in here, it wasn't heard while the app was watching.
-CREATE TABLE IF NOT EXISTS listens (
-    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id            INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-    track_id           TEXT    NOT NULL,
-    name               TEXT    NOT NULL,
-    artist             TEXT    NOT NULL,
-    played_at          INTEGER NOT NULL,
-    duration_ms        INTEGER NOT NULL DEFAULT 0,
-    listened_ms        INTEGER NOT NULL DEFAULT 0,
-    completion_ratio   REAL    NOT NULL DEFAULT 0,
-    qualified          INTEGER NOT NULL DEFAULT 0,
-    context_uri        TEXT,
-    is_open            INTEGER NOT NULL DEFAULT 0
+-- The permanent listening history. Two things write here. The live playback poll in
+-- app/tracker.py writes `origin = 0` rows: listens it measured itself, each with a real
+-- `completion_ratio`. The streaming-history importer in app/importer.py writes
+-- `origin = 1` rows: plays from a user's Spotify export that happened before their
+-- first live listen, judged from the export's own `ms_played` and end reason. An
+-- imported play is never written twice -- see idx_listens_imported -- and never
+-- overlaps the live history, so `origin` only records where a row's figures came from.
+--
+-- A row holds integers only: the track and the playlist it was heard from are keys
+-- into `tracks` and `contexts`, stored once however often they are played. See
+-- LISTENS_DDL for the table itself.
+{listens}
+
+-- One row per track ever heard, by anyone. The name and artist are the latest Spotify
+-- reported; `listens` points here by `key` rather than repeating them on every play.
+CREATE TABLE IF NOT EXISTS tracks (
+    key       INTEGER PRIMARY KEY,
+    track_id  TEXT    NOT NULL UNIQUE,
+    name      TEXT    NOT NULL,
+    artist    TEXT    NOT NULL
 );
 
--- Every history page is ordered by (played_at DESC, id DESC) and paged by keyset, so
--- this index alone answers a page without a sort or a scan of everything before it.
-CREATE INDEX IF NOT EXISTS idx_listens_user_time
-    ON listens (user_id, played_at DESC, id DESC);
-
-CREATE INDEX IF NOT EXISTS idx_listens_user_qualified_time
-    ON listens (user_id, qualified, played_at DESC, id DESC);
-
-CREATE INDEX IF NOT EXISTS idx_listens_user_track
-    ON listens (user_id, track_id, played_at DESC);
+-- The playlists and albums listens were heard from, for the same reason.
+CREATE TABLE IF NOT EXISTS contexts (
+    key  INTEGER PRIMARY KEY,
+    uri  TEXT    NOT NULL UNIQUE
+);
 
 {play_counts}
 
@@ -118,6 +155,10 @@ CREATE TABLE IF NOT EXISTS discovery_sources (
     label        TEXT    NOT NULL,
     created_at   INTEGER NOT NULL,
     degraded     TEXT,
+    -- The track list the last complete sweep of this source worked through, as a
+    -- digest, and the month it was archived into. See `Discovery.sweep_sources`.
+    swept_month  TEXT,
+    swept_digest TEXT,
     PRIMARY KEY (user_id, playlist_id)
 );
 
@@ -166,53 +207,112 @@ CREATE TABLE IF NOT EXISTS discovery_playlists (
     playlist_id  TEXT    NOT NULL,
     PRIMARY KEY (user_id, month)
 );
+
+-- Artist ids by track, as Spotify reported them. Shared by every user, unlike all of the
+-- above: a track's artists are the same whoever's Discover Weekly it turned up in, so
+-- two people getting the same track cost one lookup between them.
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_id     TEXT    PRIMARY KEY,
+    artist_ids   TEXT    NOT NULL,
+    resolved_at  INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Playlist membership as last read from Spotify, so a restart starts from a copy one
+-- snapshot check can vouch for rather than re-paging every playlist. Kept by
+-- `PlaylistCache`: replaced when a playlist is read in full, edited in place when a
+-- track is added or removed here. `position` is the track's place in the playlist.
+CREATE TABLE IF NOT EXISTS playlist_mirror (
+    user_id      INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    playlist_id  TEXT    NOT NULL,
+    snapshot_id  TEXT,
+    PRIMARY KEY (user_id, playlist_id)
+);
+
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    user_id      INTEGER NOT NULL,
+    playlist_id  TEXT    NOT NULL,
+    position     INTEGER NOT NULL,
+    track_id     TEXT    NOT NULL,
+    name         TEXT    NOT NULL,
+    artist       TEXT    NOT NULL,
+    PRIMARY KEY (user_id, playlist_id, position),
+    FOREIGN KEY (user_id, playlist_id)
+        REFERENCES playlist_mirror (user_id, playlist_id) ON DELETE CASCADE
+) WITHOUT ROWID;
 """
 
-# Kept separate because a migration recreates this table from scratch: it is a
-# materialised aggregate of `listens`, so rebuilding it is always the correct repair.
-PLAY_COUNTS_DDL = """
-CREATE TABLE IF NOT EXISTS play_counts (
-    user_id         INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-    track_id        TEXT    NOT NULL,
-    name            TEXT    NOT NULL,
-    artist          TEXT    NOT NULL,
-    qualified_plays INTEGER NOT NULL DEFAULT 0,
-    total_plays     INTEGER NOT NULL DEFAULT 0,
-    last_played     INTEGER NOT NULL DEFAULT 0,
-    PRIMARY KEY (user_id, track_id)
+# Kept separate because the schema-6 migration rebuilds `listens` in this shape and
+# copies the history across.
+LISTENS_DDL = """
+CREATE TABLE IF NOT EXISTS listens (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id            INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    track_key          INTEGER NOT NULL,
+    played_at          INTEGER NOT NULL,
+    duration_ms        INTEGER NOT NULL DEFAULT 0,
+    listened_ms        INTEGER NOT NULL DEFAULT 0,
+    completion_ratio   REAL    NOT NULL DEFAULT 0,
+    qualified          INTEGER NOT NULL DEFAULT 0,
+    context_key        INTEGER,
+    is_open            INTEGER NOT NULL DEFAULT 0,
+    local_day          TEXT    NOT NULL DEFAULT '',
+    local_hour         INTEGER NOT NULL DEFAULT 0,
+    origin             INTEGER NOT NULL DEFAULT 0
 );
 """
 
-SCHEMA = SCHEMA.format(play_counts=PLAY_COUNTS_DDL.strip())
+# Created by `_migrate` once `listens` is in its current shape: the rewrite that moved
+# the strings out drops and rebuilds them, and the last one is keyed on `track_key`.
+LISTENS_INDEXES = """
+-- Every history page is ordered by (played_at DESC, id DESC) and paged by keyset, so
+-- this index alone answers a page without a sort or a scan of everything before it.
+-- The trailing columns are what the stats page and the history header add up over a
+-- time range, so those read the index alone and never touch the table.
+CREATE INDEX IF NOT EXISTS idx_listens_user_time
+    ON listens (user_id, played_at DESC, id DESC, is_open, qualified, listened_ms);
+
+CREATE INDEX IF NOT EXISTS idx_listens_user_qualified_time
+    ON listens (user_id, qualified, played_at DESC, id DESC);
+
+-- A search resolves to track keys first, then to this user's plays of them.
+CREATE INDEX IF NOT EXISTS idx_listens_user_track
+    ON listens (user_id, track_key, played_at DESC);
 
-# Full-text search over the history, as an external-content table: the index stores the
-# terms, the rows stay in `listens`, and the triggers keep the two in step. `prefix`
+-- Importing the same streaming-history file twice adds nothing; see app/importer.py.
+-- Partial, so the live history pays nothing for it.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_listens_imported
+    ON listens (user_id, played_at, track_key) WHERE origin = 1;
+"""
+
+SCHEMA = SCHEMA.format(listens=LISTENS_DDL.strip(), play_counts=tally.DDL.strip() + ";")
+
+# Full-text search over the history, as an external-content table on `tracks`: the index
+# stores the terms once per track rather than once per play, and a match is joined to
+# the listens through `track_key`. The triggers keep it in step with `tracks`. `prefix`
 # makes "rad" match "Radiohead" without a leading-wildcard scan.
 FTS_SCHEMA = """
-CREATE VIRTUAL TABLE IF NOT EXISTS listens_fts USING fts5(
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
     name,
     artist,
-    content='listens',
-    content_rowid='id',
+    content='tracks',
+    content_rowid='key',
     tokenize="unicode61 remove_diacritics 2",
     prefix='2 3 4'
 );
 
-CREATE TRIGGER IF NOT EXISTS listens_fts_insert AFTER INSERT ON listens BEGIN
-    INSERT INTO listens_fts (rowid, name, artist) VALUES (new.id, new.name, new.artist);
+CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, name, artist) VALUES (new.key, new.name, new.artist);
 END;
 
-CREATE TRIGGER IF NOT EXISTS listens_fts_delete AFTER DELETE ON listens BEGIN
-    INSERT INTO listens_fts (listens_fts, rowid, name, artist)
-    VALUES ('delete', old.id, old.name, old.artist);
+CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, name, artist)
+    VALUES ('delete', old.key, old.name, old.artist);
 END;
 
--- Open rows are rewritten on every poll; restricting the trigger to the indexed columns
--- keeps that from churning the FTS index once per tick.
-CREATE TRIGGER IF NOT EXISTS listens_fts_update AFTER UPDATE OF name, artist ON listens BEGIN
-    INSERT INTO listens_fts (listens_fts, rowid, name, artist)
-    VALUES ('delete', old.id, old.name, old.artist);
-    INSERT INTO listens_fts (rowid, name, artist) VALUES (new.id, new.name, new.artist);
+CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE OF name, artist ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, name, artist)
+    VALUES ('delete', old.key, old.name, old.artist);
+    INSERT INTO tracks_fts (rowid, name, artist) VALUES (new.key, new.name, new.artist);
 END;
 """
 
@@ -248,6 +348,18 @@ BOOLEAN_SETTINGS = frozenset(
 JSON_SETTINGS = frozenset({"pinned_stats"})
 
 
+def _decode_settings(row: sqlite3.Row) -> dict[str, Any]:
+    data = dict(row)
+    for key in BOOLEAN_SETTINGS:
+        data[key] = bool(data[key])
+    for key in JSON_SETTINGS:
+        try:
+            data[key] = json.loads(data[key])
+        except (json.JSONDecodeError, TypeError):
+            data[key] = []
+    return data
+
+
 def now_seconds() -> int:
     return int(time.time())
 
@@ -257,8 +369,16 @@ def now_millis() -> int:
 
 
 class Database:
-    def __init__(self, db_path: str, fernet_key: bytes, default_playlist_name: str):
+    def __init__(
+        self,
+        db_path: str,
+        fernet_key: bytes,
+        default_playlist_name: str,
+        readers: int = READER_POOL_SIZE,
+        flush_interval: float = OPEN_LISTEN_FLUSH_SECONDS,
+    ):
         os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.conn.execute("PRAGMA journal_mode = WAL")
@@ -266,11 +386,73 @@ class Database:
         self.lock = Lock()
         self.fernet = Fernet(fernet_key)
         self.default_playlist_name = default_playlist_name
+        # An in-memory database is private to its connection, so there is nothing for a
+        # second one to read; it falls back to sharing the writer, as everything used to.
+        self.readers = 0 if db_path == ":memory:" else max(0, int(readers))
+        self._reader_slots = BoundedSemaphore(max(self.readers, 1))
+        self._idle_readers: list[sqlite3.Connection] = []
+        # Latest (listened_ms, completion_ratio, duration_ms) per open row, waiting for
+        # the next flush. Zero disables the batching: every update commits on its own.
+        self.flush_interval = max(0.0, float(flush_interval))
+        self._pending_open: dict[int, tuple[int, float, int]] = {}
+        self._pending_lock = Lock()
+        self.write_stats = {
+            "open_updates": 0,
+            "open_updates_merged": 0,
+            "open_flushes": 0,
+            "open_rows_flushed": 0,
+        }
+        # Decoded settings per user; see `settings`.
+        self._settings: dict[int, dict[str, Any]] = {}
+        # Per-user change versions; see `touch_state`.
+        self._state_clock = itertools.count(1)
+        self._state_versions: dict[int, dict[str, int]] = {}
+        # Told (user_id, version, sections) on every touch, from whichever thread made it.
+        self.on_state_change: Optional[Callable[[int, int, tuple[str, ...]], None]] = None
         with self.lock:
-            self.conn.executescript(SCHEMA)
+            self.conn.executescript(SCHEMA + stats.SCHEMA)
             self.fts = self._enable_fts()
             self._migrate()
             self.conn.commit()
+        self._flush_stop = Event()
+        self._flusher: Optional[Thread] = None
+        if self.flush_interval:
+            self._flusher = Thread(
+                target=self._flush_loop, name="open-listen-flush", daemon=True
+            )
+            self._flusher.start()
+
+    def _open_reader(self) -> sqlite3.Connection:
+        uri = Path(self.db_path).absolute().as_uri() + "?mode=ro"
+        # Autocommit, so the BEGIN in `_reader` is the only transaction boundary.
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """A read-only connection, holding one snapshot for as long as it is checked out.
+
+        Several queries inside one `with` block see the same committed state, which is
+        what the lock used to guarantee for the stats page. With `readers=0` this is the
+        writer connection under the lock instead.
+        """
+        if not self.readers:
+            with self.lock:
+                yield self.conn
+            return
+
+        with self._reader_slots:
+            try:
+                conn = self._idle_readers.pop()
+            except IndexError:
+                conn = self._open_reader()
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("ROLLBACK")
+                self._idle_readers.append(conn)
 
     def _enable_fts(self) -> bool:
         """Build the search index, reporting whether this SQLite has FTS5 at all.
@@ -301,6 +483,8 @@ class Database:
             return int(row["value"])
         if self._table_exists("plays"):
             return 1  # the recently-played ledger
+        if self._table_exists("listens_v5"):
+            return 5  # part-way through moving the strings out of `listens`
         if "source" in self._columns("listens"):
             return 2  # measured listens, with backfilled ones alongside
         # No marker and no older shape: either brand new, or already current.
@@ -317,6 +501,12 @@ class Database:
             ("seen_contexts", "title", "TEXT"),
             ("cursors", "last_source_sweep", "INTEGER NOT NULL DEFAULT 0"),
             ("settings", "pinned_stats", "TEXT NOT NULL DEFAULT '[]'"),
+            ("user_stats", "tracks", "INTEGER NOT NULL DEFAULT 0"),
+            ("discovery_sources", "swept_month", "TEXT"),
+            ("discovery_sources", "swept_digest", "TEXT"),
+            ("listens", "local_day", "TEXT NOT NULL DEFAULT ''"),
+            ("listens", "local_hour", "INTEGER NOT NULL DEFAULT 0"),
+            ("listens", "origin", "INTEGER NOT NULL DEFAULT 0"),
         )
         for table, column, ddl in additions:
             if column not in self._columns(table):
@@ -340,10 +530,33 @@ class Database:
                     self.conn.execute(f"ALTER TABLE listens DROP COLUMN {column}")
             self.conn.execute("DROP INDEX IF EXISTS idx_listens_history_played")
 
-        if 0 < version < SCHEMA_VERSION:
+        if 0 < version < 6:
+            self._normalize_listens()
+
+        if 0 < version < 7:
+            # Ahead of the steps below, since the stats rebuild reads these columns. The
+            # index is recreated at the end with the columns that let it cover the stats.
+            filled = stats.fill_local_slots(self.conn)
+            log.info("Stored the local day and hour of %s listen(s)", filled)
+            self.conn.execute("DROP INDEX IF EXISTS idx_listens_user_time")
+
+        if 0 < version < 3:
             self._rebuild_play_counts()
             self.conn.execute("UPDATE listens SET completion_ratio = 0 WHERE completion_ratio IS NULL")
 
+        if 0 < version < 4:
+            users = stats.rebuild(self.conn)
+            log.info("Built the stats rollup for %s user(s) from the listen history", users)
+
+        if 0 < version < 5:
+            self.conn.execute(
+                """
+                UPDATE user_stats
+                   SET tracks = (SELECT COUNT(*) FROM play_counts p
+                                  WHERE p.user_id = user_stats.user_id)
+                """
+            )
+
         # `recently_played_after` tracked how far the sweep had read. There is no sweep.
         if "recently_played_after" in self._columns("cursors"):
             try:
@@ -351,6 +564,12 @@ class Database:
             except sqlite3.OperationalError as exc:  # pragma: no cover - old SQLite
                 log.debug("Left recently_played_after in place: %s", exc)
 
+        # An online recount cut short left a half-filled shadow table holding the index's
+        # name; the live table gets it back below.
+        tally.discard_shadow(self.conn)
+        self.conn.executescript(LISTENS_INDEXES)
+        self.conn.execute(tally.INDEX)
+
         self.conn.execute(
             "INSERT INTO meta (key, value) VALUES ('schema_version', ?) "
             "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
@@ -366,23 +585,82 @@ class Database:
         """
         # Dropped rather than emptied: an older schema had different columns here.
         self.conn.execute("DROP TABLE IF EXISTS play_counts")
-        self.conn.executescript(PLAY_COUNTS_DDL)
+        self.conn.executescript(tally.DDL)
+        tally.recount(self.conn)
+        log.info("Rebuilt play counts from the listen history")
+
+    def _normalize_listens(self) -> None:
+        """Rewrite `listens` with its strings moved out to `tracks` and `contexts`.
+
+        Every row used to carry its track id, name, artist and context URI -- well over
+        half its bytes, repeated on every play of the same song. SQLite can't drop those
+        columns in place and keep the table compact, so the history is copied into a
+        table of the current shape and the old one dropped. A track that was renamed
+        between plays keeps its latest name, as the tally always has.
+        """
+        if self._table_exists("listens_v5"):
+            # A rewrite interrupted part-way: the history is still whole in the old
+            # table, so whatever the new one holds is dropped and the copy starts again.
+            self.conn.execute("DROP TABLE IF EXISTS listens")
+        elif "track_key" in self._columns("listens"):
+            return
+        else:
+            # The old search index and its triggers read columns about to go, and the
+            # indexes' names are wanted for the new table.
+            for trigger in ("insert", "delete", "update"):
+                self.conn.execute(f"DROP TRIGGER IF EXISTS listens_fts_{trigger}")
+            self.conn.execute("DROP TABLE IF EXISTS listens_fts")
+            for index in ("idx_listens_user_time", "idx_listens_user_qualified_time",
+                          "idx_listens_user_track"):
+                self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+            self.conn.execute("ALTER TABLE listens RENAME TO listens_v5")
+
+        columns = self._columns("listens_v5")
+        self.conn.executescript(LISTENS_DDL)
         self.conn.execute(
             """
-            INSERT INTO play_counts
-                (user_id, track_id, name, artist, qualified_plays, total_plays, last_played)
-            SELECT user_id, track_id, name, artist,
-                   SUM(qualified), COUNT(*), MAX(played_at)
-              FROM listens
-             WHERE is_open = 0
-             GROUP BY user_id, track_id
+            INSERT INTO tracks (track_id, name, artist)
+            SELECT track_id, name, artist FROM listens_v5
+             WHERE id IN (SELECT MAX(id) FROM listens_v5 GROUP BY track_id)
+            ON CONFLICT(track_id) DO UPDATE SET name = excluded.name, artist = excluded.artist
             """
         )
-        log.info("Rebuilt play counts from the listen history")
+        context = "NULL"
+        if "context_uri" in columns:
+            context = "o.context_uri"
+            self.conn.execute(
+                """
+                INSERT OR IGNORE INTO contexts (uri)
+                SELECT DISTINCT context_uri FROM listens_v5 WHERE context_uri IS NOT NULL
+                """
+            )
+        is_open = "o.is_open" if "is_open" in columns else "0"
+        copied = self.conn.execute(
+            f"""
+            INSERT INTO listens
+                (id, user_id, track_key, played_at, duration_ms, listened_ms,
+                 completion_ratio, qualified, context_key, is_open)
+            SELECT o.id, o.user_id, t.key, o.played_at, COALESCE(o.duration_ms, 0),
+                   COALESCE(o.listened_ms, 0), COALESCE(o.completion_ratio, 0),
+                   COALESCE(o.qualified, 0), c.key, {is_open}
+              FROM listens_v5 o
+              JOIN tracks t ON t.track_id = o.track_id
+              LEFT JOIN contexts c ON c.uri = {context}
+             ORDER BY o.id
+            """
+        ).rowcount
+        self.conn.execute("DROP TABLE listens_v5")
+        log.info("Moved %s listen(s) onto the track and context tables", copied)
 
     def close(self) -> None:
+        self._flush_stop.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush_open_listens()
         with self.lock:
             self.conn.close()
+        while self._idle_readers:
+            self._idle_readers.pop().close()
 
     # ---------------------------------------------------------------- users
 
@@ -397,6 +675,7 @@ class Database:
                     (display_name, row["id"]),
                 )
                 self.conn.commit()
+                self.touch_state(int(row["id"]), "user")
                 return int(row["id"])
 
             cursor = self.conn.execute(
@@ -416,28 +695,28 @@ class Database:
             return user_id
 
     def user(self, user_id: int) -> Optional[dict[str, Any]]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT id, spotify_user_id, display_name FROM users WHERE id = ?",
                 (user_id,),
             ).fetchone()
         return dict(row) if row else None
 
     def user_count(self) -> int:
-        with self.lock:
-            row = self.conn.execute("SELECT COUNT(*) AS n FROM users").fetchone()
+        with self._reader() as conn:
+            row = conn.execute("SELECT COUNT(*) AS n FROM users").fetchone()
         return int(row["n"])
 
     def user_exists(self, spotify_user_id: str) -> bool:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT 1 FROM users WHERE spotify_user_id = ?", (spotify_user_id,)
             ).fetchone()
         return row is not None
 
     def connected_user_ids(self) -> list[int]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT u.id FROM users u
                 JOIN tokens t ON t.user_id = u.id
@@ -450,7 +729,26 @@ class Database:
     def delete_user(self, user_id: int) -> None:
         with self.lock:
             self.conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            # Tracks and contexts nobody else has heard went with them. One pass over
+            # the survivors' keys, rather than a lookup per dimension row. A track an
+            # import has added but not yet merged any plays of is still wanted, and the
+            # staging tables only exist once something has been imported.
+            keep = "SELECT DISTINCT track_key FROM listens"
+            if self._table_exists("import_staging"):
+                self.conn.execute("DELETE FROM import_staging WHERE user_id = ?", (user_id,))
+                self.conn.execute("DELETE FROM import_tracks WHERE user_id = ?", (user_id,))
+                keep += (
+                    " UNION SELECT tracks.key FROM tracks"
+                    " JOIN import_staging ON import_staging.track_id = tracks.track_id"
+                )
+            self.conn.execute(f"DELETE FROM tracks WHERE key NOT IN ({keep})")
+            self.conn.execute(
+                "DELETE FROM contexts WHERE key NOT IN"
+                " (SELECT context_key FROM listens WHERE context_key IS NOT NULL)"
+            )
             self.conn.commit()
+            self._settings.pop(user_id, None)
+            self._state_versions.pop(user_id, None)
 
     # --------------------------------------------------------------- tokens
 
@@ -477,8 +775,8 @@ class Database:
             self.conn.commit()
 
     def tokens(self, user_id: int) -> Optional[dict[str, Any]]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT access_token, refresh_token, expires_at FROM tokens WHERE user_id = ?",
                 (user_id,),
             ).fetchone()
@@ -500,6 +798,33 @@ class Database:
             self.conn.execute("DELETE FROM tokens WHERE user_id = ?", (user_id,))
             self.conn.commit()
 
+    # --------------------------------------------------------- state version
+
+    def touch_state(self, user_id: int, *sections: str) -> None:
+        """Record that something the browser's state poll shows has changed for a user.
+
+        Every write that changes what `/api/state` would return calls this, naming the
+        sections it moved (none means all of them), and so does the tracker for what it
+        only keeps in memory. The versions are in-memory only -- they restart with the
+        process, which is why the ETag built from them carries a per-boot nonce as well.
+        Drawn from one shared counter, so they only ever grow, and the newest section's
+        version is the user's version as a whole.
+        """
+        sections = sections or STATE_SECTIONS
+        version = next(self._state_clock)
+        versions = self._state_versions.setdefault(user_id, {})
+        for section in sections:
+            versions[section] = version
+        if self.on_state_change:
+            self.on_state_change(user_id, version, sections)
+
+    def state_version(self, user_id: int, section: Optional[str] = None) -> int:
+        """The version of one section, or of the newest change to any of them."""
+        versions = self._state_versions.get(user_id, {})
+        if section is not None:
+            return versions.get(section, 0)
+        return max(versions.values(), default=0)
+
     # ------------------------------------------------------------- sessions
 
     def create_session(self, token: str, user_id: int, expires_at: int) -> None:
@@ -514,8 +839,8 @@ class Database:
             self.conn.commit()
 
     def session_user_id(self, token: str) -> Optional[int]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT user_id, expires_at FROM sessions WHERE token = ?", (token,)
             ).fetchone()
         if not row or int(row["expires_at"]) < now_seconds():
@@ -550,22 +875,25 @@ class Database:
     # -------------------------------------------------------------- settings
 
     def settings(self, user_id: int) -> dict[str, Any]:
-        with self.lock:
-            row = self.conn.execute(
+        """A user's settings, from memory after the first read.
+
+        The tracker asks on every poll and the browser on every state request, so this is
+        kept off the database entirely: `update_settings` is the only writer and replaces
+        the cached entry as it commits. The dict is shared between every caller -- treat
+        it as read-only and copy anything you mean to change.
+        """
+        cached = self._settings.get(user_id)
+        if cached is not None:
+            return cached
+        with self._reader() as conn:
+            row = conn.execute(
                 f"SELECT {', '.join(SETTINGS_COLUMNS)} FROM settings WHERE user_id = ?",
                 (user_id,),
             ).fetchone()
         if not row:
             raise KeyError(f"No settings for user {user_id}")
-        data = dict(row)
-        for key in BOOLEAN_SETTINGS:
-            data[key] = bool(data[key])
-        for key in JSON_SETTINGS:
-            try:
-                data[key] = json.loads(data[key])
-            except (json.JSONDecodeError, TypeError):
-                data[key] = []
-        return data
+        # If an update landed while we read, its entry wins over our older snapshot.
+        return self._settings.setdefault(user_id, _decode_settings(row))
 
     def update_settings(self, user_id: int, updates: dict[str, Any]) -> dict[str, Any]:
         parts, values = [], []
@@ -579,14 +907,24 @@ class Database:
             parts.append(f"{key} = ?")
             values.append(value)
 
-        if parts:
-            values.append(user_id)
-            with self.lock:
-                self.conn.execute(
-                    f"UPDATE settings SET {', '.join(parts)} WHERE user_id = ?", tuple(values)
-                )
-                self.conn.commit()
-        return self.settings(user_id)
+        if not parts:
+            return self.settings(user_id)
+        values.append(user_id)
+        with self.lock:
+            self.conn.execute(
+                f"UPDATE settings SET {', '.join(parts)} WHERE user_id = ?", tuple(values)
+            )
+            self.conn.commit()
+            self.touch_state(user_id, "settings", "favorites", "stats")
+            row = self.conn.execute(
+                f"SELECT {', '.join(SETTINGS_COLUMNS)} FROM settings WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            if not row:
+                raise KeyError(f"No settings for user {user_id}")
+            # A new dict rather than an edit, so nobody holding the old one sees it change.
+            settings = self._settings[user_id] = _decode_settings(row)
+        return settings
 
     # --------------------------------------------------------------- listens
 
@@ -598,12 +936,13 @@ class Database:
         artist: str,
         played_at: int,
         qualified: bool,
-    ) -> int:
+    ) -> tuple[int, bool]:
         """Fold one listen into the per-track tally. Caller holds the lock.
 
         `play_counts` is a materialised aggregate of `listens`. It could be a GROUP BY,
         but the browser polls the state endpoint every few seconds and the history is
         the one table designed to grow forever -- so the tally is kept, not recomputed.
+        Returns the track's qualified plays, and whether this was its first listen.
         """
         self.conn.execute(
             """
@@ -620,10 +959,45 @@ class Database:
             (user_id, track_id, name, artist, 1 if qualified else 0, played_at),
         )
         row = self.conn.execute(
-            "SELECT qualified_plays FROM play_counts WHERE user_id = ? AND track_id = ?",
+            """
+            SELECT qualified_plays, total_plays FROM play_counts
+             WHERE user_id = ? AND track_id = ?
+            """,
             (user_id, track_id),
         ).fetchone()
-        return int(row["qualified_plays"])
+        return int(row["qualified_plays"]), int(row["total_plays"]) == 1
+
+    def _track_key(self, track_id: str, name: str, artist: str) -> int:
+        """The `tracks` key for a track, adding it or updating its name. Caller holds the lock."""
+        row = self.conn.execute(
+            "SELECT key, name, artist FROM tracks WHERE track_id = ?", (track_id,)
+        ).fetchone()
+        if row is None:
+            cursor = self.conn.execute(
+                "INSERT INTO tracks (track_id, name, artist) VALUES (?, ?, ?)",
+                (track_id, name, artist),
+            )
+            return int(cursor.lastrowid)
+        if (row["name"], row["artist"]) != (name, artist):
+            self.conn.execute(
+                "UPDATE tracks SET name = ?, artist = ? WHERE key = ?", (name, artist, row["key"])
+            )
+        return int(row["key"])
+
+    def _context_key(self, uri: Optional[str]) -> Optional[int]:
+        """The `contexts` key for a URI, adding it if it's new. Caller holds the lock."""
+        if not uri:
+            return None
+        row = self.conn.execute("SELECT key FROM contexts WHERE uri = ?", (uri,)).fetchone()
+        if row is not None:
+            return int(row["key"])
+        return int(self.conn.execute("INSERT INTO contexts (uri) VALUES (?)", (uri,)).lastrowid)
+
+    @staticmethod
+    def _local_day_and_hour(played_at: int) -> tuple[str, int]:
+        # Stored with the row, so the stats rebuild never converts a timestamp again.
+        day, _, hour = stats.local_slot(played_at)
+        return day, hour
 
     def open_listen(
         self,
@@ -640,11 +1014,18 @@ class Database:
             cursor = self.conn.execute(
                 """
                 INSERT INTO listens
-                    (user_id, track_id, name, artist, played_at, duration_ms, listened_ms,
-                     completion_ratio, qualified, context_uri, is_open)
-                VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, ?, 1)
+                    (user_id, track_key, played_at, duration_ms, listened_ms,
+                     completion_ratio, qualified, context_key, is_open, local_day, local_hour)
+                VALUES (?, ?, ?, ?, 0, 0, 0, ?, 1, ?, ?)
                 """,
-                (user_id, track_id, name, artist, played_at, duration_ms, context_uri),
+                (
+                    user_id,
+                    self._track_key(track_id, name, artist),
+                    played_at,
+                    duration_ms,
+                    self._context_key(context_uri),
+                    *self._local_day_and_hour(played_at),
+                ),
             )
             self.conn.commit()
         return int(cursor.lastrowid)
@@ -652,16 +1033,54 @@ class Database:
     def update_open_listen(
         self, row_id: int, listened_ms: int, completion_ratio: float, duration_ms: int
     ) -> None:
+        """Mirror an open listen's progress. Queued, and written on the next flush."""
+        with self._pending_lock:
+            self.write_stats["open_updates"] += 1
+            if row_id in self._pending_open:
+                self.write_stats["open_updates_merged"] += 1
+            self._pending_open[row_id] = (listened_ms, completion_ratio, duration_ms)
+        if not self.flush_interval:
+            self.flush_open_listens()
+
+    def flush_open_listens(self) -> int:
+        """Write every queued open-listen update in one transaction. Returns the row count.
+
+        Only the latest update per row is kept, and the UPDATE only touches rows still
+        open -- so a flush that lands after `close_listen` can never overwrite the final
+        figures with a stale one.
+        """
+        with self._pending_lock:
+            pending, self._pending_open = self._pending_open, {}
+        if not pending:
+            return 0
+
         with self.lock:
-            self.conn.execute(
+            self.conn.executemany(
                 """
                 UPDATE listens
                    SET listened_ms = ?, completion_ratio = ?, duration_ms = ?
                  WHERE id = ? AND is_open = 1
                 """,
-                (listened_ms, completion_ratio, duration_ms, row_id),
+                [(*values, row_id) for row_id, values in pending.items()],
             )
             self.conn.commit()
+        with self._pending_lock:
+            self.write_stats["open_flushes"] += 1
+            self.write_stats["open_rows_flushed"] += len(pending)
+        return len(pending)
+
+    def _flush_loop(self) -> None:
+        while not self._flush_stop.wait(self.flush_interval):
+            try:
+                self.flush_open_listens()
+            except Exception as exc:
+                log.warning("Could not flush open listens: %s", exc)
+
+    def metrics(self) -> dict[str, Any]:
+        with self._pending_lock:
+            return {
+                "open_listens": {**self.write_stats, "pending": len(self._pending_open)},
+            }
 
     def close_listen(
         self,
@@ -679,20 +1098,24 @@ class Database:
         """Finish a measured listen and return the track's qualified-play count.
 
         Both writes happen under one lock and one commit, so a listen can never be
-        recorded without its tally moving, or the other way round.
+        recorded without its tally moving, or the other way round. Commits immediately:
+        any queued progress for the row is superseded by the final figures.
         """
+        with self._pending_lock:
+            self._pending_open.pop(row_id, None)
         with self.lock:
             self.conn.execute(
                 """
                 UPDATE listens
-                   SET name = ?, artist = ?, played_at = ?, duration_ms = ?, listened_ms = ?,
-                       completion_ratio = ?, qualified = ?, is_open = 0
+                   SET track_key = ?, played_at = ?, local_day = ?, local_hour = ?,
+                       duration_ms = ?, listened_ms = ?, completion_ratio = ?, qualified = ?,
+                       is_open = 0
                  WHERE id = ?
                 """,
                 (
-                    name,
-                    artist,
+                    self._track_key(track_id, name, artist),
                     played_at,
+                    *self._local_day_and_hour(played_at),
                     duration_ms,
                     listened_ms,
                     completion_ratio,
@@ -700,8 +1123,21 @@ class Database:
                     row_id,
                 ),
             )
-            count = self._bump_counts(user_id, track_id, name, artist, played_at, qualified)
+            count, new_track = self._bump_counts(
+                user_id, track_id, name, artist, played_at, qualified
+            )
+            stats.fold(
+                self.conn,
+                user_id,
+                artist,
+                played_at,
+                listened_ms,
+                completion_ratio,
+                qualified,
+                new_track,
+            )
             self.conn.commit()
+            self.touch_state(user_id, "favorites", "stats")
         return count
 
     def close_orphaned_listens(self) -> None:
@@ -712,12 +1148,14 @@ class Database:
         listen that had already cleared the threshold still counts; one that hadn't is
         recorded at what it reached.
         """
+        self.flush_open_listens()
         with self.lock:
             rows = self.conn.execute(
                 """
-                SELECT l.id, l.user_id, l.track_id, l.name, l.artist, l.played_at,
-                       l.completion_ratio, s.min_completion_ratio AS threshold
+                SELECT l.id, l.user_id, t.track_id, t.name, t.artist, l.played_at,
+                       l.listened_ms, l.completion_ratio, s.min_completion_ratio AS threshold
                   FROM listens l
+                  JOIN tracks t ON t.key = l.track_key
                   JOIN settings s ON s.user_id = l.user_id
                  WHERE l.is_open = 1
                 """
@@ -728,7 +1166,7 @@ class Database:
                     "UPDATE listens SET is_open = 0, qualified = ? WHERE id = ?",
                     (1 if qualified else 0, row["id"]),
                 )
-                self._bump_counts(
+                _, new_track = self._bump_counts(
                     int(row["user_id"]),
                     str(row["track_id"]),
                     str(row["name"]),
@@ -736,7 +1174,19 @@ class Database:
                     int(row["played_at"]),
                     qualified=qualified,
                 )
+                stats.fold(
+                    self.conn,
+                    int(row["user_id"]),
+                    str(row["artist"]),
+                    int(row["played_at"]),
+                    int(row["listened_ms"] or 0),
+                    float(row["completion_ratio"] or 0),
+                    qualified,
+                    new_track,
+                )
             self.conn.commit()
+        for user_id in {int(row["user_id"]) for row in rows}:
+            self.touch_state(user_id, "favorites", "stats")
         if rows:
             log.info("Closed %s listen(s) interrupted by a restart", len(rows))
 
@@ -751,7 +1201,7 @@ class Database:
         end: Optional[int] = None,
         qualified: Optional[bool] = None,
         favorites_only: Optional[bool] = None,
-        favorite_track_ids: Optional[set[str]] = None,
+        favorite_track_ids: Optional[frozenset[str]] = None,
         sort: str = "time",
         cursor: Optional[str] = None,
         limit: int = 50,
@@ -761,36 +1211,120 @@ class Database:
         Sorted by the chosen column (default played_at). Paged by keyset: the cursor
         carries the last row's sort-column value plus its id.
         """
-        limit = max(1, min(int(limit), HISTORY_PAGE_LIMIT))
+        return self._history_page(
+            user_id,
+            query=query,
+            start=start,
+            end=end,
+            qualified=qualified,
+            favorites_only=favorites_only,
+            favorite_track_ids=favorite_track_ids,
+            sort=sort,
+            cursor=cursor,
+            limit=max(1, min(int(limit), HISTORY_PAGE_LIMIT)),
+        )
+
+    def export_history(
+        self,
+        user_id: int,
+        *,
+        query: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        qualified: Optional[bool] = None,
+        favorites_only: Optional[bool] = None,
+        favorite_track_ids: Optional[frozenset[str]] = None,
+        sort: str = "time",
+        chunk: int = EXPORT_CHUNK_ROWS,
+    ) -> Iterator[dict[str, Any]]:
+        """Every row `history` would page through with these filters, in the same order.
+
+        Read `chunk` rows at a time, each chunk its own short read that is over before
+        its rows are handed out -- so a download that takes minutes never holds a
+        reader, the lock, or a WAL snapshot for longer than one chunk takes to read, and
+        never has more than one chunk in memory.
+        """
+        cursor: Optional[str] = None
+        while True:
+            page = self._history_page(
+                user_id,
+                query=query,
+                start=start,
+                end=end,
+                qualified=qualified,
+                favorites_only=favorites_only,
+                favorite_track_ids=favorite_track_ids,
+                sort=sort,
+                cursor=cursor,
+                limit=chunk,
+            )
+            yield from page["items"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def import_history(
+        self,
+        user_id: int,
+        files: Iterable[IO[Any]],
+        resolve: Optional[importer.Resolver] = None,
+    ) -> dict[str, int]:
+        """Add the plays from Spotify streaming-history exports; see app/importer.py.
+
+        Staged and then merged in batches, each taking the lock only as long as it takes
+        to write, and the Web API asked about lengths with the lock let go -- the
+        tracker's writes wait for a batch at most, not for the file.
+        """
+        summary = importer.import_streams(
+            self.conn, user_id, files, lock=self.lock, resolve=resolve
+        )
+        if summary["imported"]:
+            self.touch_state(user_id, "favorites", "stats")
+        return summary
 
+    def _history_page(
+        self,
+        user_id: int,
+        *,
+        query: Optional[str],
+        start: Optional[int],
+        end: Optional[int],
+        qualified: Optional[bool],
+        favorites_only: Optional[bool],
+        favorite_track_ids: Optional[frozenset[str]],
+        sort: str,
+        cursor: Optional[str],
+        limit: int,
+    ) -> dict[str, Any]:
+        """The keyset page both `history()` and `export_history()` read."""
         sort_cols: dict[str, tuple[str, str]] = {
             "time": ("l.played_at", "played_at"),
-            "name": ("l.name", "name"),
-            "artist": ("l.artist", "artist"),
+            "name": ("t.name", "name"),
+            "artist": ("t.artist", "artist"),
             "length": ("l.duration_ms", "duration_ms"),
             "completion": ("l.completion_ratio", "completion_ratio"),
         }
         col_sql, col_name = sort_cols.get(sort, sort_cols["time"])
 
-        joins = ""
+        joins = " JOIN tracks t ON t.key = l.track_key"
         extra_cols = ""
         where = ["l.user_id = ?"]
         params: list[Any] = [user_id]
 
         if extra_cols or True:
             # Always join play_counts for the per-track tally shown in the UI.
-            joins += " LEFT JOIN play_counts pc ON pc.user_id = l.user_id AND pc.track_id = l.track_id"
+            joins += " LEFT JOIN play_counts pc ON pc.user_id = l.user_id AND pc.track_id = t.track_id"
             extra_cols += ", COALESCE(pc.qualified_plays, 0) AS play_count"
 
         if query and query.strip():
             if self.fts:
                 match = fts_query(query)
                 if match:
-                    joins += " JOIN listens_fts ON listens_fts.rowid = l.id"
-                    where.append("listens_fts MATCH ?")
+                    joins += " JOIN tracks_fts ON tracks_fts.rowid = l.track_key"
+                    where.append("tracks_fts MATCH ?")
                     params.append(match)
             else:
-                where.append("(l.name LIKE ? OR l.artist LIKE ?)")
+                where.append("(t.name LIKE ? OR t.artist LIKE ?)")
                 params += [f"%{query.strip()}%"] * 2
         if start is not None:
             where.append("l.played_at >= ?")
@@ -803,7 +1337,7 @@ class Database:
             params.append(1 if qualified else 0)
         if favorites_only and favorite_track_ids:
             placeholders = ",".join("?" * len(favorite_track_ids))
-            where.append(f"l.track_id IN ({placeholders})")
+            where.append(f"t.track_id IN ({placeholders})")
             params.extend(favorite_track_ids)
         if cursor is not None:
             parts = cursor.split("|", 2)
@@ -817,15 +1351,15 @@ class Database:
                 params += [cur_val, cur_val, cur_id]
 
         sql = f"""
-            SELECT l.id, l.track_id, l.name, l.artist, l.played_at, l.duration_ms,
+            SELECT l.id, t.track_id, t.name, t.artist, l.played_at, l.duration_ms,
                    l.listened_ms, l.completion_ratio, l.qualified, l.is_open{extra_cols}
               FROM listens l {joins}
              WHERE {' AND '.join(where)}
              ORDER BY {col_sql} DESC, l.id DESC
              LIMIT ?
         """
-        with self.lock:
-            rows = self.conn.execute(sql, (*params, limit + 1)).fetchall()
+        with self._reader() as conn:
+            rows = conn.execute(sql, (*params, limit + 1)).fetchall()
 
         items = [dict(row) for row in rows[:limit]]
         for item in items:
@@ -845,8 +1379,8 @@ class Database:
         return {"items": items, "next_cursor": next_cursor}
 
     def history_summary(self, user_id: int) -> dict[str, Any]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 """
                 SELECT COUNT(*) AS listens,
                        COALESCE(SUM(qualified), 0) AS qualified,
@@ -856,20 +1390,18 @@ class Database:
                 """,
                 (user_id,),
             ).fetchone()
-            tracks = self.conn.execute(
-                "SELECT COUNT(*) AS n FROM play_counts WHERE user_id = ?", (user_id,)
-            ).fetchone()
+            tracks = self._tracked_tracks(conn, user_id)
         return {
             "listens": int(row["listens"]),
             "qualified": int(row["qualified"]),
-            "tracks": int(tracks["n"]),
+            "tracks": tracks,
             "first_played": row["first_played"],
             "last_played": row["last_played"],
         }
 
     def count_listens_since(self, user_id: int, since_ms: int) -> dict[str, int]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 """
                 SELECT COUNT(*) AS total, COALESCE(SUM(qualified), 0) AS qualified
                   FROM listens WHERE user_id = ? AND played_at >= ?
@@ -879,8 +1411,10 @@ class Database:
         return {"total": int(row["total"]), "qualified": int(row["qualified"])}
 
     def play_counts(self, user_id: int) -> dict[str, dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        """Every track the user has ever heard. For tools and tests -- anything on a poll
+        path wants `play_counts_over` or `play_counts_for`, which cost what they return."""
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT track_id, name, artist, qualified_plays, total_plays, last_played
                 FROM play_counts WHERE user_id = ?
@@ -889,9 +1423,79 @@ class Database:
             ).fetchall()
         return {str(row["track_id"]): dict(row) for row in rows}
 
+    def play_counts_over(self, user_id: int, threshold: int) -> dict[str, dict[str, Any]]:
+        """The tracks with at least `threshold` qualified plays, read off the index."""
+        with self._reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT track_id, name, artist, qualified_plays, total_plays, last_played
+                FROM play_counts WHERE user_id = ? AND qualified_plays >= ?
+                """,
+                (user_id, threshold),
+            ).fetchall()
+        return {str(row["track_id"]): dict(row) for row in rows}
+
+    def play_counts_for(self, user_id: int, track_ids: Iterable[str]) -> dict[str, dict[str, Any]]:
+        """The tally for the given tracks, by primary key. Unheard ones are left out."""
+        ids = list(track_ids)
+        found: dict[str, dict[str, Any]] = {}
+        with self._reader() as conn:
+            for start in range(0, len(ids), SQL_VARIABLE_CHUNK):
+                chunk = ids[start : start + SQL_VARIABLE_CHUNK]
+                rows = conn.execute(
+                    f"""
+                    SELECT track_id, name, artist, qualified_plays, total_plays, last_played
+                    FROM play_counts
+                    WHERE user_id = ? AND track_id IN ({",".join("?" * len(chunk))})
+                    """,
+                    (user_id, *chunk),
+                ).fetchall()
+                found.update((str(row["track_id"]), dict(row)) for row in rows)
+        return found
+
+    def drifted_play_counts(self, user_ids: Optional[Iterable[int]] = None) -> list[int]:
+        """The users whose tally disagrees with their listens; everyone's checked by
+        default. Read from snapshots, a chunk of users each, so it holds up no writes."""
+        if user_ids is None:
+            with self._reader() as conn:
+                user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        user_ids = list(user_ids)
+        drifted: list[int] = []
+        for start in range(0, len(user_ids), tally.VERIFY_CHUNK_USERS):
+            with self._reader() as conn:
+                drifted += tally.drifted(conn, user_ids[start : start + tally.VERIFY_CHUNK_USERS])
+        return drifted
+
+    def repair_play_counts(self, user_ids: Iterable[int]) -> int:
+        """Recount the given users' tallies from their listens. Returns the rows written."""
+        user_ids = list(user_ids)
+        written = tally.repair(self.conn, user_ids, self.lock)
+        for user_id in user_ids:
+            self.touch_state(user_id, "favorites")
+        return written
+
+    def recount_play_counts(self) -> int:
+        """Recount every tally online; see `tally.rebuild`. Returns the rows it holds."""
+        written = tally.rebuild(self.conn, self.lock)
+        with self._reader() as conn:
+            user_ids = [row[0] for row in conn.execute("SELECT id FROM users")]
+        for user_id in user_ids:
+            self.touch_state(user_id, "favorites")
+        return written
+
+    def tracked_track_count(self, user_id: int) -> int:
+        with self._reader() as conn:
+            return self._tracked_tracks(conn, user_id)
+
+    @staticmethod
+    def _tracked_tracks(conn: sqlite3.Connection, user_id: int) -> int:
+        # Kept by the stats rollup as listens close, rather than counting the tally.
+        row = conn.execute("SELECT tracks FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+        return int(row[0]) if row else 0
+
     def next_favorite_candidate(self, user_id: int, threshold: int) -> Optional[dict[str, Any]]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 """
                 SELECT track_id, name, artist, qualified_plays, total_plays, last_played
                 FROM play_counts
@@ -903,56 +1507,14 @@ class Database:
             ).fetchone()
         return dict(row) if row else None
 
-    def _distinct_days(self, user_id: int) -> list[str]:
-        with self.lock:
-            rows = self.conn.execute(
-                """
-                SELECT DISTINCT DATE(played_at / 1000, 'unixepoch', 'localtime') AS day
-                  FROM listens WHERE user_id = ? AND is_open = 0
-                 ORDER BY day DESC
-                """,
-                (user_id,),
-            ).fetchall()
-        return [row["day"] for row in rows]
-
-    @staticmethod
-    def _compute_streaks(days: list[str]) -> tuple[int, int]:
-        if not days:
-            return 0, 0
-
-        from datetime import date, timedelta
-
-        today = date.today().isoformat()
-        dates = {date.fromisoformat(d) for d in days}
-        min_date = min(dates)
-
-        current = 0
-        d = date.today()
-        while d >= min_date:
-            if d in dates:
-                current += 1
-                d -= timedelta(days=1)
-            else:
-                break
-
-        longest = 0
-        run = 0
-        all_dates = sorted(dates, reverse=True)
-        prev: Optional[date] = None
-        for d in all_dates:
-            if prev is not None and (prev - d).days == 1:
-                run += 1
-            else:
-                run = 1
-            longest = max(longest, run)
-            prev = d
-
-        return current, longest
-
     def get_all_stats(self, user_id: int, threshold: int) -> dict[str, Any]:
-        with self.lock:
+        """The stats page. All-time figures come from the rollup in app/stats.py; the
+        rest read at most two weeks of listens, or the per-track tally, through an index."""
+        with self._reader() as conn:
+            rollup = stats.snapshot(conn, user_id)
+
             # Counted in 24h
-            row_24h = self.conn.execute(
+            row_24h = conn.execute(
                 """
                 SELECT COUNT(*) AS total, COALESCE(SUM(qualified), 0) AS qualified
                   FROM listens WHERE user_id = ? AND played_at >= ?
@@ -960,26 +1522,8 @@ class Database:
                 (user_id, now_millis() - 86_400_000),
             ).fetchone()
 
-            # Total listens + listening time + avg completion + skipped
-            row_listens = self.conn.execute(
-                """
-                SELECT COUNT(*) AS total,
-                       COALESCE(SUM(listened_ms), 0) AS total_ms,
-                       COALESCE(AVG(completion_ratio), 0) AS avg_completion,
-                       COALESCE(SUM(CASE WHEN qualified = 0 THEN 1 ELSE 0 END), 0) AS skipped
-                  FROM listens WHERE user_id = ? AND is_open = 0
-                """,
-                (user_id,),
-            ).fetchone()
-
-            # Tracks seen
-            row_tracks = self.conn.execute(
-                "SELECT COUNT(*) AS n FROM play_counts WHERE user_id = ?",
-                (user_id,),
-            ).fetchone()
-
             # Favorites count
-            row_favs = self.conn.execute(
+            row_favs = conn.execute(
                 """
                 SELECT COUNT(*) AS n FROM play_counts
                  WHERE user_id = ? AND qualified_plays >= ?
@@ -987,18 +1531,8 @@ class Database:
                 (user_id, threshold),
             ).fetchone()
 
-            # Top artist
-            row_artist = self.conn.execute(
-                """
-                SELECT artist, SUM(qualified_plays) AS plays
-                  FROM play_counts WHERE user_id = ?
-                 GROUP BY artist ORDER BY plays DESC LIMIT 1
-                """,
-                (user_id,),
-            ).fetchone()
-
             # Next favorite
-            row_next = self.conn.execute(
+            row_next = conn.execute(
                 """
                 SELECT track_id, name, artist, qualified_plays
                   FROM play_counts
@@ -1009,19 +1543,8 @@ class Database:
                 (user_id, threshold),
             ).fetchone()
 
-            # Peak hour
-            row_hour = self.conn.execute(
-                """
-                SELECT CAST(STRFTIME('%H', played_at / 1000, 'unixepoch', 'localtime') AS INTEGER) AS h,
-                       COUNT(*) AS n
-                  FROM listens WHERE user_id = ?
-                 GROUP BY h ORDER BY n DESC LIMIT 1
-                """,
-                (user_id,),
-            ).fetchone()
-
             # Avg daily hours, last 7 days
-            row_avg = self.conn.execute(
+            row_avg = conn.execute(
                 """
                 SELECT COALESCE(SUM(listened_ms) / 7.0 / 3600000.0, 0) AS avg_hrs
                   FROM listens WHERE user_id = ? AND is_open = 0
@@ -1031,7 +1554,7 @@ class Database:
             ).fetchone()
 
             # Top track
-            row_top_track = self.conn.execute(
+            row_top_track = conn.execute(
                 """
                 SELECT name, artist, qualified_plays
                   FROM play_counts WHERE user_id = ?
@@ -1041,62 +1564,20 @@ class Database:
                 (user_id,),
             ).fetchone()
 
-            # Unique artists
-            row_unique_artists = self.conn.execute(
-                "SELECT COUNT(DISTINCT artist) AS n FROM play_counts WHERE user_id = ?",
-                (user_id,),
-            ).fetchone()
-
-            # Perfect listens (tracks completed 100%)
-            row_perfect = self.conn.execute(
-                """
-                SELECT COUNT(*) AS n FROM listens
-                 WHERE user_id = ? AND is_open = 0 AND completion_ratio >= 1.0
-                """,
-                (user_id,),
-            ).fetchone()
-
             # Listening trend: this week vs last week
             week_ago = now_millis() - 7 * 86_400_000
             fortnight_ago = now_millis() - 14 * 86_400_000
-            row_trend = self.conn.execute(
+            row_trend = conn.execute(
                 """
                 SELECT COALESCE(SUM(CASE WHEN played_at >= ? THEN listened_ms END), 0) AS this_week,
-                       COALESCE(SUM(CASE WHEN played_at >= ? AND played_at < ? THEN listened_ms END), 0) AS last_week
-                  FROM listens WHERE user_id = ? AND is_open = 0
+                       COALESCE(SUM(CASE WHEN played_at < ? THEN listened_ms END), 0) AS last_week
+                  FROM listens WHERE user_id = ? AND is_open = 0 AND played_at >= ?
                 """,
-                (week_ago, fortnight_ago, week_ago, user_id),
-            ).fetchone()
-
-            # First listen date
-            row_first = self.conn.execute(
-                "SELECT MIN(played_at) AS ts FROM listens WHERE user_id = ? AND is_open = 0",
-                (user_id,),
-            ).fetchone()
-
-            # Most active day of week
-            row_dow = self.conn.execute(
-                """
-                SELECT CAST(STRFTIME('%w', played_at / 1000, 'unixepoch', 'localtime') AS INTEGER) AS dow,
-                       COUNT(*) AS n
-                  FROM listens WHERE user_id = ?
-                 GROUP BY dow ORDER BY n DESC LIMIT 1
-                """,
-                (user_id,),
-            ).fetchone()
-
-            # Late night listening
-            row_late = self.conn.execute(
-                """
-                SELECT COUNT(*) AS total,
-                       SUM(CASE WHEN CAST(STRFTIME('%H', played_at / 1000, 'unixepoch', 'localtime') AS INTEGER) BETWEEN 0 AND 5 THEN 1 ELSE 0 END) AS late
-                  FROM listens WHERE user_id = ? AND is_open = 0
-                """,
-                (user_id,),
+                (week_ago, week_ago, user_id, fortnight_ago),
             ).fetchone()
 
             # Top context / playlist
-            row_context = self.conn.execute(
+            row_context = conn.execute(
                 """
                 SELECT title, playlist_id, play_count
                   FROM seen_contexts WHERE user_id = ?
@@ -1105,11 +1586,7 @@ class Database:
                 (user_id,),
             ).fetchone()
 
-        # Streaks (outside lock b/c it uses distinct_days which acquires its own)
-        days = self._distinct_days(user_id)
-        current_streak, longest_streak = self._compute_streaks(days)
-
-        total_ms = int(row_listens["total_ms"]) if row_listens else 0
+        total_ms = rollup["listened_ms"]
         hours = total_ms // 3_600_000
         mins = (total_ms % 3_600_000) // 60_000
 
@@ -1124,7 +1601,7 @@ class Database:
             "subtitle": f"of {total_24h} played in last 24h",
         })
 
-        total_listens_n = int(row_listens["total"]) if row_listens else 0
+        total_listens_n = rollup["listens"]
 
         if row_next:
             result.append({
@@ -1148,8 +1625,8 @@ class Database:
             "subtitle": "total tracked",
         })
 
-        if row_first and row_first["ts"]:
-            first_ts = int(row_first["ts"]) / 1000
+        if rollup["first_played_at"]:
+            first_ts = int(rollup["first_played_at"]) / 1000
             result.append({
                 "id": "first_listen",
                 "label": "Tracking Since",
@@ -1157,7 +1634,7 @@ class Database:
                 "subtitle": "first listen recorded",
             })
 
-        total_tracks_n = int(row_tracks["n"])
+        total_tracks_n = rollup["tracks"]
         result.append({
             "id": "total_tracks",
             "label": "Unique Tracks",
@@ -1165,7 +1642,7 @@ class Database:
             "subtitle": "different songs heard",
         })
 
-        total_artists_n = int(row_unique_artists["n"]) if row_unique_artists else 0
+        total_artists_n = rollup["artists"]
         result.append({
             "id": "total_artists",
             "label": "Unique Artists",
@@ -1188,12 +1665,13 @@ class Database:
                 "subtitle": f"{row_top_track['artist']} · {int(row_top_track['qualified_plays'])} plays",
             })
 
-        if row_artist:
+        if rollup["top_artist"]:
+            top_artist, top_artist_plays = rollup["top_artist"]
             result.append({
                 "id": "top_artist",
                 "label": "Top Artist",
-                "value": str(row_artist["artist"]),
-                "subtitle": f"{int(row_artist['plays'])} counted plays",
+                "value": top_artist,
+                "subtitle": f"{top_artist_plays} counted plays",
             })
 
         if row_context and row_context["title"]:
@@ -1204,6 +1682,7 @@ class Database:
                 "subtitle": f"{int(row_context['play_count'])} plays · most played playlist",
             })
 
+        current_streak, longest_streak = rollup["current_streak"], rollup["longest_streak"]
         result.append({
             "id": "current_streak",
             "label": "Current Streak",
@@ -1218,25 +1697,25 @@ class Database:
             "subtitle": "all-time best",
         })
 
-        if row_hour:
+        if rollup["peak_hour"] is not None:
             result.append({
                 "id": "peak_hour",
                 "label": "Peak Hour",
-                "value": f"{int(row_hour['h'])}:00",
+                "value": f"{rollup['peak_hour']}:00",
                 "subtitle": "most active hour",
             })
 
         _DAY_NAMES = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
-        if row_dow:
+        if rollup["top_weekday"] is not None:
             result.append({
                 "id": "top_day",
                 "label": "Top Day",
-                "value": _DAY_NAMES[int(row_dow["dow"])],
+                "value": _DAY_NAMES[rollup["top_weekday"]],
                 "subtitle": "busiest day of the week",
             })
 
-        if row_late and int(row_late["total"]) > 0:
-            late_pct = round(int(row_late["late"]) / int(row_late["total"]) * 100)
+        if total_listens_n > 0:
+            late_pct = round(rollup["late_night"] / total_listens_n * 100)
             vibe = "Night Owl" if late_pct >= 25 else "Early Bird"
             result.append({
                 "id": "night_owl",
@@ -1245,7 +1724,7 @@ class Database:
                 "subtitle": f"{late_pct}% of plays between midnight–5am",
             })
 
-        avg_pct = round((float(row_listens["avg_completion"]) if row_listens else 0) * 100)
+        avg_pct = round(rollup["avg_completion"] * 100)
         result.append({
             "id": "avg_completion",
             "label": "Avg Completion",
@@ -1253,8 +1732,8 @@ class Database:
             "subtitle": "mean listen-through",
         })
 
-        total_closed = int(row_listens["total"]) if row_listens else 0
-        skip_n = int(row_listens["skipped"]) if row_listens else 0
+        total_closed = total_listens_n
+        skip_n = rollup["skipped"]
         skip_pct = round(skip_n / total_closed * 100) if total_closed > 0 else 0
         result.append({
             "id": "skip_rate",
@@ -1263,7 +1742,7 @@ class Database:
             "subtitle": f"{skip_n:,} tracks skipped before counting",
         })
 
-        perfect_n = int(row_perfect["n"]) if row_perfect else 0
+        perfect_n = rollup["perfect"]
         result.append({
             "id": "perfect_listens",
             "label": "Perfect Listens",
@@ -1300,8 +1779,8 @@ class Database:
     # ------------------------------------------------------------- discovery
 
     def discovery_sources(self, user_id: int) -> list[dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT playlist_id, label, degraded FROM discovery_sources
                 WHERE user_id = ? ORDER BY created_at
@@ -1312,11 +1791,41 @@ class Database:
 
     def set_source_degraded(
         self, user_id: int, playlist_id: str, error: Optional[str]
+    ) -> None:
+        with self.lock:
+            changed = self.conn.execute(
+                """
+                UPDATE discovery_sources SET degraded = ?
+                 WHERE user_id = ? AND playlist_id = ? AND degraded IS NOT ?
+                """,
+                (error, user_id, playlist_id, error),
+            ).rowcount
+            self.conn.commit()
+            if changed:
+                self.touch_state(user_id, "discovery")
+
+    def source_digest(self, user_id: int, playlist_id: str, month: str) -> Optional[str]:
+        """The digest of the track list last swept into `month`, if any was."""
+        with self._reader() as conn:
+            row = conn.execute(
+                """
+                SELECT swept_digest FROM discovery_sources
+                 WHERE user_id = ? AND playlist_id = ? AND swept_month = ?
+                """,
+                (user_id, playlist_id, month),
+            ).fetchone()
+        return row["swept_digest"] if row else None
+
+    def set_source_digest(
+        self, user_id: int, playlist_id: str, month: str, digest: Optional[str]
     ) -> None:
         with self.lock:
             self.conn.execute(
-                "UPDATE discovery_sources SET degraded = ? WHERE user_id = ? AND playlist_id = ?",
-                (error, user_id, playlist_id),
+                """
+                UPDATE discovery_sources SET swept_month = ?, swept_digest = ?
+                 WHERE user_id = ? AND playlist_id = ?
+                """,
+                (month, digest, user_id, playlist_id),
             )
             self.conn.commit()
 
@@ -1335,6 +1844,7 @@ class Database:
                 (user_id, playlist_id),
             )
             self.conn.commit()
+            self.touch_state(user_id, "discovery")
 
     def remove_discovery_source(self, user_id: int, playlist_id: str) -> None:
         with self.lock:
@@ -1343,6 +1853,7 @@ class Database:
                 (user_id, playlist_id),
             )
             self.conn.commit()
+            self.touch_state(user_id, "discovery")
 
     def note_seen_context(
         self,
@@ -1368,8 +1879,8 @@ class Database:
             self.conn.commit()
 
     def unlabelled_contexts(self, user_id: int) -> list[dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT playlist_id, sample_track, title, play_count, last_seen
                 FROM seen_contexts
@@ -1382,8 +1893,8 @@ class Database:
         return [dict(row) for row in rows]
 
     def last_source_sweep(self, user_id: int) -> int:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT last_source_sweep FROM cursors WHERE user_id = ?", (user_id,)
             ).fetchone()
         return int(row["last_source_sweep"]) if row else 0
@@ -1410,16 +1921,24 @@ class Database:
         artist: str,
         reason: str,
     ) -> None:
+        self.record_blocked_many(user_id, month, [(track_id, name, artist, reason)])
+
+    def record_blocked_many(
+        self, user_id: int, month: str, rows: list[tuple[str, str, str, str]]
+    ) -> None:
+        """Record (track_id, name, artist, reason) rows in one transaction."""
+        blocked_at = now_seconds()
         with self.lock:
-            self.conn.execute(
+            self.conn.executemany(
                 """
                 INSERT OR IGNORE INTO discovery_blocked
                     (user_id, month, track_id, name, artist, reason, blocked_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (user_id, month, track_id, name, artist, reason, now_seconds()),
+                [(user_id, month, *row, blocked_at) for row in rows],
             )
             self.conn.commit()
+            self.touch_state(user_id, "discovery")
 
     def is_seen_this_month(self, user_id: int, month: str, track_id: str) -> bool:
         """Already archived or already blocked -- either way, don't reprocess it.
@@ -1427,23 +1946,31 @@ class Database:
         Blocked tracks count here so a filtered track doesn't cost an API lookup on
         every single sweep for the rest of the month.
         """
-        with self.lock:
-            row = self.conn.execute(
+        return not self.unseen_this_month(user_id, month, [track_id])
+
+    def unseen_this_month(self, user_id: int, month: str, track_ids: list[str]) -> list[str]:
+        """The tracks neither archived nor blocked in `month`, in the order given.
+
+        One query for a whole track list: the ids go in as a JSON array and are joined
+        against both ledgers by primary key, rather than asked about one at a time.
+        """
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
-                SELECT 1 FROM discovery_archive
-                 WHERE user_id = ? AND month = ? AND track_id = ?
-                UNION ALL
-                SELECT 1 FROM discovery_blocked
-                 WHERE user_id = ? AND month = ? AND track_id = ?
-                 LIMIT 1
+                SELECT ids.value FROM json_each(?) ids
+                 WHERE NOT EXISTS (SELECT 1 FROM discovery_archive a
+                                    WHERE a.user_id = ? AND a.month = ? AND a.track_id = ids.value)
+                   AND NOT EXISTS (SELECT 1 FROM discovery_blocked b
+                                    WHERE b.user_id = ? AND b.month = ? AND b.track_id = ids.value)
+                 ORDER BY ids.key
                 """,
-                (user_id, month, track_id, user_id, month, track_id),
-            ).fetchone()
-        return row is not None
+                (json.dumps(track_ids), user_id, month, user_id, month),
+            ).fetchall()
+        return [str(row[0]) for row in rows]
 
     def blocked_month(self, user_id: int, month: str) -> list[dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT track_id, name, artist, reason, blocked_at FROM discovery_blocked
                 WHERE user_id = ? AND month = ? ORDER BY blocked_at DESC
@@ -1470,30 +1997,56 @@ class Database:
         source_id: str,
     ) -> bool:
         """Returns True only the first time a track lands in a given month."""
+        track = {"track_id": track_id, "name": name, "artist": artist}
+        return bool(self.archive_discovery_many(user_id, month, [track], source_id))
+
+    def archive_discovery_many(
+        self, user_id: int, month: str, tracks: list[dict[str, str]], source_id: str
+    ) -> list[dict[str, str]]:
+        """Archive tracks in one transaction. Returns those that weren't already there."""
+        added_at = now_seconds()
+        archived = []
         with self.lock:
-            cursor = self.conn.execute(
-                """
-                INSERT OR IGNORE INTO discovery_archive
-                    (user_id, month, track_id, name, artist, source_id, added_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (user_id, month, track_id, name, artist, source_id, now_seconds()),
-            )
+            for track in tracks:
+                cursor = self.conn.execute(
+                    """
+                    INSERT OR IGNORE INTO discovery_archive
+                        (user_id, month, track_id, name, artist, source_id, added_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        user_id,
+                        month,
+                        track["track_id"],
+                        track["name"],
+                        track["artist"],
+                        source_id,
+                        added_at,
+                    ),
+                )
+                if cursor.rowcount == 1:
+                    archived.append(track)
             self.conn.commit()
-        return cursor.rowcount == 1
+            if archived:
+                self.touch_state(user_id, "discovery")
+        return archived
 
     def unarchive_discovery(self, user_id: int, month: str, track_id: str) -> None:
-        """Roll back an archive row when the Spotify write that followed it failed."""
+        self.unarchive_discovery_many(user_id, month, [track_id])
+
+    def unarchive_discovery_many(self, user_id: int, month: str, track_ids: list[str]) -> None:
+        """Roll back archive rows when the Spotify write that followed them failed."""
         with self.lock:
-            self.conn.execute(
+            self.conn.executemany(
                 "DELETE FROM discovery_archive WHERE user_id = ? AND month = ? AND track_id = ?",
-                (user_id, month, track_id),
+                [(user_id, month, track_id) for track_id in track_ids],
             )
             self.conn.commit()
+            self.touch_state(user_id, "discovery")
 
     def discovery_month(self, user_id: int, month: str) -> list[dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT track_id, name, artist, added_at FROM discovery_archive
                 WHERE user_id = ? AND month = ? ORDER BY added_at DESC
@@ -1503,8 +2056,8 @@ class Database:
         return [dict(row) for row in rows]
 
     def discovery_months(self, user_id: int) -> list[dict[str, Any]]:
-        with self.lock:
-            rows = self.conn.execute(
+        with self._reader() as conn:
+            rows = conn.execute(
                 """
                 SELECT month, COUNT(*) AS tracks FROM discovery_archive
                 WHERE user_id = ? GROUP BY month ORDER BY month DESC
@@ -1514,8 +2067,8 @@ class Database:
         return [dict(row) for row in rows]
 
     def discovery_playlist_id(self, user_id: int, month: str) -> Optional[str]:
-        with self.lock:
-            row = self.conn.execute(
+        with self._reader() as conn:
+            row = conn.execute(
                 "SELECT playlist_id FROM discovery_playlists WHERE user_id = ? AND month = ?",
                 (user_id, month),
             ).fetchone()
@@ -1531,3 +2084,206 @@ class Database:
                 (user_id, month, playlist_id),
             )
             self.conn.commit()
+            self.touch_state(user_id, "discovery")
+
+    # ------------------------------------------------------------ track artists
+
+    def track_artists(self, track_ids: Iterable[str]) -> dict[str, list[str]]:
+        """Cached artist ids for whichever of these tracks have been resolved before."""
+        ids = list(track_ids)
+        found: dict[str, list[str]] = {}
+        with self._reader() as conn:
+            for start in range(0, len(ids), SQL_VARIABLE_CHUNK):
+                chunk = ids[start : start + SQL_VARIABLE_CHUNK]
+                rows = conn.execute(
+                    f"""
+                    SELECT track_id, artist_ids FROM track_artists
+                    WHERE track_id IN ({",".join("?" * len(chunk))})
+                    """,
+                    chunk,
+                ).fetchall()
+                found.update((str(row["track_id"]), json.loads(row["artist_ids"])) for row in rows)
+        return found
+
+    def save_track_artists(self, resolved: dict[str, list[str]]) -> None:
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO track_artists (track_id, artist_ids, resolved_at) VALUES (?, ?, ?)
+                ON CONFLICT(track_id) DO UPDATE SET
+                    artist_ids  = excluded.artist_ids,
+                    resolved_at = excluded.resolved_at
+                """,
+                [
+                    (track_id, json.dumps(artist_ids), now_seconds())
+                    for track_id, artist_ids in resolved.items()
+                ],
+            )
+            self.conn.commit()
+
+    # ------------------------------------------------------- playlist mirror
+
+    def playlist_mirror(
+        self, user_id: int, playlist_id: Optional[str] = None
+    ) -> dict[str, MirroredPlaylist]:
+        """The user's mirrored playlists -- or just the one -- with their snapshot, and
+        their tracks in order."""
+        where, params = "user_id = ?", (user_id,)
+        if playlist_id is not None:
+            where, params = "user_id = ? AND playlist_id = ?", (user_id, playlist_id)
+        with self._reader() as conn:
+            mirrored: dict[str, MirroredPlaylist] = {
+                str(row["playlist_id"]): (row["snapshot_id"], [])
+                for row in conn.execute(
+                    f"SELECT playlist_id, snapshot_id FROM playlist_mirror WHERE {where}",
+                    params,
+                )
+            }
+            for row in conn.execute(
+                f"""
+                SELECT playlist_id, track_id, name, artist FROM playlist_tracks
+                WHERE {where} ORDER BY playlist_id, position
+                """,
+                params,
+            ):
+                mirrored[str(row["playlist_id"])][1].append(
+                    {"track_id": row["track_id"], "name": row["name"], "artist": row["artist"]}
+                )
+        return mirrored
+
+    def mirrored_playlist_ids(self, user_id: int) -> set[str]:
+        """Which of the user's playlists are mirrored, without reading their tracks."""
+        with self._reader() as conn:
+            return {
+                str(row["playlist_id"])
+                for row in conn.execute(
+                    "SELECT playlist_id FROM playlist_mirror WHERE user_id = ?", (user_id,)
+                )
+            }
+
+    def save_playlist_mirror(
+        self,
+        user_id: int,
+        playlist_id: str,
+        snapshot_id: Optional[str],
+        tracks: list[dict[str, str]],
+    ) -> None:
+        """Replace the mirrored copy with a full read of the playlist."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?",
+                (user_id, playlist_id),
+            )
+            self._set_mirror_snapshot(user_id, playlist_id, snapshot_id)
+            self._insert_mirror_tracks(user_id, playlist_id, 0, tracks)
+            self.conn.commit()
+
+    def mirror_added(
+        self,
+        user_id: int,
+        playlist_id: str,
+        snapshot_id: Optional[str],
+        tracks: list[dict[str, str]],
+        position: Optional[int] = None,
+    ) -> None:
+        """Tracks added at `position`, or at the end: the ones after it move down."""
+        with self.lock:
+            if position is None:
+                position = self.conn.execute(
+                    "SELECT COUNT(*) FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?",
+                    (user_id, playlist_id),
+                ).fetchone()[0]
+            else:
+                self._shift_mirror(user_id, playlist_id, position, len(tracks))
+            self._set_mirror_snapshot(user_id, playlist_id, snapshot_id)
+            self._insert_mirror_tracks(user_id, playlist_id, position, tracks)
+            self.conn.commit()
+
+    def mirror_removed(
+        self, user_id: int, playlist_id: str, snapshot_id: Optional[str], track_ids: set[str]
+    ) -> None:
+        """Every occurrence of these tracks gone, and the rest closed up behind them."""
+        ids = list(track_ids)
+        with self.lock:
+            for start in range(0, len(ids), SQL_VARIABLE_CHUNK):
+                chunk = ids[start : start + SQL_VARIABLE_CHUNK]
+                self.conn.execute(
+                    f"""
+                    DELETE FROM playlist_tracks
+                    WHERE user_id = ? AND playlist_id = ?
+                      AND track_id IN ({",".join("?" * len(chunk))})
+                    """,
+                    (user_id, playlist_id, *chunk),
+                )
+            # Renumbered through negative positions, so no two rows ever share a key
+            # part-way through the update.
+            self.conn.execute(
+                """
+                UPDATE playlist_tracks SET position = -1 - ranked.new_position
+                FROM (
+                    SELECT position AS old_position,
+                           ROW_NUMBER() OVER (ORDER BY position) - 1 AS new_position
+                    FROM playlist_tracks WHERE user_id = ?1 AND playlist_id = ?2
+                ) AS ranked
+                WHERE user_id = ?1 AND playlist_id = ?2 AND position = ranked.old_position
+                """,
+                (user_id, playlist_id),
+            )
+            self._flip_mirror_positions(user_id, playlist_id)
+            self._set_mirror_snapshot(user_id, playlist_id, snapshot_id)
+            self.conn.commit()
+
+    def forget_playlist_mirror(self, user_id: int, playlist_id: Optional[str] = None) -> None:
+        with self.lock:
+            if playlist_id is None:
+                self.conn.execute("DELETE FROM playlist_mirror WHERE user_id = ?", (user_id,))
+            else:
+                self.conn.execute(
+                    "DELETE FROM playlist_mirror WHERE user_id = ? AND playlist_id = ?",
+                    (user_id, playlist_id),
+                )
+            self.conn.commit()
+
+    def _set_mirror_snapshot(
+        self, user_id: int, playlist_id: str, snapshot_id: Optional[str]
+    ) -> None:
+        self.conn.execute(
+            """
+            INSERT INTO playlist_mirror (user_id, playlist_id, snapshot_id) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, playlist_id) DO UPDATE SET snapshot_id = excluded.snapshot_id
+            """,
+            (user_id, playlist_id, snapshot_id),
+        )
+
+    def _insert_mirror_tracks(
+        self, user_id: int, playlist_id: str, first: int, tracks: list[dict[str, str]]
+    ) -> None:
+        self.conn.executemany(
+            """
+            INSERT INTO playlist_tracks (user_id, playlist_id, position, track_id, name, artist)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (user_id, playlist_id, first + i, t["track_id"], t["name"], t["artist"])
+                for i, t in enumerate(tracks)
+            ],
+        )
+
+    def _shift_mirror(self, user_id: int, playlist_id: str, position: int, by: int) -> None:
+        self.conn.execute(
+            """
+            UPDATE playlist_tracks SET position = -1 - (position + ?)
+            WHERE user_id = ? AND playlist_id = ? AND position >= ?
+            """,
+            (by, user_id, playlist_id, position),
+        )
+        self._flip_mirror_positions(user_id, playlist_id)
+
+    def _flip_mirror_positions(self, user_id: int, playlist_id: str) -> None:
+        self.conn.execute(
+            """
+            UPDATE playlist_tracks SET position = -1 - position
+            WHERE user_id = ? AND playlist_id = ? AND position < 0
+            """,
+            (user_id, playlist_id),
+        )
@@ -14,16 +14,20 @@ playlist behind it doesn't) if the page's shape ever changes.
 Tracks by artists on the live AI blocklist are filtered out before anything is written.
 """
 
+import hashlib
 import json
 import logging
 import re
+import time
+from dataclasses import dataclass
 from datetime import datetime
+from threading import Lock
 from typing import Any, Optional
 
 import requests
 import spotipy
 
-from . import playlists
+from . import playlists, sweeps
 from .aiblocklist import AiBlocklist
 from .db import Database
 from .playlists import PlaylistCache
@@ -33,6 +37,9 @@ log = logging.getLogger(__name__)
 EMBED_URL = "https://open.spotify.com/embed/playlist/{playlist_id}"
 OEMBED_URL = "https://open.spotify.com/oembed"
 EMBED_TIMEOUT = 25
+# How long a read embed page is trusted outright. Past it, the page is revalidated with a
+# conditional GET, so a playlist that hasn't changed costs an empty 304, not the page.
+EMBED_TTL_SECONDS = 30 * 60
 EMBED_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126 Safari/537.36"
 
 NEXT_DATA_RE = re.compile(
@@ -45,11 +52,69 @@ PLAYLIST_DESCRIPTION = "Discoveries from this month. Maintained automatically."
 # what this feature is for. Anything else needs one click from the user.
 AUTO_SOURCE_TITLES = {"discover weekly"}
 
+# Tracks per `GET /tracks?ids=`, the endpoint's own limit.
+TRACKS_PER_REQUEST = 50
+
 
 class EmbedUnavailable(Exception):
     """The embed page didn't parse. Callers fall back to play-based capture."""
 
 
+@dataclass
+class _Embed:
+    data: dict[str, Any]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    checked_at: float
+
+
+class EmbedCache:
+    """Parsed embed pages by playlist id, shared by every user's sweep.
+
+    Several people's sources are often the same public playlist, and a Discover Weekly
+    is re-checked every couple of hours on Mondays, so the same page used to be fetched
+    and parsed over and over. Within the TTL a read is served from here; after it, the
+    page is revalidated rather than fetched blind.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[str, _Embed] = {}
+        self._lock = Lock()
+
+    def get(self, playlist_id: str) -> Optional[_Embed]:
+        with self._lock:
+            return self._entries.get(playlist_id)
+
+    def put(
+        self,
+        playlist_id: str,
+        data: dict[str, Any],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        with self._lock:
+            self._entries[playlist_id] = _Embed(data, etag, last_modified, time.monotonic())
+
+    def revalidated(self, playlist_id: str) -> None:
+        """The server said the page hasn't changed: trust it for another TTL."""
+        with self._lock:
+            entry = self._entries.get(playlist_id)
+            if entry:
+                entry.checked_at = time.monotonic()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+embed_cache = EmbedCache()
+
+
+def tracks_digest(tracks: list[dict[str, str]]) -> str:
+    """A fingerprint of a track list: equal exactly when the same tracks, in order."""
+    return hashlib.sha256("\n".join(t["track_id"] for t in tracks).encode()).hexdigest()
+
+
 def month_key(moment: Optional[datetime] = None) -> str:
     """Stable sort/group key, e.g. '2026-07'."""
     return (moment or datetime.now()).strftime("%Y-%m")
@@ -102,18 +167,46 @@ def playlist_title(playlist_id: str) -> Optional[str]:
 
 
 def read_playlist_embed(playlist_id: str) -> dict[str, Any]:
-    """Full track list from the public embed page. Raises EmbedUnavailable on any problem."""
+    """Full track list from the public embed page. Raises EmbedUnavailable on any problem.
+
+    Goes through `embed_cache`, and a request that does go out draws from the shared
+    embed budget. The result carries a `digest` of its track list.
+    """
+    cached = embed_cache.get(playlist_id)
+    if cached and time.monotonic() - cached.checked_at < EMBED_TTL_SECONDS:
+        return cached.data
+
+    headers = {"User-Agent": EMBED_UA}
+    if cached and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+    sweeps.budget.embed.take()
     try:
         response = requests.get(
             EMBED_URL.format(playlist_id=playlist_id),
             timeout=EMBED_TIMEOUT,
-            headers={"User-Agent": EMBED_UA},
+            headers=headers,
         )
+        if cached and response.status_code == 304:
+            embed_cache.revalidated(playlist_id)
+            return cached.data
         response.raise_for_status()
     except Exception as exc:
         raise EmbedUnavailable(f"fetch failed: {exc}") from exc
 
-    match = NEXT_DATA_RE.search(response.text)
+    data = parse_embed(response.text)
+    embed_cache.put(
+        playlist_id,
+        data,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+    return data
+
+
+def parse_embed(html: str) -> dict[str, Any]:
+    match = NEXT_DATA_RE.search(html)
     if not match:
         raise EmbedUnavailable("no __NEXT_DATA__ block on the page")
 
@@ -139,7 +232,15 @@ def read_playlist_embed(playlist_id: str) -> dict[str, Any]:
     if not tracks:
         raise EmbedUnavailable("page parsed but contained no tracks")
 
-    return {"name": str(entity.get("name") or ""), "tracks": tracks}
+    return {
+        "name": str(entity.get("name") or ""),
+        "tracks": tracks,
+        "digest": tracks_digest(tracks),
+    }
+
+
+def _artist_ids_of(track: dict[str, Any]) -> list[str]:
+    return [a["id"] for a in (track.get("artists") or []) if a and a.get("id")]
 
 
 class Discovery:
@@ -147,6 +248,8 @@ class Discovery:
         self.db = db
         self.cache = cache
         self.blocklist = blocklist
+        # Cleared the first time Spotify refuses the several-tracks endpoint.
+        self.batch_lookup = True
 
     # ------------------------------------------------------------- playlists
 
@@ -168,23 +271,70 @@ class Discovery:
 
     # -------------------------------------------------------------- blocking
 
-    def _artist_ids(self, client: spotipy.Spotify, track_id: str) -> list[str]:
-        """Artist ids for a track. The embed only gives names, and names aren't unique."""
-        try:
-            track = client.track(track_id)
-        except Exception as exc:
-            log.debug("Could not resolve artists for %s: %s", track_id, exc)
-            return []
-        return [a["id"] for a in (track.get("artists") or []) if a and a.get("id")]
+    def resolve_artist_ids(
+        self, client: spotipy.Spotify, track_ids: list[str]
+    ) -> dict[str, list[str]]:
+        """Artist ids for each track. The embed only gives names, and names aren't unique.
+
+        Looked up in the shared `track_artists` table first; only what nobody has seen
+        before goes to Spotify, fifty to a request. Tracks that couldn't be resolved are
+        left out, for the name check to cover.
+        """
+        known = self.db.track_artists(track_ids)
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in known]
+        resolved: dict[str, list[str]] = {}
+        for start in range(0, len(missing), TRACKS_PER_REQUEST):
+            batch = missing[start : start + TRACKS_PER_REQUEST]
+            resolved.update(self._fetch_artist_ids(client, batch))
+        if resolved:
+            self.db.save_track_artists(resolved)
+        return {**known, **resolved}
+
+    def _fetch_artist_ids(
+        self, client: spotipy.Spotify, track_ids: list[str]
+    ) -> dict[str, list[str]]:
+        if self.batch_lookup:
+            try:
+                found = client.tracks(track_ids).get("tracks") or []
+            except spotipy.SpotifyException as exc:
+                if exc.http_status not in (403, 404):
+                    log.debug("Could not resolve artists for %s track(s): %s", len(track_ids), exc)
+                    return {}
+                # Development Mode has closed batch endpoints before. One call per track
+                # still works, so fall back to it rather than lose the id check.
+                log.warning(
+                    "GET /tracks?ids= unavailable (%s); resolving one at a time",
+                    exc.http_status,
+                )
+                self.batch_lookup = False
+            except Exception as exc:
+                log.debug("Could not resolve artists for %s track(s): %s", len(track_ids), exc)
+                return {}
+            else:
+                return {
+                    track["id"]: ids
+                    for track in found
+                    if track and track.get("id") and (ids := _artist_ids_of(track))
+                }
+
+        resolved: dict[str, list[str]] = {}
+        for track_id in track_ids:
+            try:
+                ids = _artist_ids_of(client.track(track_id))
+            except Exception as exc:
+                log.debug("Could not resolve artists for %s: %s", track_id, exc)
+                continue
+            if ids:
+                resolved[track_id] = ids
+        return resolved
 
     def _blocked_reason(
-        self, client: spotipy.Spotify, track: dict[str, str]
+        self, track: dict[str, str], artist_ids: Optional[list[str]]
     ) -> Optional[str]:
         """Why this track is blocked, or None. Fails open when the list isn't loaded."""
         if not self.blocklist.loaded:
             return None
 
-        artist_ids = self._artist_ids(client, track["track_id"])
         if artist_ids:
             hit = self.blocklist.blocks_artist_ids(artist_ids)
             return f"AI artist {hit}" if hit else None
@@ -211,10 +361,18 @@ class Discovery:
             s for s in self.db.discovery_sources(user_id)
             if s["label"].casefold() in AUTO_SOURCE_TITLES
         ]
+        # Every call the sweep makes from here on counts against the shared budget.
+        client = sweeps.budget.client(client)
+        pages = sweeps.fetch_all(
+            lambda playlist_id: read_playlist_embed(playlist_id),
+            [source["playlist_id"] for source in sources],
+        )
         for source in sources:
             playlist_id = source["playlist_id"]
             try:
-                data = read_playlist_embed(playlist_id)
+                data = pages[playlist_id]
+                if isinstance(data, Exception):
+                    raise data
             except EmbedUnavailable as exc:
                 # Not fatal: play-based capture still runs on every poll.
                 log.warning("Embed read failed for %s: %s", playlist_id, exc)
@@ -223,48 +381,63 @@ class Discovery:
                 continue
 
             self.db.set_source_degraded(user_id, playlist_id, None)
-            fresh: list[dict[str, str]] = []
-
-            for track in data["tracks"]:
-                if self.db.is_seen_this_month(user_id, key, track["track_id"]):
-                    continue
+            # The same list the last complete sweep into this month worked through:
+            # every track on it is already archived or blocked, so nothing to look up.
+            digest = data.get("digest") or tracks_digest(data["tracks"])
+            if self.db.source_digest(user_id, playlist_id, key) == digest:
+                continue
 
-                reason = self._blocked_reason(client, track)
+            unseen_ids = set(
+                self.db.unseen_this_month(user_id, key, [t["track_id"] for t in data["tracks"]])
+            )
+            unseen = [track for track in data["tracks"] if track["track_id"] in unseen_ids]
+            artists = (
+                self.resolve_artist_ids(client, [track["track_id"] for track in unseen])
+                if unseen and self.blocklist.loaded
+                else {}
+            )
+            blocked: list[tuple[str, str, str, str]] = []
+            keep: list[dict[str, str]] = []
+            for track in unseen:
+                reason = self._blocked_reason(track, artists.get(track["track_id"]))
                 if reason:
-                    self.db.record_blocked(
-                        user_id, key, track["track_id"], track["name"], track["artist"], reason
-                    )
-                    summary["blocked"] += 1
+                    blocked.append((track["track_id"], track["name"], track["artist"], reason))
                     log.info("Blocked %s - %s (%s)", track["artist"], track["name"], reason)
-                    continue
-
-                if self.db.archive_discovery(
-                    user_id, key, track["track_id"], track["name"], track["artist"], playlist_id
-                ):
-                    fresh.append(track)
-
-            if not fresh:
-                continue
-
-            try:
-                month_id = self.month_playlist(
-                    user_id, client, key, bool(settings["playlist_public"])
-                )
-                playlists.add_tracks(
-                    client, month_id, [t["track_id"] for t in fresh], self.cache
+                else:
+                    keep.append(track)
+
+            # One transaction for each ledger, however long the list.
+            if blocked:
+                self.db.record_blocked_many(user_id, key, blocked)
+                summary["blocked"] += len(blocked)
+            fresh = self.db.archive_discovery_many(user_id, key, keep, playlist_id) if keep else []
+
+            if fresh:
+                try:
+                    month_id = self.month_playlist(
+                        user_id, client, key, bool(settings["playlist_public"])
+                    )
+                    playlists.add_tracks(
+                        client,
+                        month_id,
+                        [t["track_id"] for t in fresh],
+                        self.cache,
+                        details={t["track_id"]: t for t in fresh},
+                    )
+                except Exception:
+                    # Keep the ledger honest so the next sweep retries these.
+                    self.db.unarchive_discovery_many(
+                        user_id, key, [track["track_id"] for track in fresh]
+                    )
+                    raise
+
+                summary["archived"] += len(fresh)
+                log.info(
+                    "Archived %s track(s) from %r to %s",
+                    len(fresh),
+                    source["label"],
+                    month_playlist_name(key),
                 )
-            except Exception:
-                # Keep the ledger honest so the next sweep retries these.
-                for track in fresh:
-                    self.db.unarchive_discovery(user_id, key, track["track_id"])
-                raise
-
-            summary["archived"] += len(fresh)
-            log.info(
-                "Archived %s track(s) from %r to %s",
-                len(fresh),
-                source["label"],
-                month_playlist_name(key),
-            )
+            self.db.set_source_digest(user_id, playlist_id, key, digest)
 
         return summary
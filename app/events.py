@@ -0,0 +1,179 @@
+"""Pushing changes to the browser as they happen, over Server-Sent Events.
+
+Every open tab used to find out what changed by polling `/api/state` every five seconds.
+Now each tab holds one `/api/stream` connection instead, and the tracker publishes to it
+as it goes: the now-playing panel whenever it changes, each listen as it closes, tracks
+as they're added to the favourites, sweep summaries -- and a bare `state` event whenever
+anything else a user can see moved, which is the tab's cue to refetch (usually a 304).
+
+Publishing happens on the poll workers' threads; subscribers live on the event loop. A
+publish is handed across with `call_soon_threadsafe`, so the tracker never waits on a
+slow tab. Each subscriber has a small bounded queue, and the two events that only
+matter in their latest form -- `now_playing` and `state` -- are coalesced rather than
+queued, so a tab that falls behind catches up with one event, not a backlog. A `state`
+names the sections that moved, so coalescing two merges them rather than keeping the
+newer alone.
+"""
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Optional
+
+# Events where only the newest one matters. A newer one replaces one still queued.
+COALESCED = frozenset({"now_playing", "state"})
+
+# Per-tab backlog. Past it the tab is told to resync instead of being sent the rest.
+QUEUE_SIZE = 64
+
+# A comment line this often keeps proxies from timing the connection out, and lets
+# the server notice a tab that went away without saying so.
+KEEPALIVE_SECONDS = 15
+
+# How long the browser waits before reconnecting a dropped stream.
+RETRY_MS = 3000
+
+
+# Queued in place of a coalesced event's payload, which is read from `latest` instead.
+_LATEST = object()
+
+
+def merged_state(queued: Any, newer: Any) -> Any:
+    """Two `state` touches a tab hasn't read yet, as one: every section either named, at
+    the newer version. A resync wins, and so does a touch that names no sections -- the
+    tab reads that as all of them."""
+    if not isinstance(queued, dict) or not isinstance(newer, dict):
+        return {"resync": True}
+    if queued.get("resync") or newer.get("resync"):
+        return {"resync": True}
+    merged = dict(newer)
+    if "version" in queued and "version" in newer:
+        merged["version"] = max(queued["version"], newer["version"])
+    if queued.get("sections") and newer.get("sections"):
+        merged["sections"] = list(dict.fromkeys([*queued["sections"], *newer["sections"]]))
+    else:
+        merged.pop("sections", None)
+    return merged
+
+
+@dataclass(eq=False)
+class Subscriber:
+    user_id: int
+    queue: "asyncio.Queue[Optional[tuple[str, Any]]]" = field(
+        default_factory=lambda: asyncio.Queue(QUEUE_SIZE)
+    )
+    # The payload of each coalesced event waiting in the queue, by name.
+    latest: dict[str, Any] = field(default_factory=dict)
+
+    def deliver(self, event: str, data: Any) -> None:
+        if event not in COALESCED:
+            self._put((event, data))
+            return
+        queued = event in self.latest
+        if queued and event == "state":
+            data = merged_state(self.latest[event], data)
+        self.latest[event] = data
+        if not queued:
+            self._put((event, _LATEST))
+
+    def _put(self, item: tuple[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Too far behind to be worth catching up event by event: start it over.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.latest = {"state": {"resync": True}}
+            self.queue.put_nowait(("state", _LATEST))
+
+    async def next(self) -> Optional[tuple[str, Any]]:
+        """The next event, or None once the hub has closed."""
+        item = await self.queue.get()
+        if item is None:
+            return None
+        event, data = item
+        if data is _LATEST:
+            data = self.latest.pop(event, None)
+        return event, data
+
+
+class EventHub:
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: dict[int, set[Subscriber]] = {}
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Attach to the loop the subscribers run on. Publishes before this are dropped."""
+        self._loop = loop
+
+    def publish(self, user_id: int, event: str, data: Any = None) -> None:
+        """Send an event to every tab `user_id` has open. Safe from any thread."""
+        if self._loop is None or user_id not in self._subscribers:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, user_id, event, data)
+        except RuntimeError:
+            pass  # the loop has closed: shutting down, nobody left to tell
+
+    def _deliver(self, user_id: int, event: str, data: Any) -> None:
+        for subscriber in self._subscribers.get(user_id, ()):
+            subscriber.deliver(event, data)
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int) -> AsyncIterator[Subscriber]:
+        subscriber = Subscriber(user_id)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def close(self) -> None:
+        """End every open stream."""
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "users": len(self._subscribers),
+            "streams": sum(len(s) for s in self._subscribers.values()),
+        }
+
+
+def format_event(event: str, data: Any) -> str:
+    """One SSE message. `data` is JSON on a single line, so it never needs splitting."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+async def stream(hub: EventHub, user_id: int, first: Optional[tuple[str, Any]] = None):
+    """The body of `/api/stream`: events for one user, with keepalives, until closed."""
+    async with hub.subscribe(user_id) as subscriber:
+        yield f"retry: {RETRY_MS}\n\n"
+        if first:
+            yield format_event(*first)
+        # One wait for the next event, carried across keepalives rather than cancelled by
+        # each: a cancellation landing as an event is taken off the queue would lose it.
+        waiting: Optional[asyncio.Task] = None
+        try:
+            while True:
+                if waiting is None:
+                    waiting = asyncio.ensure_future(subscriber.next())
+                done, _ = await asyncio.wait({waiting}, timeout=KEEPALIVE_SECONDS)
+                if not done:
+                    yield ": keepalive\n\n"
+                    continue
+                message, waiting = waiting.result(), None
+                if message is None:
+                    return
+                yield format_event(*message)
+        finally:
+            if waiting is not None:
+                waiting.cancel()
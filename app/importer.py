@@ -0,0 +1,470 @@
+"""Importing Spotify's extended streaming history: the years before the app was watching.
+
+The live poll only records what it hears, so a history starts the day an account
+connected. Spotify's privacy export (`Streaming_History_Audio_*.json`, one JSON array
+per file, often hundreds of MB each) covers everything before that, and every entry
+carries `ms_played` -- a measurement, not just a mark that something played -- so those
+plays can be judged against the listening threshold like any other.
+
+The files are parsed incrementally (`read_streams`): a buffer of one read's worth of
+text, decoded one entry at a time, so memory grows with the tracks in a file rather than
+its plays. Entries are staged into `import_staging` in batches, each its own short
+transaction, and their tracks into `import_tracks`. Each track's length is then worked
+out (`prepare`), and the plays move into `listens` in set-based batches (`merge_batch`),
+again a short transaction each, that dedupe and fold what went in into `play_counts`
+and the stats rollup. The app's writer waits on a batch at a time, never on the file.
+
+Only plays from before the first live listen are kept: from then on the poll has the
+better measurement. Imported rows are marked with `origin = ORIGIN_EXPORT`, and a
+unique index over them makes importing the same file twice a no-op.
+
+A play's completion needs the track's length, which the export doesn't carry. It is
+taken, in order, from a live listen of the same track, from a play the export says ran
+to the end (`reason_end == "trackdone"`), or from `resolve` -- the Web API, when the
+upload endpoint has a client to ask, called with the lock let go. A play whose length
+stays unknown is recorded with a completion of 0: heard, but never counted.
+
+Deliberately stdlib-only, like app/stats.py: scripts/dbtool.py runs it on the host.
+"""
+
+import codecs
+import json
+import sqlite3
+from contextlib import nullcontext
+from datetime import datetime
+from typing import IO, Any, Callable, ContextManager, Iterable, Iterator, Optional
+
+from . import stats
+
+# `listens.origin`: measured by the live poll, or read from a streaming-history export.
+ORIGIN_LIVE = 0
+ORIGIN_EXPORT = 1
+
+# Characters read from a file at a time.
+READ_CHUNK = 1 << 20
+
+# Plays staged per transaction. The app's writer waits at most one batch for the lock.
+STAGING_BATCH = 10_000
+
+TRACK_URI_PREFIX = "spotify:track:"
+
+# Staged plays move into `listens` this many at a time, each batch its own transaction.
+MERGE_BATCH = 10_000
+
+# Past any real (played_at, rowid): the upper bound of the last batch.
+_END = 1 << 62
+
+# The plays read so far, and the length worked out for each of their tracks. Ordinary
+# tables rather than temporary ones: an import lets go of the lock between steps, and
+# another user's may run on the same connection meanwhile.
+STAGING_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS import_staging (
+        user_id     INTEGER NOT NULL,
+        track_id    TEXT    NOT NULL,
+        name        TEXT    NOT NULL,
+        artist      TEXT    NOT NULL,
+        played_at   INTEGER NOT NULL,
+        ms_played   INTEGER NOT NULL,
+        finished    INTEGER NOT NULL,
+        local_day   TEXT    NOT NULL,
+        local_hour  INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_import_staging_user_time
+        ON import_staging (user_id, played_at)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS import_tracks (
+        user_id     INTEGER NOT NULL,
+        track_id    TEXT    NOT NULL,
+        name        TEXT    NOT NULL,
+        artist      TEXT    NOT NULL,
+        duration_ms INTEGER,
+        PRIMARY KEY (user_id, track_id)
+    )
+    """,
+)
+
+# (track_id, ...) -> {track_id: duration_ms}, for the lengths nothing local knows.
+Resolver = Callable[[list[str]], dict[str, int]]
+
+
+def read_streams(stream: IO[Any], chunk_size: int = READ_CHUNK) -> Iterator[dict[str, Any]]:
+    """The entries of a JSON array, one at a time, read `chunk_size` characters at once.
+
+    Accepts a binary or a text stream. Raises ValueError on anything but an array, and
+    on a file that ends part-way through.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pos, opened = "", 0, False
+    while True:
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        text = utf8.decode(chunk, final=eof) if isinstance(chunk, bytes) else chunk
+        buffer = buffer[pos:] + text
+        pos = 0
+        separators = " \t\r\n," if opened else " \t\r\n"
+        while True:
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not opened:
+                if buffer[pos] != "[":
+                    raise ValueError("not a streaming history file: expected a JSON array")
+                opened, pos = True, pos + 1
+                separators += ","
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                entry, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError("the file ends part-way through an entry") from None
+                break  # the rest of this entry is in the next read
+            if isinstance(entry, dict):
+                yield entry
+        if eof:
+            raise ValueError("the file ends before its array does")
+
+
+def _parse_ts(value: str) -> int:
+    # "2019-06-02T17:35:04Z" -- the moment the play stopped, in UTC.
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def plays(entries: Iterable[dict[str, Any]], user_id: int) -> Iterator[tuple[Any, ...]]:
+    """Staging rows for the music in `entries`. Podcasts, audiobooks and anything without
+    a track URI are skipped -- they never reach `listens` from the live poll either."""
+    for entry in entries:
+        uri = entry.get("spotify_track_uri") or ""
+        if not uri.startswith(TRACK_URI_PREFIX) or not entry.get("ts"):
+            continue
+        ms_played = max(0, int(entry.get("ms_played") or 0))
+        played_at = _parse_ts(entry["ts"]) - ms_played
+        day, _, hour = stats.local_slot(played_at)
+        yield (
+            user_id,
+            uri[len(TRACK_URI_PREFIX):],
+            entry.get("master_metadata_track_name") or "Unknown track",
+            entry.get("master_metadata_album_artist_name") or "Unknown artist",
+            played_at,
+            ms_played,
+            1 if entry.get("reason_end") == "trackdone" else 0,
+            day,
+            hour,
+        )
+
+
+def stage(
+    conn: sqlite3.Connection,
+    rows: Iterable[tuple[Any, ...]],
+    lock: Optional[ContextManager[Any]] = None,
+    batch: int = STAGING_BATCH,
+) -> int:
+    """Write staging rows `batch` at a time, each batch committed. Returns the count."""
+    lock = lock or nullcontext()
+    staged = 0
+    pending: list[tuple[Any, ...]] = []
+
+    def flush() -> None:
+        with lock:
+            conn.executemany(
+                "INSERT INTO import_staging VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", pending
+            )
+            conn.commit()
+
+    for row in rows:
+        pending.append(row)
+        if len(pending) == batch:
+            flush()
+            staged += len(pending)
+            pending = []
+    if pending:
+        flush()
+        staged += len(pending)
+    return staged
+
+
+def note_tracks(
+    conn: sqlite3.Connection,
+    user_id: int,
+    tracks: dict[str, tuple[str, str, Optional[int]]],
+    lock: Optional[ContextManager[Any]] = None,
+    batch: int = STAGING_BATCH,
+) -> None:
+    """Write the (name, artist, length) of each track in the import to `import_tracks`,
+    `batch` at a time, each batch committed."""
+    lock = lock or nullcontext()
+    rows = [(user_id, track_id, *track) for track_id, track in tracks.items()]
+    for start in range(0, len(rows), batch):
+        with lock:
+            conn.executemany(
+                "INSERT INTO import_tracks VALUES (?, ?, ?, ?, ?)", rows[start:start + batch]
+            )
+            conn.commit()
+
+
+def prepare(conn: sqlite3.Connection, user_id: int) -> list[str]:
+    """Give each track in `import_tracks` the best length anything local knows. The
+    caller holds the lock and commits. Returns the tracks whose length is still unknown."""
+    # A track the poll has already named keeps that name.
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO tracks (track_id, name, artist)
+        SELECT track_id, name, artist FROM import_tracks WHERE user_id = ?
+        """,
+        (user_id,),
+    )
+    conn.execute(
+        """
+        UPDATE import_tracks
+           SET duration_ms = COALESCE(
+                   (SELECT MAX(l.duration_ms) FROM tracks t
+                      JOIN listens l ON l.user_id = import_tracks.user_id AND l.track_key = t.key
+                     WHERE t.track_id = import_tracks.track_id AND l.duration_ms > 0),
+                   duration_ms)
+         WHERE user_id = ?
+        """,
+        (user_id,),
+    )
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT track_id FROM import_tracks WHERE user_id = ? AND duration_ms IS NULL",
+            (user_id,),
+        )
+    ]
+
+
+def merge_batch(
+    conn: sqlite3.Connection,
+    user_id: int,
+    batch: int,
+    threshold: float,
+    first_live: Optional[int],
+) -> tuple[int, int, bool]:
+    """Move the first `batch` of a user's staged plays, in the order they were heard,
+    into `listens`, and fold what went in into `play_counts` and the stats rollup. The
+    staged rows go with them. The caller holds the lock and commits.
+
+    Returns the plays imported, how many of those have no length, and whether any staged
+    plays are left.
+    """
+    upto = conn.execute(
+        """
+        SELECT played_at, rowid FROM import_staging WHERE user_id = ?
+         ORDER BY played_at, rowid LIMIT 1 OFFSET ?
+        """,
+        (user_id, batch - 1),
+    ).fetchone()
+    last = (upto[0], upto[1]) if upto else (_END, _END)
+    # What goes in is read back by `id > before`, with `+user_id` so SQLite takes the
+    # rowid range rather than every listen the user has through their index.
+    before = conn.execute("SELECT COALESCE(MAX(id), 0) FROM listens").fetchone()[0]
+
+    imported = conn.execute(
+        """
+        INSERT OR IGNORE INTO listens
+            (user_id, track_key, played_at, duration_ms, listened_ms, completion_ratio,
+             qualified, is_open, local_day, local_hour, origin)
+        SELECT user_id, key, played_at, duration_ms, ms_played, ratio,
+               ratio >= ?, 0, local_day, local_hour, ?
+          FROM (SELECT s.user_id, t.key, s.played_at, COALESCE(i.duration_ms, 0) AS duration_ms,
+                       s.ms_played, s.local_day, s.local_hour,
+                       CASE WHEN i.duration_ms > 0
+                            THEN MIN(1.0, s.ms_played * 1.0 / i.duration_ms)
+                            ELSE 0.0 END AS ratio
+                  FROM import_staging s
+                  JOIN import_tracks i ON i.user_id = s.user_id AND i.track_id = s.track_id
+                  JOIN tracks t ON t.track_id = s.track_id
+                 WHERE s.user_id = ? AND (s.played_at, s.rowid) <= (?, ?)
+                   AND (? IS NULL OR s.played_at < ?)
+                 ORDER BY s.played_at, s.rowid)
+        """,
+        (threshold, ORIGIN_EXPORT, user_id, *last, first_live, first_live),
+    ).rowcount
+    conn.execute(
+        "DELETE FROM import_staging WHERE user_id = ? AND (played_at, rowid) <= (?, ?)",
+        (user_id, *last),
+    )
+    if not imported:
+        return 0, 0, upto is not None
+
+    unmeasured = conn.execute(
+        "SELECT COUNT(*) FROM listens WHERE id > ? AND +user_id = ? AND duration_ms = 0",
+        (before, user_id),
+    ).fetchone()[0]
+    new_tracks = conn.execute(
+        """
+        SELECT COUNT(DISTINCT l.track_key)
+          FROM listens l
+          JOIN tracks t ON t.key = l.track_key
+         WHERE l.id > ? AND +l.user_id = ?
+           AND NOT EXISTS (SELECT 1 FROM play_counts p
+                            WHERE p.user_id = l.user_id AND p.track_id = t.track_id)
+        """,
+        (before, user_id),
+    ).fetchone()[0]
+    # The tally, in one pass over just the rows that went in.
+    conn.execute(
+        """
+        INSERT INTO play_counts
+            (user_id, track_id, name, artist, qualified_plays, total_plays, last_played)
+        SELECT l.user_id, t.track_id, t.name, t.artist,
+               SUM(l.qualified), COUNT(*), MAX(l.played_at)
+          FROM listens l
+          JOIN tracks t ON t.key = l.track_key
+         WHERE l.id > ? AND +l.user_id = ?
+         GROUP BY l.track_key
+        ON CONFLICT(user_id, track_id) DO UPDATE SET
+            qualified_plays = play_counts.qualified_plays + excluded.qualified_plays,
+            total_plays     = play_counts.total_plays + excluded.total_plays,
+            last_played     = MAX(play_counts.last_played, excluded.last_played)
+        """,
+        (before, user_id),
+    )
+    stats.fold_since(conn, user_id, before, new_tracks)
+    return imported, unmeasured, upto is not None
+
+
+def merge(
+    conn: sqlite3.Connection,
+    user_id: int,
+    *,
+    lock: Optional[ContextManager[Any]] = None,
+    resolve: Optional[Resolver] = None,
+    batch: int = MERGE_BATCH,
+) -> dict[str, int]:
+    """Move a user's staged plays into `listens`. Commits as it goes; returns what
+    happened to them.
+
+    The lengths are worked out first, in one short transaction, and whatever they leave
+    unknown goes to `resolve` with no lock held -- it may be minutes of Web API calls.
+    The plays then go in `batch` at a time, each batch its own transaction.
+    """
+    lock = lock or nullcontext()
+    with lock:
+        unknown = prepare(conn, user_id)
+        conn.commit()
+    if resolve is not None and unknown:
+        durations = [(ms, user_id, track_id) for track_id, ms in resolve(unknown).items() if ms]
+        with lock:
+            conn.executemany(
+                "UPDATE import_tracks SET duration_ms = ? WHERE user_id = ? AND track_id = ?",
+                durations,
+            )
+            conn.commit()
+
+    with lock:
+        staged = conn.execute(
+            "SELECT COUNT(*) FROM import_staging WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        first_live = conn.execute(
+            "SELECT MIN(played_at) FROM listens WHERE user_id = ? AND origin = ?",
+            (user_id, ORIGIN_LIVE),
+        ).fetchone()[0]
+        threshold = conn.execute(
+            "SELECT min_completion_ratio FROM settings WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        overlapping = 0
+        if first_live is not None:
+            overlapping = conn.execute(
+                "SELECT COUNT(*) FROM import_staging WHERE user_id = ? AND played_at >= ?",
+                (user_id, first_live),
+            ).fetchone()[0]
+
+    imported = unmeasured = 0
+    more = True
+    while more:
+        with lock:
+            moved, unknown_length, more = merge_batch(conn, user_id, batch, threshold, first_live)
+            conn.commit()
+        imported += moved
+        unmeasured += unknown_length
+
+    with lock:
+        conn.execute("DELETE FROM import_tracks WHERE user_id = ?", (user_id,))
+        conn.commit()
+    return {
+        "plays": staged,
+        "imported": imported,
+        "before_tracking": staged - overlapping,
+        "duplicates": staged - overlapping - imported,
+        "unmeasured": unmeasured,
+    }
+
+
+def import_streams(
+    conn: sqlite3.Connection,
+    user_id: int,
+    files: Iterable[IO[Any]],
+    *,
+    lock: Optional[ContextManager[Any]] = None,
+    resolve: Optional[Resolver] = None,
+) -> dict[str, int]:
+    """Import streaming-history files for one user. Commits as it goes; see the module
+    docstring. Returns counts: entries read, plays among them, and what became of those."""
+    lock = lock or nullcontext()
+    with lock:
+        for statement in STAGING_SCHEMA:
+            conn.execute(statement)
+        # Whatever an interrupted import left behind would be counted twice.
+        conn.execute("DELETE FROM import_staging WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM import_tracks WHERE user_id = ?", (user_id,))
+        conn.commit()
+
+    read = 0
+    # Each track's name and artist, and its length if a play ran to the end: held here
+    # rather than grouped from the staged plays, so nothing holds the lock for that.
+    tracks: dict[str, tuple[str, str, Optional[int]]] = {}
+    # When each track was last played: a track renamed between plays keeps the name its
+    # latest play carried, as the tally does, whatever order the files come in.
+    latest: dict[str, int] = {}
+
+    def counted(entries: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+        nonlocal read
+        for entry in entries:
+            read += 1
+            yield entry
+
+    def noted(rows: Iterable[tuple[Any, ...]]) -> Iterator[tuple[Any, ...]]:
+        for row in rows:
+            track_id, name, artist, played_at = row[1], row[2], row[3], row[4]
+            ms_played, finished = row[5], row[6]
+            seen = tracks.get(track_id)
+            length = ms_played if finished else None
+            if seen is None or played_at >= latest[track_id]:
+                latest[track_id] = played_at
+            else:
+                name, artist = seen[0], seen[1]
+            if seen is not None and seen[2] is not None and (length is None or seen[2] > length):
+                length = seen[2]
+            tracks[track_id] = (name, artist, length)
+            yield row
+
+    for stream in files:
+        stage(conn, noted(plays(counted(read_streams(stream)), user_id)), lock, STAGING_BATCH)
+    note_tracks(conn, user_id, tracks, lock, STAGING_BATCH)
+    summary = merge(conn, user_id, lock=lock, resolve=resolve, batch=MERGE_BATCH)
+    return {"entries": read, **summary}
+
+
+def spotify_durations(client: Any) -> Resolver:
+    """A resolver asking the Web API, fifty tracks a request."""
+
+    def resolve(track_ids: list[str]) -> dict[str, int]:
+        found: dict[str, int] = {}
+        for i in range(0, len(track_ids), 50):
+            response = client.tracks(track_ids[i:i + 50]) or {}
+            for track in response.get("tracks") or []:
+                if track and track.get("id") and track.get("duration_ms"):
+                    found[str(track["id"])] = int(track["duration_ms"])
+        return found
+
+    return resolve
+
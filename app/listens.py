@@ -38,10 +38,24 @@ RESTART_MIN_HEARD_MS = 25_000
 # playback still running; too much happened in between to account for.
 STALE_GAP_MS = 60_000
 
+# The strings observations are built from, so the same track, artist and playlist polled
+# by a hundred users -- or a hundred times -- is one set of strings. Kept here rather
+# than left to `sys.intern`: on 3.12 an interned string is immortal, and every track
+# anyone ever played would stay in memory for the life of the process. Emptied once it
+# holds this many; strings already handed out stay as they are, only later copies of
+# them stop being shared until they are seen again.
+SHARED_STRINGS = 100_000
+_strings: dict[str, str] = {}
 
-@dataclass
+
+@dataclass(slots=True)
 class Observation:
-    """One poll of `GET /me/player`, reduced to what session accounting needs."""
+    """One poll of `GET /me/player`, reduced to what session accounting needs.
+
+    One is built per poll of every user, so it is slotted -- no per-instance dict -- and
+    its strings come from `shared`: the same track, artist and playlist heard by a
+    hundred users, or polled a hundred times, is one set of strings.
+    """
 
     track_id: str
     name: str
@@ -53,9 +67,13 @@ class Observation:
     at: int  # wall clock, epoch ms
 
 
-@dataclass
+@dataclass(slots=True)
 class Session:
-    """One continuous playback of one track, still open."""
+    """One continuous playback of one track, still open.
+
+    Slotted, like `Observation`. The name and artist `observe` copies across from each
+    poll are the shared strings it already holds, so nothing new is kept alive.
+    """
 
     track_id: str
     name: str
@@ -87,28 +105,46 @@ def observation_from_playback(
     """
     if not playback:
         return None
-    item = playback.get("item") or {}
+    item = playback.get("item")
+    if not item:
+        return None
     track_id = item.get("id")
     if not track_id:
         return None
-    if item.get("type") and item.get("type") != "track":
+    kind = item.get("type")
+    if kind and kind != "track":
         return None
 
-    artists = item.get("artists") or []
+    # Read straight out of the payload, with no defaults built along the way.
+    artist = None
+    artists = item.get("artists")
+    if artists and artists[0]:
+        artist = artists[0].get("name")
+    context = playback.get("context")
+    context_uri = context.get("uri") if context else None
     return Observation(
-        track_id=str(track_id),
-        name=str(item.get("name") or "Unknown Track"),
-        artist=str(
-            (artists[0].get("name") if artists and artists[0] else None) or "Unknown Artist"
-        ),
+        track_id=shared(track_id),
+        name=shared(item.get("name") or "Unknown Track"),
+        artist=shared(artist or "Unknown Artist"),
         duration_ms=max(int(item.get("duration_ms") or 0), 0),
         progress_ms=max(int(playback.get("progress_ms") or 0), 0),
         is_playing=bool(playback.get("is_playing")),
-        context_uri=((playback.get("context") or {}).get("uri")),
+        context_uri=shared(context_uri) if context_uri else None,
         at=at,
     )
 
 
+def shared(value: Any) -> str:
+    """`value` as a string, the same object as the last time it was seen if it still is."""
+    text = value if type(value) is str else str(value)
+    found = _strings.get(text)
+    if found is None:
+        if len(_strings) >= SHARED_STRINGS:
+            _strings.clear()
+        found = _strings.setdefault(text, text)
+    return found
+
+
 def start_session(obs: Observation) -> Session:
     """Open a session, crediting the audio that ran before we first saw it.
 
@@ -4,21 +4,34 @@ import asyncio
 import logging
 import os
 import secrets
+import tempfile
 import time
 from contextlib import asynccontextmanager
 from typing import Any, Optional
 
 from fastapi import Cookie, Depends, FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from . import discovery as discovery_mod
 from . import demo as demo_mod
+from . import export as export_mod
+from . import importer as importer_mod
+from . import sweeps as sweeps_mod
 from .aiblocklist import AiBlocklist
 from .config import MAX_USERS, OAUTH_STATE_TTL_SECONDS, SESSION_TTL_SECONDS, AppConfig
 from .db import Database, now_millis, now_seconds
+from .events import EventHub
+from .events import stream as event_stream
 from .spotify import SpotifyAuthError, SpotifyService
 from .tracker import TrackerManager
 
@@ -39,17 +52,57 @@ spotify_service = SpotifyService(config, database)
 blocklist = AiBlocklist(
     os.path.join(os.path.dirname(config.db_path) or ".", "ai-artists.csv")
 )
-trackers = TrackerManager(database, spotify_service, blocklist)
+events = EventHub()
+database.on_state_change = lambda user_id, version, sections: events.publish(
+    user_id, "state", {"version": version, "sections": list(sections)}
+)
+trackers = TrackerManager(database, spotify_service, blocklist, events)
+
+
+# How often the per-track tally is checked against the history it summarises. A check
+# reads every closed listen once, from reader snapshots, so daily costs little.
+PLAY_COUNTS_CHECK_SECONDS = 24 * 3600
+
+
+def check_play_counts() -> list[int]:
+    """Recount any user whose tally has drifted from their listens, then add whatever
+    the recount lifted over the threshold. Returns the users recounted."""
+    drifted = database.drifted_play_counts()
+    if not drifted:
+        return drifted
+    log.warning("Play counts disagreed with listens for user(s) %s; recounting", drifted)
+    database.repair_play_counts(drifted)
+    for user_id in drifted:
+        if not trackers.is_running(user_id):
+            continue
+        try:
+            trackers.get(user_id).reconcile_favorites()
+        except Exception as exc:
+            log.warning("Reconcile after recounting user %s failed: %s", user_id, exc)
+    return drifted
+
+
+async def maintain_play_counts() -> None:
+    while True:
+        await asyncio.sleep(PLAY_COUNTS_CHECK_SECONDS)
+        try:
+            await asyncio.to_thread(check_play_counts)
+        except Exception:
+            log.exception("Play count check failed")
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    events.bind(asyncio.get_running_loop())
     database.close_orphaned_listens()
     # Don't let a GitHub outage delay startup; the cached copy carries us until the
     # tracker's next sweep refreshes it.
     await asyncio.to_thread(blocklist.refresh)
     await trackers.start_all()
+    maintenance = asyncio.create_task(maintain_play_counts())
     yield
+    maintenance.cancel()
+    events.close()
     await trackers.stop_all()
     database.close()
 
@@ -168,29 +221,75 @@ class TogglePinRequest(BaseModel):
 # -------------------------------------------------------------------- state
 
 
-def build_state(user_id: Optional[int]) -> dict[str, Any]:
-    if user_id is None:
-        return {"connected": False}
-    if user_id == 0:
-        return demo_mod.demo_state()
+# Each section of the state, by the query name that asks for it and the keys it fills.
+# They are built independently, so a poll that only wants `now_playing` never pays for
+# the favourites, and a change to one section leaves the others' cached copies alone.
+STATE_SECTIONS: dict[str, tuple[str, ...]] = {
+    "user": ("user",),
+    "status": ("tracker_running", "last_error"),
+    "now_playing": ("now_playing",),
+    "settings": ("settings",),
+    "stats": ("stats",),
+    "favorites": ("favorites", "favorite_track_ids"),
+    "discovery": ("discovery",),
+}
+
+# Built sections by (user, section), with the key they were built for; see `section_key`.
+_section_cache: dict[tuple[int, str], tuple[tuple[Any, ...], dict[str, Any]]] = {}
+
+
+def parse_sections(value: Optional[str]) -> tuple[str, ...]:
+    if not value:
+        return tuple(STATE_SECTIONS)
+    sections = tuple(dict.fromkeys(part.strip() for part in value.split(",") if part.strip()))
+    unknown = [section for section in sections if section not in STATE_SECTIONS]
+    if unknown or not sections:
+        raise HTTPException(status_code=400, detail=f"Unknown section: {', '.join(unknown)}")
+    return sections
+
+
+def section_key(user_id: int, section: str) -> Optional[tuple[Any, ...]]:
+    """What a section's content depends on; it is rebuilt only when this changes.
+
+    The per-section version covers everything written for that user -- listens,
+    settings, discovery, what the tracker keeps in memory. The rest changes on its own:
+    the 24-hour count drifts as listens age out (hence the minute), the month rolls
+    over, and the blocklist status is shared by everyone. `now_playing` has no key: it
+    changes on every poll, so it is never cached.
+    """
+    if section == "now_playing":
+        return None
+    version = database.state_version(user_id, section)
+    if section == "stats":
+        return (version, now_seconds() // 60)
+    if section == "discovery":
+        status = blocklist.status()
+        return (
+            version,
+            discovery_mod.month_key(),
+            status["fetched_at"],
+            status["stale"],
+            bool(status["error"]),
+        )
+    return (version,)
 
-    user = database.user(user_id)
-    if not user:
-        return {"connected": False}
 
+def favorites_section(user_id: int) -> dict[str, Any]:
     tracker = trackers.get(user_id)
-    settings = database.settings(user_id)
-    threshold = int(settings["favorite_threshold"])
-    counts = database.play_counts(user_id)
+    threshold = int(database.settings(user_id)["favorite_threshold"])
     membership = tracker.favorites_membership
+    # Only what is over the threshold or in the playlist: a cost of the favourites,
+    # not of every track ever heard.
+    counts = database.play_counts_over(user_id, threshold)
+    counts.update(database.play_counts_for(user_id, membership - counts.keys()))
+
+    rows = {
+        track_id: {**row, "in_playlist": track_id in membership}
+        for track_id, row in counts.items()
+    }
 
-    rows: dict[str, dict[str, Any]] = {}
-    for track_id, row in counts.items():
-        if int(row["qualified_plays"]) < threshold and track_id not in membership:
-            continue
-        rows[track_id] = {**row, "in_playlist": track_id in membership}
-
-    # Tracks somebody added to the playlist by hand still belong in the list.
+    # Tracks somebody added to the playlist by hand, and never played here, still
+    # belong in the list.
     for entry in tracker.favorites_snapshot:
         track_id = entry["track_id"]
         if track_id in rows:
@@ -199,9 +298,9 @@ def build_state(user_id: Optional[int]) -> dict[str, Any]:
             "track_id": track_id,
             "name": entry["name"],
             "artist": entry["artist"],
-            "qualified_plays": int(counts.get(track_id, {}).get("qualified_plays", 0)),
-            "total_plays": int(counts.get(track_id, {}).get("total_plays", 0)),
-            "last_played": int(counts.get(track_id, {}).get("last_played", 0)),
+            "qualified_plays": 0,
+            "total_plays": 0,
+            "last_played": 0,
             "in_playlist": True,
         }
 
@@ -214,30 +313,27 @@ def build_state(user_id: Optional[int]) -> dict[str, Any]:
             str(item["artist"]).lower(),
         ),
     )
+    return {"favorites": favorites, "favorite_track_ids": list(membership)}
+
 
+def stats_section(user_id: int) -> dict[str, Any]:
+    threshold = int(database.settings(user_id)["favorite_threshold"])
+    return {
+        "stats": {
+            "last_24h": database.count_listens_since(user_id, now_millis() - 86_400_000),
+            "tracked_tracks": database.tracked_track_count(user_id),
+            "next_favorite": database.next_favorite_candidate(user_id, threshold),
+        }
+    }
+
+
+def discovery_section(user_id: int) -> dict[str, Any]:
     month = discovery_mod.month_key()
     months = [
         {**row, "name": discovery_mod.month_playlist_name(row["month"])}
         for row in database.discovery_months(user_id)
     ]
-
     return {
-        "connected": True,
-        "user": {
-            "display_name": user["display_name"],
-            "spotify_user_id": user["spotify_user_id"],
-        },
-        "tracker_running": trackers.is_running(user_id),
-        "last_error": tracker.last_error,
-        "now_playing": tracker.now_playing,
-        "settings": settings,
-        "stats": {
-            "last_24h": database.count_listens_since(user_id, now_millis() - 86_400_000),
-            "tracked_tracks": len(counts),
-            "next_favorite": database.next_favorite_candidate(user_id, threshold),
-        },
-        "favorites": favorites,
-        "favorite_track_ids": list(tracker.favorites_membership),
         "discovery": {
             "month": month,
             "month_name": discovery_mod.month_playlist_name(month),
@@ -245,12 +341,99 @@ def build_state(user_id: Optional[int]) -> dict[str, Any]:
             "blocked": database.blocked_month(user_id, month),
             "months": months,
             "sources": database.discovery_sources(user_id),
-            "last_sweep": tracker.last_sweep,
+            "last_sweep": trackers.get(user_id).last_sweep,
             "blocklist": blocklist.status(),
-        },
+        }
     }
 
 
+# The sections worth caching. The rest are a dict lookup or two, cheaper than a key.
+SECTION_BUILDERS = {
+    "favorites": favorites_section,
+    "stats": stats_section,
+    "discovery": discovery_section,
+}
+
+
+def build_section(user_id: int, user: dict[str, Any], section: str) -> dict[str, Any]:
+    if section == "user":
+        return {
+            "user": {
+                "display_name": user["display_name"],
+                "spotify_user_id": user["spotify_user_id"],
+            }
+        }
+    if section == "status":
+        return {
+            "tracker_running": trackers.is_running(user_id),
+            "last_error": trackers.get(user_id).last_error,
+        }
+    if section == "now_playing":
+        return {"now_playing": trackers.get(user_id).now_playing}
+    if section == "settings":
+        return {"settings": database.settings(user_id)}
+
+    # Keyed before building, so a change that lands mid-build leaves a copy filed under
+    # the older key -- rebuilt on the next request, never served past the change.
+    key = section_key(user_id, section)
+    cached = _section_cache.get((user_id, section))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    content = SECTION_BUILDERS[section](user_id)
+    _section_cache[(user_id, section)] = (key, content)
+    return content
+
+
+def forget_sections(user_id: int) -> None:
+    for section in SECTION_BUILDERS:
+        _section_cache.pop((user_id, section), None)
+
+
+def build_state(
+    user_id: Optional[int], sections: tuple[str, ...] = tuple(STATE_SECTIONS)
+) -> dict[str, Any]:
+    if user_id is None:
+        return {"connected": False}
+    if user_id == 0:
+        demo = demo_mod.demo_state()
+        keys = [key for section in sections for key in STATE_SECTIONS[section]]
+        return {"connected": True, **{key: demo[key] for key in keys if key in demo}}
+
+    user = database.user(user_id)
+    if not user:
+        return {"connected": False}
+
+    state: dict[str, Any] = {"connected": True}
+    for section in sections:
+        state.update(build_section(user_id, user, section))
+    return state
+
+
+# Part of every state ETag. The versions behind it live in memory and restart from zero,
+# so without this a tag from before a restart could match a different state after it.
+STATE_BOOT = secrets.token_hex(4)
+
+
+def state_etag(user_id: int, sections: tuple[str, ...] = tuple(STATE_SECTIONS)) -> str:
+    """A tag that changes whenever `build_state` would return something different for
+    these sections -- made of their keys, so it moves only when one of them does.
+
+    `now_playing` is deliberately left out of the full state's tag; it changes on every
+    poll and is served on its own by `/api/now-playing`. Asked for by name, it is
+    answered fresh every time instead -- see `api_state`.
+    """
+    parts: list[Any] = [STATE_BOOT, user_id]
+    for section in sections:
+        key = section_key(user_id, section)
+        parts.append(section + ("" if key is None else ":" + ".".join(map(str, key))))
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(request: Request, tag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    return tag in (candidate.strip() for candidate in header.split(","))
+
+
 # ------------------------------------------------------------------- routes
 
 
@@ -297,11 +480,69 @@ async def healthz() -> PlainTextResponse:
     return PlainTextResponse("ok")
 
 
+@app.get("/api/metrics")
+async def api_metrics(user_id: int = Depends(current_user_id)) -> dict[str, Any]:
+    """Process-wide counters, for seeing what the write path and the poll are doing. The
+    poll's are per user, so only the caller's own are shown."""
+    return {
+        "database": database.metrics(),
+        "polls": trackers.scheduler.stats(user_id),
+        "streams": events.stats(),
+        "sweeps": trackers.sweeps.stats(),
+        "playlist_cache": trackers.cache_stats(),
+    }
+
+
 @app.get("/api/state")
-async def api_state(user_id: Optional[int] = Depends(optional_user_id)) -> dict[str, Any]:
+async def api_state(
+    request: Request,
+    sections: Optional[str] = None,
+    user_id: Optional[int] = Depends(optional_user_id),
+) -> Response:
+    """The whole state, or only `?sections=` (comma-separated names from STATE_SECTIONS)."""
     # Deliberately 200 even when logged out: the front-end polls this from the login
     # page, and a stream of 401s would trip the fail2ban caddy-auth jail.
-    return build_state(user_id)
+    wanted = parse_sections(sections)
+    if not user_id:
+        return JSONResponse(build_state(user_id, wanted))
+    # Asked for by name, the live panel is fresh on every request, so it can't be tagged.
+    if sections and "now_playing" in wanted:
+        return JSONResponse(
+            build_state(user_id, wanted), headers={"Cache-Control": "no-store"}
+        )
+
+    # Taken before the state is built, so a change that lands mid-build can only make
+    # the tag older than the body -- the next poll refetches -- never newer.
+    tag = state_etag(user_id, wanted)
+    # no-cache still lets the browser keep the body; it just has to ask before reusing
+    # it, and that question is what gets answered with an empty 304.
+    headers = {"ETag": tag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+    if etag_matches(request, tag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(build_state(user_id, wanted), headers=headers)
+
+
+@app.get("/api/stream")
+async def api_stream(user_id: int = Depends(current_user_id)) -> StreamingResponse:
+    """Changes pushed as they happen -- see app/events.py. The tab opens it once signed in,
+    so unlike `/api/state` a 401 here is never polled into a stream of them."""
+    tracker = trackers.trackers.get(user_id)
+    # Start with where things stand, so a tab that (re)connects mid-track is current.
+    first = ("now_playing", tracker.now_playing if tracker else None)
+    return StreamingResponse(
+        event_stream(events, user_id, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/now-playing")
+async def api_now_playing(user_id: Optional[int] = Depends(optional_user_id)) -> dict[str, Any]:
+    """The live panel on its own: it changes on every poll, so it can't share an ETag."""
+    if user_id == 0:
+        return {"now_playing": demo_mod.demo_state().get("now_playing")}
+    tracker = trackers.trackers.get(user_id) if user_id else None
+    return {"now_playing": tracker.now_playing if tracker else None}
 
 
 @app.get("/api/history")
@@ -348,6 +589,121 @@ async def api_history(
     )
 
 
+@app.get("/api/history/export")
+async def api_history_export(
+    format: str = "ndjson",
+    q: Optional[str] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    qualified: Optional[bool] = None,
+    favorites_only: Optional[bool] = None,
+    sort: str = "time",
+    user_id: int = Depends(current_user_id),
+) -> StreamingResponse:
+    """The whole history under the same filters as `/api/history`, as one streamed
+    download -- see app/export.py for the formats."""
+    if format not in export_mod.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown format: {format} (one of {', '.join(export_mod.FORMATS)})",
+        )
+    write, media_type, extension = export_mod.FORMATS[format]
+
+    if user_id == 0:
+        rows = iter(
+            demo_mod.demo_history(query=q or "", start=start or 0, end=end or 0,
+                                  qualified=qualified, limit=1000)["items"]
+        )
+    else:
+        favorite_ids = None
+        if favorites_only:
+            favorite_ids = trackers.get(user_id).favorites_membership
+        rows = database.export_history(
+            user_id,
+            query=q,
+            start=start,
+            end=end,
+            qualified=qualified,
+            favorites_only=favorites_only,
+            favorite_track_ids=favorite_ids,
+            sort=sort,
+        )
+    # A plain iterator: Starlette pulls each piece on a worker thread, so the chunked
+    # reads behind it never run on the event loop.
+    return StreamingResponse(
+        write(rows),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="listening-history.{extension}"',
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+# Bytes of an uploaded history file held in memory before it spills to a temporary file.
+IMPORT_SPOOL_BYTES = 8 * 1024 * 1024
+# The most an uploaded history file may be. Spotify splits an export into files of a
+# dozen MB or so; this leaves plenty of room and still keeps the disk from filling up.
+IMPORT_MAX_BYTES = 256 * 1024 * 1024
+
+# Users with an import under way. An import starts by clearing whatever the user's last
+# one left staged, so a second one running alongside would wipe the first one's plays.
+# Only touched on the event loop, so it needs no lock.
+_importing: set[int] = set()
+
+
+def import_upload(user_id: int, upload: Any) -> dict[str, Any]:
+    # Track lengths nothing local knows come from the Web API, under a budget of the
+    # import's own: a first import can ask about thousands of tracks, and the sweeps'
+    # bucket is every other user's.
+    budget = sweeps_mod.budget
+    client = budget.client(spotify_service.client(user_id), budget.imports)
+    return database.import_history(user_id, [upload], importer_mod.spotify_durations(client))
+
+
+@app.post("/api/history/import")
+async def api_history_import(
+    request: Request, user_id: int = Depends(current_user_id)
+) -> dict[str, Any]:
+    """One `Streaming_History_Audio_*.json` from Spotify's privacy export, as the raw
+    request body. Importing the same file again adds nothing; see app/importer.py."""
+    if user_id == 0:
+        raise HTTPException(status_code=403, detail="The demo can't import a history")
+    too_large = HTTPException(status_code=413, detail="That file is too large to import")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > IMPORT_MAX_BYTES:
+        raise too_large
+    if user_id in _importing:
+        raise HTTPException(status_code=409, detail="An import is already running")
+
+    _importing.add(user_id)
+    # Spooled: a few hundred MB shouldn't sit in memory while the import reads it.
+    upload = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+    try:
+        received = 0
+        # The header can be absent or wrong, so the body is counted as it arrives too.
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > IMPORT_MAX_BYTES:
+                raise too_large
+            await asyncio.to_thread(upload.write, chunk)
+        upload.seek(0)
+        try:
+            summary = await asyncio.to_thread(import_upload, user_id, upload)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+    finally:
+        upload.close()
+        _importing.discard(user_id)
+
+    if summary["imported"]:
+        try:
+            await asyncio.to_thread(trackers.get(user_id).reconcile_favorites)
+        except Exception as exc:
+            log.warning("Reconcile after history import failed: %s", exc)
+    return summary
+
+
 @app.get("/api/history/summary")
 async def api_history_summary(user_id: int = Depends(current_user_id)) -> dict[str, Any]:
     if user_id == 0:
@@ -414,6 +770,7 @@ async def auth_callback(
     database.save_tokens(
         user_id, result["access_token"], result["refresh_token"], result["expires_at"]
     )
+    spotify_service.forget(user_id)  # a re-authorisation replaces any cached grant
 
     # Nothing is replayed on sign-in: tracking starts from the first thing measured, so
     # logging in can never trigger a surprise batch of playlist additions.
@@ -443,7 +800,9 @@ async def auth_disconnect(
     """Forget this account entirely -- tokens, counts, archive."""
     await trackers.stop(user_id)
     trackers.trackers.pop(user_id, None)
+    spotify_service.forget(user_id)
     database.delete_user(user_id)
+    forget_sections(user_id)
     if favsongs_session:
         database.delete_session(favsongs_session)
     response = JSONResponse({"connected": False})
@@ -551,12 +910,9 @@ async def sweep_now(user_id: int = Depends(current_user_id)) -> dict[str, Any]:
         # In dev mode, return a mock result to keep the demo flow working.
         return {"archived": 0, "blocked": 0, "errors": []}
     tracker = trackers.get(user_id)
-
-    def work() -> dict[str, Any]:
-        return tracker.sweep_sources(spotify_service.client(user_id))
-
     try:
-        return await asyncio.to_thread(work)
+        # Joins a scheduled sweep already under way rather than starting a second one.
+        return await asyncio.wrap_future(tracker.request_sweep())
     except Exception as exc:
         log.error("Sweep failed for user %s: %s", user_id, exc)
         raise HTTPException(status_code=502, detail="Sweep failed; check the logs.") from exc
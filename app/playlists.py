@@ -5,43 +5,291 @@ All calls use the post-February-2026 spotipy methods:
   current_user_playlist_create()  -> POST /me/playlists
   playlist_items()                -> GET  /playlists/{id}/items
 The `user_*` equivalents hit `/users/{id}/...`, which Spotify removed.
+
+Membership is cached with the playlist's `snapshot_id`, which changes on every edit.
+Once the cached copy is `MEMBERSHIP_TTL_SECONDS` old it is checked with a single
+`GET /playlists/{id}?fields=snapshot_id` rather than re-paged: a 2,000-track playlist is
+forty pages, and it almost never changed. Edits made here are applied to the cached copy
+along with the snapshot they produced, so adding a track doesn't cost a re-read either.
+
+Given a database, the cache is mirrored into it (`playlist_mirror`, `playlist_tracks`)
+and a playlist not in memory is loaded back from there, so a restart -- or an eviction
+-- costs a playlist a snapshot check rather than a full read. A copy loaded from the
+mirror is treated as past its TTL: it is trusted once its snapshot has been checked.
+Which playlists the mirror holds is read once per cache and kept in step from then on,
+so a miss for one it doesn't hold never reaches the database.
 """
 
 import logging
+import sys
 import time
-from typing import Any, Optional
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Iterable, Optional
 
 import spotipy
 
+from .db import Database
+from .listens import shared
+
 log = logging.getLogger(__name__)
 
 MEMBERSHIP_TTL_SECONDS = 30
 PAGE_LIMIT = 50
 ADD_BATCH = 100
 
+# What one user's cache may hold before the least recently used playlist is dropped
+# from memory. A 2,000-track playlist is around half a megabyte; the favourites and the
+# current month's archive are what's read, and last year's archives fall out. An
+# evicted playlist is still in the SQLite mirror, so it comes back for a snapshot check.
+MEMBERSHIP_CACHE_BYTES = 4 * 1024 * 1024
+
+
+@dataclass(frozen=True, eq=False)
+class PlaylistTracks(Sequence):
+    """One playlist's tracks in order, as the cache holds them.
+
+    Read-only, so the cache hands out the same object to every caller instead of a copy
+    each. Membership is the `members` frozenset; names and artists are kept apart, in
+    tuples parallel to `ids`, and every string comes from `listens.shared` -- the same
+    track in a hundred users' playlists, or playing right now, is one set of strings.
+    Indexing builds the entry dict the rest of the app reads.
+    """
+
+    ids: tuple[str, ...]
+    names: tuple[str, ...]
+    artists: tuple[str, ...]
+    members: frozenset[str]
+
+    @classmethod
+    def of(cls, entries: Iterable[dict[str, str]]) -> "PlaylistTracks":
+        rows = [
+            (shared(e["track_id"]), shared(e["name"]), shared(e["artist"]))
+            for e in entries
+        ]
+        ids = tuple(row[0] for row in rows)
+        return cls(
+            ids, tuple(row[1] for row in rows), tuple(row[2] for row in rows), frozenset(ids)
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):  # type: ignore[override]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.ids)))]
+        return {
+            "track_id": self.ids[index], "name": self.names[index], "artist": self.artists[index]
+        }
+
+    def __eq__(self, other: object) -> bool:
+        if other is self:
+            return True
+        if not isinstance(other, PlaylistTracks):
+            return NotImplemented
+        return (self.ids, self.names, self.artists) == (other.ids, other.names, other.artists)
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def inserted(self, at: int, added: "PlaylistTracks") -> "PlaylistTracks":
+        return PlaylistTracks(
+            self.ids[:at] + added.ids + self.ids[at:],
+            self.names[:at] + added.names + self.names[at:],
+            self.artists[:at] + added.artists + self.artists[at:],
+            self.members | added.members,
+        )
+
+    def without(self, ids: set[str]) -> "PlaylistTracks":
+        return PlaylistTracks.of(entry for entry in self if entry["track_id"] not in ids)
+
+    def footprint(self) -> int:
+        """Roughly the bytes held: the containers, and every string counted once per use."""
+        strings = sum(
+            sys.getsizeof(value) for column in (self.ids, self.names, self.artists)
+            for value in column
+        )
+        containers = sum(
+            sys.getsizeof(c) for c in (self.ids, self.names, self.artists, self.members)
+        )
+        return strings + containers
+
+
+NO_TRACKS = PlaylistTracks((), (), (), frozenset())
+
+
+@dataclass
+class _Membership:
+    tracks: PlaylistTracks
+    snapshot_id: Optional[str]
+    checked_at: float
+    size: int = 0
+
 
 class PlaylistCache:
-    """Track ids per playlist, so repeated auto-adds don't re-read the whole playlist."""
+    """Track ids per playlist, so repeated auto-adds don't re-read the whole playlist.
 
-    def __init__(self) -> None:
-        self._entries: dict[str, dict[str, Any]] = {}
+    Least recently used first out once the entries' footprint passes `max_bytes`.
+    Shared by a user's poll and their sweep, which run on different threads.
+    """
+
+    def __init__(
+        self,
+        db: Optional[Database] = None,
+        user_id: Optional[int] = None,
+        max_bytes: int = MEMBERSHIP_CACHE_BYTES,
+    ) -> None:
+        self._entries: "OrderedDict[str, _Membership]" = OrderedDict()
+        self._db = db if user_id is not None else None
+        self._user_id = user_id
+        self._lock = Lock()
+        # The playlists the mirror holds, read on the first miss. This cache is the only
+        # writer of the user's mirror, so from then on it keeps the set in step.
+        self._mirrored: Optional[set[str]] = None
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
 
-    def get(self, playlist_id: str) -> Optional[list[dict[str, str]]]:
-        entry = self._entries.get(playlist_id)
-        if not entry:
+    def get(self, playlist_id: str) -> Optional[PlaylistTracks]:
+        """The cached tracks, if checked within the TTL."""
+        entry = self._entry(playlist_id)
+        if entry is None or time.time() - entry.checked_at > MEMBERSHIP_TTL_SECONDS:
             return None
-        if time.time() - entry["cached_at"] > MEMBERSHIP_TTL_SECONDS:
+        self.hits += 1
+        return entry.tracks
+
+    def snapshot(self, playlist_id: str) -> Optional[str]:
+        """The snapshot the cached tracks were read at, however long ago."""
+        entry = self._entry(playlist_id)
+        return entry.snapshot_id if entry else None
+
+    def put(
+        self, playlist_id: str, tracks: PlaylistTracks, snapshot_id: Optional[str] = None
+    ) -> None:
+        """A full read of the playlist, replacing whatever was cached."""
+        self.misses += 1
+        self._store(playlist_id, _Membership(tracks, snapshot_id, time.time()))
+        if self._db is not None:
+            self._db.save_playlist_mirror(self._user_id, playlist_id, snapshot_id, list(tracks))
+            with self._lock:
+                if self._mirrored is not None:
+                    self._mirrored.add(playlist_id)
+
+    def revalidated(self, playlist_id: str) -> Optional[PlaylistTracks]:
+        """The snapshot hasn't moved: trust the cached tracks for another TTL."""
+        entry = self._entry(playlist_id)
+        if entry is None:
             return None
-        return list(entry["tracks"])
+        entry.checked_at = time.time()
+        self.revalidations += 1
+        return entry.tracks
 
-    def put(self, playlist_id: str, tracks: list[dict[str, str]]) -> None:
-        self._entries[playlist_id] = {"tracks": tracks, "cached_at": time.time()}
+    def added(
+        self,
+        playlist_id: str,
+        tracks: PlaylistTracks,
+        snapshot_id: Optional[str],
+        position: Optional[int] = None,
+    ) -> None:
+        """Apply an add made here, as Spotify did: at `position`, or at the end."""
+        entry = self._entry(playlist_id)
+        if entry is None:
+            return
+        at = len(entry.tracks) if position is None else position
+        if self._edited(playlist_id, entry, entry.tracks.inserted(at, tracks), snapshot_id):
+            if self._db is not None:
+                self._db.mirror_added(
+                    self._user_id, playlist_id, snapshot_id, list(tracks), position
+                )
+
+    def removed(self, playlist_id: str, ids: set[str], snapshot_id: Optional[str]) -> None:
+        entry = self._entry(playlist_id)
+        if entry is None:
+            return
+        if self._edited(playlist_id, entry, entry.tracks.without(ids), snapshot_id):
+            if self._db is not None:
+                self._db.mirror_removed(self._user_id, playlist_id, snapshot_id, ids)
 
     def invalidate(self, playlist_id: Optional[str] = None) -> None:
-        if playlist_id is None:
-            self._entries.clear()
-        else:
-            self._entries.pop(playlist_id, None)
+        with self._lock:
+            if playlist_id is None:
+                self._entries.clear()
+                self.bytes = 0
+            else:
+                dropped = self._entries.pop(playlist_id, None)
+                if dropped:
+                    self.bytes -= dropped.size
+        if self._db is not None:
+            self._db.forget_playlist_mirror(self._user_id, playlist_id)
+            with self._lock:
+                if playlist_id is None:
+                    self._mirrored = set()
+                elif self._mirrored is not None:
+                    self._mirrored.discard(playlist_id)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "playlists": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+        }
+
+    def _edited(
+        self,
+        playlist_id: str,
+        entry: _Membership,
+        tracks: PlaylistTracks,
+        snapshot_id: Optional[str],
+    ) -> bool:
+        if not snapshot_id:
+            # No snapshot to vouch for the edited copy: read it again next time.
+            self.invalidate(playlist_id)
+            return False
+        self._store(playlist_id, _Membership(tracks, snapshot_id, entry.checked_at))
+        return True
+
+    def _entry(self, playlist_id: str) -> Optional[_Membership]:
+        with self._lock:
+            entry = self._entries.get(playlist_id)
+            if entry is not None:
+                self._entries.move_to_end(playlist_id)
+                return entry
+            if self._db is None:
+                return None
+            if self._mirrored is None:
+                self._mirrored = self._db.mirrored_playlist_ids(self._user_id)
+            if playlist_id not in self._mirrored:
+                return None
+        # Not in memory: a restart, or evicted. The mirror has it as last seen, to be
+        # trusted once its snapshot has been checked -- so it starts out past its TTL.
+        mirrored = self._db.playlist_mirror(self._user_id, playlist_id).get(playlist_id)
+        if mirrored is None:
+            return None
+        snapshot_id, tracks = mirrored
+        entry = _Membership(PlaylistTracks.of(tracks), snapshot_id, checked_at=0.0)
+        self._store(playlist_id, entry)
+        return entry
+
+    def _store(self, playlist_id: str, entry: _Membership) -> None:
+        entry.size = entry.tracks.footprint()
+        with self._lock:
+            previous = self._entries.pop(playlist_id, None)
+            if previous:
+                self.bytes -= previous.size
+            self._entries[playlist_id] = entry
+            self.bytes += entry.size
+            # The newest entry stays even on its own over the bound: it's in use.
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
 
 
 def find_playlist_by_name(client: spotipy.Spotify, name: str) -> Optional[str]:
@@ -76,15 +324,41 @@ def find_or_create(
     return str(playlist_id)
 
 
+def snapshot_id(client: spotipy.Spotify, playlist_id: str) -> Optional[str]:
+    """The playlist's current snapshot, from its metadata alone."""
+    result = client.playlist(playlist_id, fields="snapshot_id")
+    return str((result or {}).get("snapshot_id") or "") or None
+
+
 def items(
     client: spotipy.Spotify, playlist_id: str, cache: Optional[PlaylistCache] = None
-) -> list[dict[str, str]]:
+) -> PlaylistTracks:
+    """Every track on the playlist, in order.
+
+    With a cache, a copy checked within the TTL is returned as it is; an older one is
+    checked against the snapshot, and only a changed snapshot re-reads the tracks.
+    """
+    snapshot: Optional[str] = None
     if cache:
         cached = cache.get(playlist_id)
         if cached is not None:
             return cached
+        snapshot = snapshot_id(client, playlist_id)
+        if snapshot is not None and snapshot == cache.snapshot(playlist_id):
+            cached = cache.revalidated(playlist_id)
+            if cached is not None:
+                return cached
+
+    tracks = PlaylistTracks.of(_entry(track) for track in _read_tracks(client, playlist_id))
+    if cache:
+        # The snapshot was read first, so a change made while paging shows up as a
+        # mismatch on the next check instead of being missed.
+        cache.put(playlist_id, tracks, snapshot)
+    return tracks
+
 
-    tracks: list[dict[str, str]] = []
+def _read_tracks(client: spotipy.Spotify, playlist_id: str) -> list[dict[str, Any]]:
+    found: list[dict[str, Any]] = []
     seen: set[str] = set()
     results = client.playlist_items(
         playlist_id,
@@ -99,28 +373,29 @@ def items(
             if not track_id or track_id in seen:
                 continue
             seen.add(str(track_id))
-            artists = track.get("artists") or []
-            tracks.append(
-                {
-                    "track_id": str(track_id),
-                    "name": str(track.get("name") or "Unknown Track"),
-                    "artist": str(
-                        (artists[0].get("name") if artists and artists[0] else None)
-                        or "Unknown Artist"
-                    ),
-                }
-            )
+            found.append(track)
         results = client.next(results) if results.get("next") else None
+    return found
+
+
+def _entry(track: dict[str, Any]) -> dict[str, str]:
+    artists = track.get("artists") or []
+    artist = artists[0].get("name") if artists and artists[0] else None
+    return _described(str(track["id"]), {"name": track.get("name"), "artist": artist})
 
-    if cache:
-        cache.put(playlist_id, tracks)
-    return tracks
+
+def _described(track_id: str, detail: dict[str, Any]) -> dict[str, str]:
+    return {
+        "track_id": track_id,
+        "name": str(detail.get("name") or "Unknown Track"),
+        "artist": str(detail.get("artist") or "Unknown Artist"),
+    }
 
 
 def track_ids(
     client: spotipy.Spotify, playlist_id: str, cache: Optional[PlaylistCache] = None
-) -> set[str]:
-    return {entry["track_id"] for entry in items(client, playlist_id, cache)}
+) -> frozenset[str]:
+    return items(client, playlist_id, cache).members
 
 
 def add_tracks(
@@ -129,20 +404,34 @@ def add_tracks(
     ids: list[str],
     cache: Optional[PlaylistCache] = None,
     position: Optional[int] = None,
+    details: Optional[dict[str, dict[str, str]]] = None,
 ) -> int:
-    """Add tracks that aren't already present. Returns how many were actually added."""
+    """Add tracks that aren't already present. Returns how many were actually added.
+
+    `details` gives the name and artist the cached copy records for an added track;
+    one it doesn't cover is recorded the way the playlist read records a track without.
+    """
     if not ids:
         return 0
 
+    # The diff is worked out against the cached copy, with no request at all while it
+    # is within the TTL.
     existing = track_ids(client, playlist_id, cache)
     fresh = [tid for tid in dict.fromkeys(ids) if tid not in existing]
     if not fresh:
         return 0
 
+    details = details or {}
     for start in range(0, len(fresh), ADD_BATCH):
-        client.playlist_add_items(playlist_id, fresh[start : start + ADD_BATCH], position=position)
-    if cache:
-        cache.invalidate(playlist_id)
+        batch = fresh[start : start + ADD_BATCH]
+        result = client.playlist_add_items(playlist_id, batch, position=position)
+        if cache:
+            cache.added(
+                playlist_id,
+                PlaylistTracks.of(_described(tid, details.get(tid, {})) for tid in batch),
+                (result or {}).get("snapshot_id"),
+                position,
+            )
     return len(fresh)
 
 
@@ -158,9 +447,8 @@ def remove_tracks(
         return 0
 
     for start in range(0, len(removable), ADD_BATCH):
-        client.playlist_remove_all_occurrences_of_items(
-            playlist_id, removable[start : start + ADD_BATCH]
-        )
-    if cache:
-        cache.invalidate(playlist_id)
+        batch = removable[start : start + ADD_BATCH]
+        result = client.playlist_remove_all_occurrences_of_items(playlist_id, batch)
+        if cache:
+            cache.removed(playlist_id, set(batch), (result or {}).get("snapshot_id"))
     return len(removable)
@@ -0,0 +1,218 @@
+"""One scheduler for every user's playback poll.
+
+Each user used to get an asyncio task of their own, and each of its cycles hopped onto
+the default thread pool four or five times. With a few hundred users that pool was the
+bottleneck: polls queued behind each other and drifted off the five-second grid, which
+quietly widens the unobserved tail a completion figure is allowed to have.
+
+Here every user is a job on one heap keyed by when its next poll is due. Jobs are laid
+out across the interval rather than all firing on the same tick, each poll runs as a
+single call on a bounded pool of its own, and the scheduler keeps each job on a fixed
+grid -- `due + interval`, never `finished + interval` -- so a slow poll doesn't push
+every later one back. How late each poll started is recorded per user.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+# Threads running polls. A poll spends nearly all of its time waiting on Spotify, so
+# this bounds how many are in flight at once rather than how much CPU they take. It is
+# deliberately separate from the default pool the HTTP routes use.
+POLL_WORKERS = 8
+
+# 1/phi. Giving the nth job an offset of n/phi (mod 1) keeps any number of jobs close to
+# evenly spaced, without re-spacing the ones already running when another joins.
+_GOLDEN = 0.6180339887498949
+
+# A poll returns how long to wait before the next one, or None to stop polling.
+Poll = Callable[[], Optional[float]]
+
+
+def phase_for(slot: int, interval: float) -> float:
+    """Offset into the interval for the nth job to join."""
+    return (slot * _GOLDEN) % 1.0 * interval
+
+
+def next_due(due: float, now: float, interval: float) -> tuple[float, int]:
+    """The next slot on a job's grid after `due`, and how many slots were skipped.
+
+    A poll that overran is followed immediately by the next one, still on the grid. One
+    that overran by more than a whole interval doesn't try to make up the difference in
+    a burst: the slots it missed are skipped, and counted.
+    """
+    following = due + interval
+    if now - following < interval:
+        return following, 0
+    missed = int((now - following) // interval)
+    return following + missed * interval, missed
+
+
+@dataclass
+class _Job:
+    key: int
+    poll: Poll
+    due: float
+    seq: int = 0
+    running: Optional["asyncio.Future[Any]"] = None
+    polls: int = 0
+    missed: int = 0
+    lag: float = 0.0
+    max_lag: float = 0.0
+
+
+class PollScheduler:
+    def __init__(
+        self,
+        interval: float,
+        workers: int = POLL_WORKERS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.interval = interval
+        self.workers = workers
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poll")
+        self._jobs: dict[int, _Job] = {}
+        self._heap: list[tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._slots = itertools.count()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._jobs
+
+    # ------------------------------------------------------------------ jobs
+
+    def add(self, key: int, poll: Poll) -> None:
+        """Start polling `key` on its own slot of the grid. A no-op if it already is."""
+        if key in self._jobs:
+            return
+        now = self._clock()
+        due = now - (now % self.interval) + phase_for(next(self._slots), self.interval)
+        if due < now:
+            due += self.interval
+        job = _Job(key=key, poll=poll, due=due)
+        self._jobs[key] = job
+        self._push(job)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(
+                self._run(), name="poll-scheduler"
+            )
+
+    async def remove(self, key: int) -> None:
+        """Stop polling `key`, waiting for a poll already in flight to finish.
+
+        A thread can't be interrupted, so returning before it finished would let whatever
+        runs next -- closing the open listen, say -- race the poll that is still writing.
+        """
+        job = self._jobs.pop(key, None)
+        if job and job.running:
+            try:
+                await asyncio.shield(job.running)
+            except Exception:
+                pass
+
+    async def close(self) -> None:
+        for key in list(self._jobs):
+            await self.remove(key)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    def stats(self, key: Optional[int] = None) -> dict[str, Any]:
+        """The scheduler's counters, with every job's -- or only `key`'s, if it's given."""
+        if key is None:
+            jobs = list(self._jobs.values())
+        else:
+            jobs = [self._jobs[key]] if key in self._jobs else []
+        return {
+            "interval_seconds": self.interval,
+            "workers": self.workers,
+            "users": {
+                str(job.key): {
+                    "polls": job.polls,
+                    "missed": job.missed,
+                    "lag_ms": round(job.lag * 1000),
+                    "max_lag_ms": round(job.max_lag * 1000),
+                }
+                for job in jobs
+            },
+        }
+
+    # ------------------------------------------------------------------ loop
+
+    def _push(self, job: _Job) -> None:
+        # Superseded heap entries are left where they are and skipped when popped.
+        job.seq = next(self._seq)
+        heapq.heappush(self._heap, (job.due, job.seq, job.key))
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            due, seq, key = self._heap[0]
+            delay = due - self._clock()
+            if delay > 0:
+                self._wake.clear()
+                # Not `wait_for`: on 3.11 it returns normally if the wake lands in the
+                # same tick as `close()` cancels this task, and the loop never ends.
+                try:
+                    async with asyncio.timeout(delay):
+                        await self._wake.wait()
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            job = self._jobs.get(key)
+            if job is None or job.seq != seq:
+                continue
+            job.running = asyncio.ensure_future(self._dispatch(job))
+
+    async def _dispatch(self, job: _Job) -> None:
+        started = self._clock()
+        job.lag = max(0.0, started - job.due)
+        job.max_lag = max(job.max_lag, job.lag)
+        try:
+            delay = await asyncio.get_running_loop().run_in_executor(self._executor, job.poll)
+        except Exception as exc:
+            # The poll is meant to catch its own errors; this is the backstop that keeps
+            # one bad user from falling off the schedule for good.
+            log.warning("Poll for %s raised: %s", job.key, exc)
+            delay = self.interval
+        finally:
+            job.running = None
+        job.polls += 1
+
+        if self._jobs.get(job.key) is not job:
+            return  # removed while it ran
+        if delay is None:
+            self._jobs.pop(job.key, None)
+            return
+
+        now = self._clock()
+        if delay > self.interval:
+            # Spotify asked for a pause. Honour it, then carry on from there.
+            job.due = now + delay
+        else:
+            job.due, missed = next_due(job.due, now, self.interval)
+            job.missed += missed
+        self._push(job)
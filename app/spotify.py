@@ -3,14 +3,26 @@
 Everything goes through spotipy 2.26.0, which is the first release that targets the
 February 2026 endpoint layout (`/playlists/{id}/items`, `POST /me/playlists`). Do not
 downgrade -- 2.25.x calls paths that no longer exist.
+
+Every user's calls, token refreshes included, share one keep-alive connection pool. A
+spotipy client left to its own devices builds a fresh `requests.Session` each time one
+is constructed, which for a five-second poll meant a new TCP and TLS handshake with
+api.spotify.com on every single poll.
+
+Access tokens are cached in memory per user, so an ordinary poll neither queries
+SQLite nor runs a Fernet decrypt. The store is read when a user's grant is first
+needed, and written only when the token is actually refreshed.
 """
 
 import logging
 import urllib.parse
+from dataclasses import dataclass
+from threading import Lock
 from typing import Any, Optional
 
 import requests
 import spotipy
+from requests.adapters import HTTPAdapter
 
 from .config import AppConfig
 from .db import Database, now_seconds
@@ -23,15 +35,56 @@ TOKEN_URL = "https://accounts.spotify.com/api/token"
 # Refresh a little early so a long request can't start with a token that expires mid-flight.
 TOKEN_REFRESH_MARGIN_SECONDS = 60
 
+# Connections kept open per host. Sized to the poll scheduler's workers plus some room
+# for the HTTP routes that call Spotify; beyond it requests still go out, they just
+# don't get a connection kept for them afterwards.
+HTTP_POOL_SIZE = 16
+REQUEST_TIMEOUT = 20
+
+
+def pooled_session(pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """A session whose connections are kept alive and shared across threads.
+
+    No retries at this layer: a 429 has to reach the tracker, which is what honours
+    Retry-After, and the poll simply runs again five seconds later anyway.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
 class SpotifyAuthError(Exception):
     """The user's grant is gone -- they have to reconnect."""
 
 
+@dataclass
+class _Grant:
+    access_token: str
+    refresh_token: str
+    expires_at: int
+
+    def fresh(self) -> bool:
+        return self.expires_at > now_seconds() + TOKEN_REFRESH_MARGIN_SECONDS
+
+
 class SpotifyService:
-    def __init__(self, config: AppConfig, db: Database):
+    def __init__(
+        self, config: AppConfig, db: Database, session: Optional[requests.Session] = None
+    ):
         self.config = config
         self.db = db
+        self.session = session or pooled_session()
+        # One client per user, rebuilt only when the access token it carries changes.
+        self._clients: dict[int, tuple[str, spotipy.Spotify]] = {}
+        self._clients_lock = Lock()
+        # Decrypted grants, so the store is only touched when a token actually changes.
+        # A grant is only ever replaced, never edited, so readers need no lock; the
+        # per-user refresh lock makes concurrent refreshes for one user wait on one.
+        self._grants: dict[int, _Grant] = {}
+        self._refresh_locks: dict[int, Lock] = {}
+        self._forgotten: dict[int, int] = {}
 
     def auth_url(self, state: str) -> str:
         query = urllib.parse.urlencode(
@@ -49,11 +102,11 @@ class SpotifyService:
         return f"{AUTHORIZE_URL}?{query}"
 
     def _token_request(self, payload: dict[str, str]) -> dict[str, Any]:
-        response = requests.post(
+        response = self.session.post(
             TOKEN_URL,
             data=payload,
             auth=(self.config.client_id, self.config.client_secret),
-            timeout=20,
+            timeout=REQUEST_TIMEOUT,
         )
         if response.status_code >= 400:
             body = response.text[:400]
@@ -77,7 +130,7 @@ class SpotifyService:
         if not access_token or not refresh_token:
             raise RuntimeError("Spotify OAuth response was incomplete")
 
-        profile = spotipy.Spotify(auth=access_token, requests_timeout=20).me()
+        profile = self._new_client(access_token).me()
         if not profile.get("id"):
             raise RuntimeError("Spotify profile did not include a user id")
 
@@ -90,20 +143,45 @@ class SpotifyService:
         }
 
     def access_token(self, user_id: int) -> str:
-        tokens = self.db.tokens(user_id)
-        if not tokens:
-            raise SpotifyAuthError("No stored Spotify tokens")
-
-        if int(tokens["expires_at"]) > now_seconds() + TOKEN_REFRESH_MARGIN_SECONDS:
-            return str(tokens["access_token"])
-
+        grant = self._grants.get(user_id)
+        if grant and grant.fresh():
+            return grant.access_token
+
+        with self._refresh_lock(user_id):
+            # Whoever held the lock before us may have just refreshed it.
+            grant = self._grants.get(user_id)
+            if grant and grant.fresh():
+                return grant.access_token
+
+            generation = self._forgotten.get(user_id, 0)
+            if grant is None:
+                tokens = self.db.tokens(user_id)
+                if not tokens:
+                    raise SpotifyAuthError("No stored Spotify tokens")
+                grant = _Grant(
+                    str(tokens["access_token"]),
+                    str(tokens["refresh_token"]),
+                    int(tokens["expires_at"]),
+                )
+            if not grant.fresh():
+                grant = self._refresh(user_id, grant)
+
+            with self._clients_lock:
+                # Forgotten while we were refreshing -- a disconnect or a new sign-in
+                # whose tokens must not be shadowed by these.
+                if self._forgotten.get(user_id, 0) == generation:
+                    self._grants[user_id] = grant
+            return grant.access_token
+
+    def _refresh(self, user_id: int, grant: _Grant) -> _Grant:
         try:
             refreshed = self._token_request(
-                {"grant_type": "refresh_token", "refresh_token": str(tokens["refresh_token"])}
+                {"grant_type": "refresh_token", "refresh_token": grant.refresh_token}
             )
         except SpotifyAuthError:
             # Revoked from the Spotify account page, or the app allowlist changed.
             self.db.clear_tokens(user_id)
+            self.forget(user_id)
             raise
 
         access_token = refreshed.get("access_token")
@@ -111,16 +189,42 @@ class SpotifyService:
             raise RuntimeError("Spotify refresh response was incomplete")
 
         # Spotify only sometimes rotates the refresh token; keep the old one otherwise.
-        self.db.save_tokens(
-            user_id,
+        grant = _Grant(
             str(access_token),
-            str(refreshed.get("refresh_token") or tokens["refresh_token"]),
+            str(refreshed.get("refresh_token") or grant.refresh_token),
             now_seconds() + int(refreshed.get("expires_in", 3600)),
         )
-        return str(access_token)
+        self.db.save_tokens(user_id, grant.access_token, grant.refresh_token, grant.expires_at)
+        return grant
+
+    def _refresh_lock(self, user_id: int) -> Lock:
+        with self._clients_lock:
+            return self._refresh_locks.setdefault(user_id, Lock())
+
+    def _new_client(self, access_token: str) -> spotipy.Spotify:
+        return spotipy.Spotify(
+            auth=access_token,
+            requests_session=self.session,
+            requests_timeout=REQUEST_TIMEOUT,
+            retries=0,
+        )
 
     def client(self, user_id: int) -> spotipy.Spotify:
-        return spotipy.Spotify(auth=self.access_token(user_id), requests_timeout=20, retries=0)
+        access_token = self.access_token(user_id)
+        with self._clients_lock:
+            cached = self._clients.get(user_id)
+            if cached and cached[0] == access_token:
+                return cached[1]
+            client = self._new_client(access_token)
+            self._clients[user_id] = (access_token, client)
+        return client
+
+    def forget(self, user_id: int) -> None:
+        """Drop what's held in memory for a user who disconnected or re-authorised."""
+        with self._clients_lock:
+            self._clients.pop(user_id, None)
+            self._grants.pop(user_id, None)
+            self._forgotten[user_id] = self._forgotten.get(user_id, 0) + 1
 
 
 def retry_after_seconds(error: spotipy.SpotifyException) -> Optional[int]:
@@ -0,0 +1,411 @@
+"""Listening stats kept as running totals, folded in as each listen closes.
+
+The stats page used to aggregate a user's whole history on every load -- by hour, by
+day of the week, by distinct day for the streaks -- which made it the one endpoint
+whose cost grew with every song ever played. Everything that is a sum over all time now
+lives in small rollup tables instead, updated in the same transaction that closes the
+listen, so reading them costs the same after ten years as after a week.
+
+Deliberately stdlib-only, like scripts/dbtool.py, which imports it to rebuild the
+rollup from `listens` on the host. Hours, weekdays and days are local time, exactly as
+SQLite's `'localtime'` modifier reads them. Each listen stores its local day and hour as
+it is written (`local_slot`), and a rebuild reads those columns rather than converting
+every timestamp again -- so a fold and a rebuild always agree, even across a change of
+the host's timezone.
+"""
+
+import sqlite3
+import time
+from datetime import date
+from typing import Any, Optional
+
+SCHEMA = """
+-- Totals over every closed listen. `current_run` is the length of the run of
+-- consecutive days ending at `last_day`; whether it is still alive is a question of
+-- what today is, so that is answered when it's read.
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id          INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    listens          INTEGER NOT NULL DEFAULT 0,
+    listened_ms      INTEGER NOT NULL DEFAULT 0,
+    completion_sum   REAL    NOT NULL DEFAULT 0,
+    skipped          INTEGER NOT NULL DEFAULT 0,
+    perfect          INTEGER NOT NULL DEFAULT 0,
+    first_played_at  INTEGER,
+    artists          INTEGER NOT NULL DEFAULT 0,
+    tracks           INTEGER NOT NULL DEFAULT 0,
+    last_day         TEXT,
+    current_run      INTEGER NOT NULL DEFAULT 0,
+    longest_run      INTEGER NOT NULL DEFAULT 0
+);
+
+-- Listens by local weekday (0 = Sunday, as strftime's %w) and hour: at most 168 rows a
+-- user, which answer the peak hour, the busiest day and the late-night share.
+CREATE TABLE IF NOT EXISTS stats_grid (
+    user_id  INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    weekday  INTEGER NOT NULL,
+    hour     INTEGER NOT NULL,
+    listens  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, weekday, hour)
+) WITHOUT ROWID;
+
+-- Every local day with a listen. Only read when a day arrives out of order.
+CREATE TABLE IF NOT EXISTS listen_days (
+    user_id  INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    day      TEXT    NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS artist_stats (
+    user_id          INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    artist           TEXT    NOT NULL,
+    listens          INTEGER NOT NULL DEFAULT 0,
+    qualified_plays  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, artist)
+);
+
+CREATE INDEX IF NOT EXISTS idx_artist_stats_top
+    ON artist_stats (user_id, qualified_plays DESC);
+"""
+
+ROLLUP_TABLES = ("user_stats", "stats_grid", "listen_days", "artist_stats")
+
+# Hours counted as late night, inclusive.
+LATE_NIGHT_HOURS = (0, 5)
+
+_LOCAL = "played_at / 1000, 'unixepoch', 'localtime'"
+
+
+def local_slot(played_at: int) -> tuple[str, int, int]:
+    """(day, weekday, hour) of a listen in local time, as SQLite's 'localtime' has it."""
+    moment = time.localtime(played_at / 1000)
+    return time.strftime("%Y-%m-%d", moment), (moment.tm_wday + 1) % 7, moment.tm_hour
+
+
+def fold(
+    conn: sqlite3.Connection,
+    user_id: int,
+    artist: str,
+    played_at: int,
+    listened_ms: int,
+    completion_ratio: float,
+    qualified: bool,
+    new_track: bool = False,
+) -> None:
+    """Add one closed listen to the rollup. Runs inside the caller's transaction.
+
+    `new_track` is the caller's to say -- it is the first listen of the track, as the
+    per-track tally it keeps alongside has it.
+    """
+    day, weekday, hour = local_slot(played_at)
+    conn.execute("INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)", (user_id,))
+    new_artist = conn.execute(
+        "INSERT OR IGNORE INTO artist_stats (user_id, artist) VALUES (?, ?)", (user_id, artist)
+    ).rowcount
+    conn.execute(
+        """
+        UPDATE artist_stats SET listens = listens + 1, qualified_plays = qualified_plays + ?
+         WHERE user_id = ? AND artist = ?
+        """,
+        (1 if qualified else 0, user_id, artist),
+    )
+    conn.execute(
+        """
+        UPDATE user_stats
+           SET listens         = listens + 1,
+               listened_ms     = listened_ms + ?,
+               completion_sum  = completion_sum + ?,
+               skipped         = skipped + ?,
+               perfect         = perfect + ?,
+               first_played_at = MIN(COALESCE(first_played_at, ?), ?),
+               artists         = artists + ?,
+               tracks          = tracks + ?
+         WHERE user_id = ?
+        """,
+        (
+            int(listened_ms or 0),
+            float(completion_ratio or 0),
+            0 if qualified else 1,
+            1 if (completion_ratio or 0) >= 1.0 else 0,
+            played_at,
+            played_at,
+            new_artist,
+            1 if new_track else 0,
+            user_id,
+        ),
+    )
+    conn.execute(
+        """
+        INSERT INTO stats_grid (user_id, weekday, hour, listens) VALUES (?, ?, ?, 1)
+        ON CONFLICT(user_id, weekday, hour) DO UPDATE SET listens = listens + 1
+        """,
+        (user_id, weekday, hour),
+    )
+    _add_day(conn, user_id, day)
+
+
+def fold_since(conn: sqlite3.Connection, user_id: int, after: int, new_tracks: int = 0) -> None:
+    """`fold`, set-based, for every closed listen of the user's with an id past `after` --
+    a batch the importer has just written. Runs inside the caller's transaction.
+
+    `new_tracks` is the caller's to say, as `new_track` is `fold`'s.
+    """
+    # `+user_id`: the rowid range, not the user's whole history through their index.
+    batch = "FROM listens WHERE id > ? AND +user_id = ? AND is_open = 0"
+    params = (after, user_id)
+    totals = conn.execute(
+        f"""
+        SELECT COUNT(*), SUM(listened_ms), SUM(completion_ratio), SUM(qualified = 0),
+               SUM(completion_ratio >= 1.0), MIN(played_at)
+          {batch}
+        """,
+        params,
+    ).fetchone()
+    if not totals[0]:
+        return
+
+    conn.execute(
+        f"""
+        INSERT INTO artist_stats (user_id, artist, listens, qualified_plays)
+        SELECT ?, t.artist, COUNT(*), SUM(qualified)
+          FROM (SELECT track_key, qualified {batch}) l
+          JOIN tracks t ON t.key = l.track_key
+         GROUP BY t.artist
+        ON CONFLICT(user_id, artist) DO UPDATE SET
+            listens         = artist_stats.listens + excluded.listens,
+            qualified_plays = artist_stats.qualified_plays + excluded.qualified_plays
+        """,
+        (user_id, *params),
+    )
+    conn.execute("INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)", (user_id,))
+    conn.execute(
+        """
+        UPDATE user_stats
+           SET listens         = listens + ?,
+               listened_ms     = listened_ms + ?,
+               completion_sum  = completion_sum + ?,
+               skipped         = skipped + ?,
+               perfect         = perfect + ?,
+               first_played_at = MIN(COALESCE(first_played_at, ?), ?),
+               artists         = (SELECT COUNT(*) FROM artist_stats WHERE user_id = ?),
+               tracks          = tracks + ?
+         WHERE user_id = ?
+        """,
+        (
+            totals[0],
+            int(totals[1] or 0),
+            float(totals[2] or 0),
+            totals[3],
+            totals[4],
+            totals[5],
+            totals[5],
+            user_id,
+            new_tracks,
+            user_id,
+        ),
+    )
+    conn.execute(
+        f"""
+        INSERT INTO stats_grid (user_id, weekday, hour, listens)
+        SELECT ?, CAST(STRFTIME('%w', local_day) AS INTEGER), local_hour, SUM(n)
+          FROM (SELECT local_day, local_hour, COUNT(*) AS n {batch} GROUP BY 1, 2)
+         GROUP BY 2, 3
+        ON CONFLICT(user_id, weekday, hour) DO UPDATE SET
+            listens = stats_grid.listens + excluded.listens
+        """,
+        (user_id, *params),
+    )
+    if conn.execute(
+        f"INSERT OR IGNORE INTO listen_days (user_id, day) SELECT DISTINCT ?, local_day {batch}",
+        (user_id, *params),
+    ).rowcount:
+        _recount_streaks(conn, user_id)
+
+
+def _add_day(conn: sqlite3.Connection, user_id: int, day: str) -> None:
+    if not conn.execute(
+        "INSERT OR IGNORE INTO listen_days (user_id, day) VALUES (?, ?)", (user_id, day)
+    ).rowcount:
+        return  # not the first listen of the day; nothing about the streaks moved
+
+    row = conn.execute(
+        "SELECT last_day, current_run, longest_run FROM user_stats WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
+    last_day = row[0]
+    if last_day is not None and day < last_day:
+        # An earlier day filled in after the fact -- an orphan closed on a later start.
+        # It may join two runs together, so recount rather than guess.
+        _recount_streaks(conn, user_id)
+        return
+
+    follows = last_day is not None and _days_between(last_day, day) == 1
+    run = int(row[1]) + 1 if follows else 1
+    conn.execute(
+        "UPDATE user_stats SET last_day = ?, current_run = ?, longest_run = ? WHERE user_id = ?",
+        (day, run, max(run, int(row[2])), user_id),
+    )
+
+
+def _days_between(earlier: str, later: str) -> int:
+    return (date.fromisoformat(later) - date.fromisoformat(earlier)).days
+
+
+def _recount_streaks(conn: sqlite3.Connection, user_id: int) -> None:
+    days = [
+        row[0]
+        for row in conn.execute(
+            "SELECT day FROM listen_days WHERE user_id = ? ORDER BY day", (user_id,)
+        )
+    ]
+    run = longest = 0
+    previous: Optional[str] = None
+    for day in days:
+        run = run + 1 if previous is not None and _days_between(previous, day) == 1 else 1
+        longest = max(longest, run)
+        previous = day
+    conn.execute(
+        "UPDATE user_stats SET last_day = ?, current_run = ?, longest_run = ? WHERE user_id = ?",
+        (previous, run, longest, user_id),
+    )
+
+
+def rebuild(conn: sqlite3.Connection, user_id: Optional[int] = None) -> int:
+    """Recompute the rollup from `listens`, for one user or everyone. Returns users rebuilt.
+
+    The caller commits. Used by the schema migration that introduced the rollup and by
+    `dbtool.py rebuild-stats`, for when the two are ever suspected of disagreeing.
+    """
+    scope, params = ("user_id = ?", (user_id,)) if user_id is not None else ("1", ())
+    for table in ROLLUP_TABLES:
+        conn.execute(f"DELETE FROM {table} WHERE {scope}", params)
+
+    conn.execute(
+        f"""
+        INSERT INTO user_stats
+            (user_id, listens, listened_ms, completion_sum, skipped, perfect, first_played_at)
+        SELECT user_id, COUNT(*), SUM(listened_ms), SUM(completion_ratio),
+               SUM(qualified = 0), SUM(completion_ratio >= 1.0), MIN(played_at)
+          FROM listens WHERE is_open = 0 AND {scope}
+         GROUP BY user_id
+        """,
+        params,
+    )
+    # The weekday is worked out once per (day, hour) rather than once per listen.
+    conn.execute(
+        f"""
+        INSERT INTO stats_grid (user_id, weekday, hour, listens)
+        SELECT user_id, CAST(STRFTIME('%w', local_day) AS INTEGER), local_hour, SUM(n)
+          FROM (SELECT user_id, local_day, local_hour, COUNT(*) AS n
+                  FROM listens WHERE is_open = 0 AND {scope}
+                 GROUP BY 1, 2, 3)
+         GROUP BY 1, 2, 3
+        """,
+        params,
+    )
+    conn.execute(
+        f"""
+        INSERT INTO listen_days (user_id, day)
+        SELECT DISTINCT user_id, local_day FROM listens WHERE is_open = 0 AND {scope}
+        """,
+        params,
+    )
+    conn.execute(
+        f"""
+        INSERT INTO artist_stats (user_id, artist, listens, qualified_plays)
+        SELECT user_id, t.artist, COUNT(*), SUM(qualified)
+          FROM listens JOIN tracks t ON t.key = listens.track_key
+         WHERE is_open = 0 AND {scope}
+         GROUP BY user_id, t.artist
+        """,
+        params,
+    )
+    conn.execute(
+        f"""
+        UPDATE user_stats
+           SET artists = (SELECT COUNT(*) FROM artist_stats a
+                           WHERE a.user_id = user_stats.user_id),
+               tracks  = (SELECT COUNT(DISTINCT track_key) FROM listens l
+                           WHERE l.user_id = user_stats.user_id AND l.is_open = 0)
+         WHERE {scope}
+        """,
+        params,
+    )
+
+    users = [
+        row[0] for row in conn.execute(f"SELECT user_id FROM user_stats WHERE {scope}", params)
+    ]
+    for uid in users:
+        _recount_streaks(conn, uid)
+    return len(users)
+
+
+def fill_local_slots(conn: sqlite3.Connection) -> int:
+    """Give listens written before `local_day` and `local_hour` existed their values.
+
+    The caller commits. Returns the rows filled.
+    """
+    return conn.execute(
+        f"""
+        UPDATE listens
+           SET local_day = DATE({_LOCAL}),
+               local_hour = CAST(STRFTIME('%H', {_LOCAL}) AS INTEGER)
+         WHERE local_day = ''
+        """
+    ).rowcount
+
+
+def snapshot(conn: sqlite3.Connection, user_id: int, today: Optional[str] = None) -> dict[str, Any]:
+    """Everything all-time the stats page shows, from the rollup alone."""
+    row = conn.execute(
+        """
+        SELECT listens, listened_ms, completion_sum, skipped, perfect, first_played_at,
+               artists, tracks, last_day, current_run, longest_run
+          FROM user_stats WHERE user_id = ?
+        """,
+        (user_id,),
+    ).fetchone()
+    totals = dict(zip(
+        ("listens", "listened_ms", "completion_sum", "skipped", "perfect", "first_played_at",
+         "artists", "tracks", "last_day", "current_run", "longest_run"),
+        row or (0, 0, 0.0, 0, 0, None, 0, 0, None, 0, 0),
+    ))
+
+    grid = conn.execute(
+        "SELECT weekday, hour, listens FROM stats_grid WHERE user_id = ?", (user_id,)
+    ).fetchall()
+    by_hour: dict[int, int] = {}
+    by_weekday: dict[int, int] = {}
+    late = 0
+    for weekday, hour, listens in grid:
+        by_hour[hour] = by_hour.get(hour, 0) + listens
+        by_weekday[weekday] = by_weekday.get(weekday, 0) + listens
+        if LATE_NIGHT_HOURS[0] <= hour <= LATE_NIGHT_HOURS[1]:
+            late += listens
+
+    top_artist = conn.execute(
+        """
+        SELECT artist, qualified_plays FROM artist_stats
+         WHERE user_id = ? ORDER BY qualified_plays DESC LIMIT 1
+        """,
+        (user_id,),
+    ).fetchone()
+
+    today = today or date.today().isoformat()
+    listens = int(totals["listens"])
+    return {
+        "listens": listens,
+        "listened_ms": int(totals["listened_ms"]),
+        "avg_completion": float(totals["completion_sum"]) / listens if listens else 0.0,
+        "skipped": int(totals["skipped"]),
+        "perfect": int(totals["perfect"]),
+        "first_played_at": totals["first_played_at"],
+        "artists": int(totals["artists"]),
+        "tracks": int(totals["tracks"]),
+        "top_artist": (str(top_artist[0]), int(top_artist[1])) if top_artist else None,
+        "peak_hour": max(by_hour, key=by_hour.__getitem__) if by_hour else None,
+        "top_weekday": max(by_weekday, key=by_weekday.__getitem__) if by_weekday else None,
+        "late_night": late,
+        # A streak is current only if it reaches today.
+        "current_streak": int(totals["current_run"]) if totals["last_day"] == today else 0,
+        "longest_streak": int(totals["longest_run"]),
+    }
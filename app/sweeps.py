@@ -0,0 +1,212 @@
+"""Discovery sweeps, run off the poll path and under one shared rate budget.
+
+A sweep used to run inline in the poll cycle that noticed it was due. Reading an embed
+page and the lookups and playlist writes that follow can take seconds -- far longer
+than the five-second measurement a poll exists for -- so on a Monday morning every
+user's poll stalled behind their own sweep, and with many users the poll pool filled
+with sweeps and the live measurement drifted for everyone.
+
+Now a poll only decides a sweep is due and hands it to `SweepPool`, a small bounded pool
+of its own, and carries on. At most one sweep per user is queued or running; asking
+again joins that one. Within a sweep the embed pages of a user's sources are fetched
+concurrently (`fetch_all`).
+
+Concurrency is only safe with a ceiling on what it can send, so every request a sweep
+makes draws from `budget`: a token bucket for the embed host and one for the Spotify
+Web API, shared by every sweep in the process. The live poll never draws from it --
+its one request every five seconds per user is already paced by the scheduler, and it
+must not queue behind a burst of sweeps.
+"""
+
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+# Threads running sweeps. Separate from the poll pool, so a slow sweep can't hold up a
+# poll, and small: the rate budget, not the thread count, is what bounds the traffic.
+SWEEP_WORKERS = 4
+
+# Threads fetching embed pages for the sweeps. Shared, and never used by anything that
+# waits on it from inside itself, so it can't deadlock the way nesting on one pool can.
+EMBED_WORKERS = 4
+
+# Requests per second a sweep may make, and how many may go out at once after a lull.
+# The embed page is a public web page, not an API; a couple a second is polite. The Web
+# API's limit is over a rolling window and unpublished, and the polls share it.
+EMBED_RATE, EMBED_BURST = 2.0, 4
+SPOTIFY_RATE, SPOTIFY_BURST = 5.0, 10
+
+# The history import's own share of the Web API, apart from the sweeps'. A first import
+# can ask about thousands of track lengths, and draining the sweeps' bucket with them
+# would hold up every other user's sweep until it was done.
+IMPORT_RATE, IMPORT_BURST = 1.0, 2
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """`rate` tokens a second, holding at most `burst`. Safe from any thread.
+
+    `take` reserves its token up front and then sleeps off any shortfall outside the
+    lock, so callers are served in the order they asked and a waiting thread doesn't
+    hold up the others' bookkeeping.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self.taken = 0
+        self.waited = 0.0
+
+    def take(self) -> float:
+        """Spend a token, waiting for one if there are none. Returns the seconds waited."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+            self.taken += 1
+            self.waited += wait
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def stats(self) -> dict[str, Any]:
+        return {"rate": self.rate, "taken": self.taken, "waited_ms": round(self.waited * 1000)}
+
+
+class BudgetedClient:
+    """A Spotify client whose every API call first takes a token from `bucket`."""
+
+    def __init__(self, client: Any, bucket: TokenBucket):
+        self._client = client
+        self._bucket = bucket
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            self._bucket.take()
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class RateBudget:
+    """The buckets every sweep in the process shares, `embed` and `spotify`, and the
+    history import's, `imports`."""
+
+    def __init__(self, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.embed = TokenBucket(EMBED_RATE, EMBED_BURST, sleep=sleep)
+        self.spotify = TokenBucket(SPOTIFY_RATE, SPOTIFY_BURST, sleep=sleep)
+        self.imports = TokenBucket(IMPORT_RATE, IMPORT_BURST, sleep=sleep)
+
+    def client(self, client: Any, bucket: Optional[TokenBucket] = None) -> Any:
+        """`client`, with its calls drawn from `bucket` -- the Spotify bucket unless told
+        otherwise. Wrapping twice is a no-op."""
+        if isinstance(client, BudgetedClient):
+            return client
+        return BudgetedClient(client, bucket or self.spotify)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "embed": self.embed.stats(),
+            "spotify": self.spotify.stats(),
+            "imports": self.imports.stats(),
+        }
+
+
+budget = RateBudget()
+
+_fetcher = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+
+
+def fetch_all(fetch: Callable[[str], T], keys: Iterable[str]) -> dict[str, "T | Exception"]:
+    """`fetch(key)` for every key, concurrently, each result or the exception it raised.
+
+    A single key is fetched on the calling thread -- there's nothing to overlap it with.
+    """
+    keys = list(dict.fromkeys(keys))
+    results: dict[str, Any] = {}
+    if len(keys) == 1:
+        try:
+            results[keys[0]] = fetch(keys[0])
+        except Exception as exc:
+            results[keys[0]] = exc
+        return results
+
+    futures = {key: _fetcher.submit(fetch, key) for key in keys}
+    for key, future in futures.items():
+        exc = future.exception()
+        results[key] = exc if exc is not None else future.result()
+    return results
+
+
+class SweepPool:
+    """A bounded pool for sweeps, running at most one per user at a time."""
+
+    def __init__(self, workers: int = SWEEP_WORKERS):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sweep")
+        self._lock = Lock()
+        self._in_flight: dict[int, Future] = {}
+        self.completed = 0
+        self.failed = 0
+        self.joined = 0
+
+    def __contains__(self, key: int) -> bool:
+        with self._lock:
+            return key in self._in_flight
+
+    def submit(self, key: int, sweep: Callable[[], T]) -> "Future[T]":
+        """Queue `sweep` for `key`, or return the one already queued or running for it."""
+        with self._lock:
+            running = self._in_flight.get(key)
+            if running is not None:
+                self.joined += 1
+                return running
+            future = self._executor.submit(sweep)
+            self._in_flight[key] = future
+        # Outside the lock: a future that already finished runs the callback right here.
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+    def _finished(self, key: int, future: Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def close(self) -> None:
+        """Drop the sweeps still queued. One already running finishes in its thread."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return {
+            "workers": self.workers,
+            "in_flight": in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "joined": self.joined,
+            "budget": budget.stats(),
+        }
@@ -0,0 +1,237 @@
+"""Checking `play_counts` against the history it summarises, and rebuilding it online.
+
+`play_counts` is a materialised aggregate of `listens`, folded one listen at a time as
+each closes (`Database._bump_counts`) and a batch at a time by the importer. Nothing but
+those folds keeps the two in step, and until now the only way to put them right was the
+migration's drop-and-recount, under the writer's lock and with the app down.
+
+Here instead:
+
+- `drifted` compares, per user, a checksum of the stored tally with the same checksum
+  worked out from `listens`, inside one read snapshot. It writes nothing and holds no
+  lock, so it can run beside the app as often as anyone likes.
+- `repair` recounts the users it names in place, one short transaction each.
+- `rebuild` recounts everyone into a shadow table a chunk of users per transaction,
+  then swaps it in with a rename. The app's writes go on between chunks; a trigger
+  notes every user whose tally changed meanwhile, and those are recounted in the
+  transaction that makes the swap, so nothing folded during the rebuild is lost.
+
+Deliberately stdlib-only, like app/stats.py, so scripts/dbtool.py can run all three on
+the host.
+"""
+
+import sqlite3
+from contextlib import nullcontext
+from typing import Any, ContextManager, Iterable, Optional
+
+# Users per transaction while the shadow table fills. The app's writer waits at most
+# one chunk for the lock.
+REBUILD_CHUNK_USERS = 50
+
+# Users compared per read snapshot.
+VERIFY_CHUNK_USERS = 100
+
+# A materialised aggregate of `listens`, so recounting it is always the correct repair.
+# `app/db.py` creates it with the rest of the schema.
+DDL = """
+CREATE TABLE IF NOT EXISTS play_counts (
+    user_id         INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    track_id        TEXT    NOT NULL,
+    name            TEXT    NOT NULL,
+    artist          TEXT    NOT NULL,
+    qualified_plays INTEGER NOT NULL DEFAULT 0,
+    total_plays     INTEGER NOT NULL DEFAULT 0,
+    last_played     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, track_id)
+)
+"""
+
+# The favourites are the rows at or over a threshold that is a setting, so this is a
+# plain index rather than a partial one: a range scan from the top of a user's tally,
+# which costs what the favourites number, however many tracks were ever heard. Created
+# by `_migrate`, after any rebuild, since an older `play_counts` lacks the columns.
+INDEX = """
+CREATE INDEX IF NOT EXISTS idx_play_counts_qualified
+    ON play_counts (user_id, qualified_plays DESC, last_played DESC)
+"""
+
+SHADOW_TABLE = "play_counts_shadow"
+DIRTY_TABLE = "play_counts_dirty"
+
+_COLUMNS = "(user_id, track_id, name, artist, qualified_plays, total_plays, last_played)"
+
+# The tally as the history has it. A track that was renamed between plays keeps its
+# latest name, as the live fold does.
+_RECOUNT = """
+SELECT l.user_id, t.track_id, t.name, t.artist,
+       SUM(l.qualified), COUNT(*), MAX(l.played_at)
+  FROM listens l
+  JOIN tracks t ON t.key = l.track_key
+ WHERE l.is_open = 0 AND {scope}
+ GROUP BY l.user_id, l.track_key
+"""
+
+# One number per tally row: its counts, each weighted by a number drawn from the track,
+# so that plays moved from one track to another change the sum even when the totals
+# don't. Every product stays inside 64 bits for any track key under 2**31.
+_MODULUS = 2147483647
+_WEIGHT = f"((key * 2654435761) % {_MODULUS} + 1)"
+_FINGERPRINT = f"""
+{_WEIGHT} * ((total_plays * 65599 + qualified_plays) % {_MODULUS} + 1) % {_MODULUS}
++ {_WEIGHT} * (last_played % {_MODULUS} + 1) % {_MODULUS}
+"""
+
+_STORED = """
+SELECT p.user_id, COALESCE(t.key, -1) AS key,
+       p.qualified_plays, p.total_plays, p.last_played
+  FROM play_counts p
+  LEFT JOIN tracks t ON t.track_id = p.track_id
+ WHERE p.user_id IN (SELECT value FROM json_each(?))
+"""
+
+_EXPECTED = """
+SELECT user_id, track_key AS key, SUM(qualified) AS qualified_plays,
+       COUNT(*) AS total_plays, MAX(played_at) AS last_played
+  FROM listens
+ WHERE is_open = 0 AND user_id IN (SELECT value FROM json_each(?))
+ GROUP BY user_id, track_key
+"""
+
+# (tracks, plays, fingerprint sum) per user.
+Checksum = tuple[int, int, int]
+
+
+def recount(
+    conn: sqlite3.Connection,
+    table: str = "play_counts",
+    scope: str = "1",
+    params: tuple[Any, ...] = (),
+) -> int:
+    """Insert the tally for the listens `scope` selects into `table`. The caller holds
+    the lock and commits. Returns the rows written."""
+    return conn.execute(
+        f"INSERT INTO {table} {_COLUMNS} {_RECOUNT.format(scope=scope)}", params
+    ).rowcount
+
+
+def _checksums(conn: sqlite3.Connection, rows: str, users: str) -> dict[int, Checksum]:
+    query = f"""
+        SELECT user_id, COUNT(*), SUM(total_plays), SUM({_FINGERPRINT})
+          FROM ({rows})
+         GROUP BY user_id
+    """
+    return {row[0]: (row[1], row[2], row[3]) for row in conn.execute(query, (users,))}
+
+
+def checksums(
+    conn: sqlite3.Connection, user_ids: Iterable[int]
+) -> tuple[dict[int, Checksum], dict[int, Checksum]]:
+    """The stored and the expected checksum of each user's tally. Run both inside one
+    read transaction, or a listen closing between them reads as drift."""
+    users = "[" + ",".join(str(int(user_id)) for user_id in user_ids) + "]"
+    return _checksums(conn, _STORED, users), _checksums(conn, _EXPECTED, users)
+
+
+def drifted(conn: sqlite3.Connection, user_ids: Iterable[int]) -> list[int]:
+    """The users among `user_ids` whose tally disagrees with their listens."""
+    user_ids = list(user_ids)
+    stored, expected = checksums(conn, user_ids)
+    return [user_id for user_id in user_ids if stored.get(user_id) != expected.get(user_id)]
+
+
+def repair(
+    conn: sqlite3.Connection,
+    user_ids: Iterable[int],
+    lock: Optional[ContextManager[Any]] = None,
+) -> int:
+    """Recount each user's tally from their listens, a user per transaction. Returns the
+    rows written."""
+    lock = lock or nullcontext()
+    written = 0
+    for user_id in user_ids:
+        with lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM play_counts WHERE user_id = ?", (user_id,))
+                written += recount(conn, scope="l.user_id = ?", params=(user_id,))
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    return written
+
+
+def discard_shadow(conn: sqlite3.Connection) -> None:
+    """Drop what an interrupted `rebuild` left behind. The caller holds the lock.
+
+    The shadow table carries the tally's index under its real name -- SQLite can't
+    rename an index -- so the live table is left without one until the next rebuild
+    or the next start recreates it.
+    """
+    for event in ("insert", "update", "delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {DIRTY_TABLE}_{event}")
+    conn.execute(f"DROP TABLE IF EXISTS {DIRTY_TABLE}")
+    conn.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+
+
+def rebuild(
+    conn: sqlite3.Connection,
+    lock: Optional[ContextManager[Any]] = None,
+    chunk: int = REBUILD_CHUNK_USERS,
+) -> int:
+    """Recount every tally into a shadow table and swap it in. Returns the rows it holds.
+
+    The caller must not have a transaction open. The live index is dropped first, since
+    the shadow's must have its name: until the swap, the favourites read a user's tally
+    by its primary key and sort it, which is slower but still correct.
+    """
+    lock = lock or nullcontext()
+    with lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            discard_shadow(conn)
+            conn.execute("DROP INDEX IF EXISTS idx_play_counts_qualified")
+            conn.execute(DDL.replace("play_counts", SHADOW_TABLE))
+            conn.execute(INDEX.replace("ON play_counts", f"ON {SHADOW_TABLE}"))
+            conn.execute(f"CREATE TABLE {DIRTY_TABLE} (user_id INTEGER PRIMARY KEY)")
+            for event, row in (("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")):
+                conn.execute(
+                    f"""
+                    CREATE TRIGGER {DIRTY_TABLE}_{event} AFTER {event.upper()} ON play_counts
+                    BEGIN
+                        INSERT OR IGNORE INTO {DIRTY_TABLE} VALUES ({row}.user_id);
+                    END
+                    """
+                )
+            user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    for start in range(0, len(user_ids), chunk):
+        first, last = user_ids[start], user_ids[min(start + chunk, len(user_ids)) - 1]
+        with lock:
+            recount(conn, SHADOW_TABLE, "l.user_id BETWEEN ? AND ?", (first, last))
+            conn.commit()
+
+    with lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Recounted: everyone whose tally moved since their chunk was copied, and
+            # anyone who joined after the list of users was taken.
+            stale = f"SELECT user_id FROM {DIRTY_TABLE} UNION SELECT id FROM users WHERE id > ?"
+            last = user_ids[-1] if user_ids else 0
+            conn.execute(f"DELETE FROM {SHADOW_TABLE} WHERE user_id IN ({stale})", (last,))
+            recount(conn, SHADOW_TABLE, f"l.user_id IN ({stale})", (last,))
+            for event in ("insert", "update", "delete"):
+                conn.execute(f"DROP TRIGGER {DIRTY_TABLE}_{event}")
+            conn.execute(f"DROP TABLE {DIRTY_TABLE}")
+            conn.execute("DROP TABLE play_counts")
+            conn.execute(f"ALTER TABLE {SHADOW_TABLE} RENAME TO play_counts")
+            rows = conn.execute("SELECT COUNT(*) FROM play_counts").fetchone()[0]
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    return rows
@@ -19,6 +19,7 @@ quietly make everyone's percentages mean something different.
 
 import asyncio
 import logging
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from typing import Any, Optional
 
@@ -28,9 +29,12 @@ from . import listens, playlists
 from .aiblocklist import AiBlocklist
 from .db import Database, now_millis, now_seconds
 from .discovery import Discovery
+from .events import EventHub
 from .listens import Observation, Session
-from .playlists import PlaylistCache
+from .playlists import PlaylistCache, PlaylistTracks
+from .scheduler import PollScheduler
 from .spotify import SpotifyAuthError, SpotifyService, retry_after_seconds
+from .sweeps import SweepPool
 
 log = logging.getLogger(__name__)
 
@@ -75,21 +79,29 @@ def format_now_playing(
 
 class UserTracker:
     def __init__(
-        self, user_id: int, db: Database, spotify: SpotifyService, blocklist: AiBlocklist
+        self,
+        user_id: int,
+        db: Database,
+        spotify: SpotifyService,
+        blocklist: AiBlocklist,
+        events: Optional[EventHub] = None,
+        sweeps: Optional[SweepPool] = None,
     ):
         self.user_id = user_id
         self.db = db
         self.spotify = spotify
-        self.cache = PlaylistCache()
+        self.events = events
+        # Where sweeps run. Without one a sweep runs on the caller's thread.
+        self.sweeps = sweeps
+        self.cache = PlaylistCache(db, user_id)
         self.discovery = Discovery(db, self.cache, blocklist)
         self.last_sweep: Optional[dict[str, Any]] = None
-        self.task: Optional[asyncio.Task] = None
-        self.now_playing: Optional[dict[str, Any]] = None
+        self._now_playing: Optional[dict[str, Any]] = None
         self.last_error: Optional[str] = None
         # Refreshed once per cycle so /api/state, which the browser polls, needs no
         # Spotify call of its own.
-        self.favorites_snapshot: list[dict[str, str]] = []
-        self.favorites_membership: set[str] = set()
+        self.favorites_snapshot: PlaylistTracks = playlists.NO_TRACKS
+        self.favorites_membership: frozenset[str] = frozenset()
         # The playback currently being measured. Mirrored to an open row in `listens`,
         # so a restart keeps whatever was heard before it rather than dropping it.
         self.session: Optional[Session] = None
@@ -98,6 +110,21 @@ class UserTracker:
         self._needs_reconcile = False
         self._initialized = False
 
+    @property
+    def now_playing(self) -> Optional[dict[str, Any]]:
+        return self._now_playing
+
+    @now_playing.setter
+    def now_playing(self, value: Optional[dict[str, Any]]) -> None:
+        # Pushed only when it changes: a paused track is one event, not one per poll.
+        if value != self._now_playing:
+            self._now_playing = value
+            self._publish("now_playing", value)
+
+    def _publish(self, event: str, data: Any) -> None:
+        if self.events:
+            self.events.publish(self.user_id, event, data)
+
     # ------------------------------------------------------------- favourites
 
     def _favorites_playlist(self, client: spotipy.Spotify, settings: dict[str, Any]) -> str:
@@ -117,8 +144,19 @@ class UserTracker:
     def add_to_favorites(self, client: spotipy.Spotify, track_ids: list[str]) -> int:
         settings = self.db.settings(self.user_id)
         playlist_id = self._favorites_playlist(client, settings)
-        # add_tracks skips anything already present, so repeat calls are free.
-        return playlists.add_tracks(client, playlist_id, track_ids, self.cache, position=0)
+        # add_tracks skips anything already present, so repeat calls are free. The names
+        # let the cached membership take the new tracks in place of a re-read.
+        added = playlists.add_tracks(
+            client,
+            playlist_id,
+            track_ids,
+            self.cache,
+            position=0,
+            details=self.db.play_counts_for(self.user_id, track_ids),
+        )
+        if added:
+            self._publish("favorites", {"added": added})
+        return added
 
     def remove_from_favorites(self, client: spotipy.Spotify, track_ids: list[str]) -> int:
         settings = self.db.settings(self.user_id)
@@ -135,14 +173,16 @@ class UserTracker:
         first time `_favorites_playlist` creates or finds the playlist.
         """
         playlist_id = self.db.settings(self.user_id).get("favorites_playlist_id")
-        if not playlist_id:
-            self.favorites_snapshot = []
-            self.favorites_membership = set()
-            return
-
-        entries = playlists.items(client, str(playlist_id), self.cache)
+        entries = (
+            playlists.items(client, str(playlist_id), self.cache)
+            if playlist_id
+            else playlists.NO_TRACKS
+        )
+        if entries == self.favorites_snapshot:
+            return  # the usual case: the cached membership, unchanged since last poll
         self.favorites_snapshot = entries
-        self.favorites_membership = {entry["track_id"] for entry in entries}
+        self.favorites_membership = entries.members
+        self.db.touch_state(self.user_id, "favorites")
 
     def reconcile_favorites(self) -> int:
         """Add everything already over the threshold that isn't in the playlist yet.
@@ -156,11 +196,7 @@ class UserTracker:
             return 0
 
         threshold = int(settings["favorite_threshold"])
-        qualifying = [
-            track_id
-            for track_id, row in self.db.play_counts(self.user_id).items()
-            if int(row["qualified_plays"]) >= threshold
-        ]
+        qualifying = list(self.db.play_counts_over(self.user_id, threshold))
         if not qualifying:
             return 0
         return self.add_to_favorites(self.spotify.client(self.user_id), qualifying)
@@ -203,6 +239,18 @@ class UserTracker:
             "counts" if qualified else f"below {threshold_ratio:.0%}",
             count,
         )
+        self._publish(
+            "listen",
+            {
+                "track_id": result["track_id"],
+                "name": result["name"],
+                "artist": result["artist"],
+                "played_at": result["played_at"],
+                "completion_ratio": result["completion_ratio"],
+                "qualified": qualified,
+                "qualified_plays": count,
+            },
+        )
 
         if not qualified:
             return
@@ -265,9 +313,41 @@ class UserTracker:
         summary = self.discovery.sweep_sources(self.user_id, client, settings)
         self.db.set_last_source_sweep(self.user_id, now_seconds())
         self.last_sweep = {**summary, "at": now_seconds()}
+        self.db.touch_state(self.user_id, "discovery")
+        self._publish("sweep", self.last_sweep)
         return summary
 
-    def _maybe_sweep_sources(self, client: spotipy.Spotify) -> None:
+    def request_sweep(self) -> "Future[dict[str, Any]]":
+        """Sweep on the sweep pool, or join the sweep already queued or running.
+
+        A failed sweep is retried after `SOURCE_SWEEP_RETRY_SECONDS`; the future still
+        carries the error, for a caller that waits on it.
+        """
+        if self.sweeps is not None:
+            return self.sweeps.submit(self.user_id, self._sweep_or_retry)
+        future: Future = Future()
+        try:
+            future.set_result(self._sweep_or_retry())
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def _sweep_or_retry(self) -> dict[str, Any]:
+        try:
+            # Its own client, fetched when the sweep starts: one queued behind others
+            # may start after the token the poll was using has been refreshed.
+            return self.sweep_sources(self.spotify.client(self.user_id))
+        except Exception as exc:
+            self.db.set_last_source_sweep(
+                self.user_id,
+                now_seconds() - SOURCE_SWEEP_CHECK_SECONDS + SOURCE_SWEEP_RETRY_SECONDS,
+            )
+            log.warning("Source sweep failed for user %s: %s", self.user_id, exc)
+            raise
+
+    def _maybe_sweep_sources(self) -> None:
+        if self.sweeps is not None and self.user_id in self.sweeps:
+            return  # one is already on its way
         due = self.db.last_source_sweep(self.user_id) + SOURCE_SWEEP_CHECK_SECONDS
         if now_seconds() < due:
             return
@@ -279,14 +359,8 @@ class UserTracker:
         if now.weekday() != 0 and self.db.last_source_sweep(self.user_id) >= int(monday.timestamp()):
             return
 
-        try:
-            self.sweep_sources(client)
-        except Exception as exc:
-            self.db.set_last_source_sweep(
-                self.user_id,
-                now_seconds() - SOURCE_SWEEP_CHECK_SECONDS + SOURCE_SWEEP_RETRY_SECONDS,
-            )
-            log.warning("Source sweep failed for user %s: %s", self.user_id, exc)
+        # Handed off, not waited on: the poll carries on measuring while it runs.
+        self.request_sweep()
 
     def _live_poll(self, client: spotipy.Spotify) -> Optional[bool]:
         """Measure playback, refresh now-playing, run discovery capture.
@@ -342,7 +416,7 @@ class UserTracker:
             if dw_id and dw_id not in existing_ids:
                 self.db.add_discovery_source(self.user_id, dw_id, "Discover Weekly")
                 log.info("Auto-registered Discover Weekly source for user %s", self.user_id)
-                self.sweep_sources(client)
+                self.request_sweep()
         except Exception as exc:
             log.warning(
                 "Could not auto-register Discover Weekly for user %s: %s", self.user_id, exc
@@ -352,99 +426,125 @@ class UserTracker:
 
     # ------------------------------------------------------------------- loop
 
-    async def _cycle(self) -> None:
-        client = await asyncio.to_thread(self.spotify.client, self.user_id)
+    def _cycle(self) -> None:
+        client = self.spotify.client(self.user_id)
 
         if not self._initialized:
-            await asyncio.to_thread(self._initialize, client)
+            self._initialize(client)
 
-        active = await asyncio.to_thread(self._live_poll, client)
+        active = self._live_poll(client)
         if active is None:
             return  # couldn't reach Spotify; retry on next cycle
         # One Spotify read per cycle at most: the playlist membership behind this is
-        # cached for 30s, so a 5-second poll doesn't turn into a 5-second playlist read.
-        await asyncio.to_thread(self.refresh_favorites, client)
-        await asyncio.to_thread(self._maybe_sweep_sources, client)
+        # cached for 30s, and after that only its snapshot is checked -- a 5-second poll
+        # doesn't turn into a 5-second playlist read.
+        self.refresh_favorites(client)
+        self._maybe_sweep_sources()
 
         if self._needs_reconcile:
-            await asyncio.to_thread(self.reconcile_favorites)
+            self.reconcile_favorites()
             self._needs_reconcile = False
 
         self.last_error = None
 
-    async def run(self) -> None:
-        log.info("Tracker started for user %s", self.user_id)
+    def poll(self) -> Optional[float]:
+        """Run one cycle. Returns the seconds until the next, or None to stop polling.
+
+        Called by the shared scheduler on one of its worker threads, so the whole cycle
+        is one hop off the event loop rather than one per step.
+        """
+        error = self.last_error
         try:
-            while True:
-                # Fixed, except when Spotify itself tells us to slow down below.
-                delay = POLL_INTERVAL_SECONDS
-                try:
-                    await self._cycle()
-                except SpotifyAuthError:
-                    log.warning("User %s must reconnect Spotify; stopping tracker", self.user_id)
-                    self.last_error = "Spotify access was revoked. Log in again to resume."
-                    self.now_playing = None
-                    return
-                except spotipy.SpotifyException as exc:
-                    wait = retry_after_seconds(exc)
-                    if wait:
-                        log.warning("Rate limited for user %s, waiting %ss", self.user_id, wait)
-                        self.last_error = "Rate limited by Spotify; retrying shortly."
-                        delay = wait
-                    else:
-                        log.warning("Spotify error for user %s: %s", self.user_id, exc)
-                        self.last_error = f"Spotify error: {exc.msg or exc.http_status}"
-                except Exception as exc:
-                    log.warning("Tracker error for user %s: %s", self.user_id, exc)
-                    self.last_error = str(exc)
-
-                await asyncio.sleep(delay)
-        except asyncio.CancelledError:
-            log.info("Tracker stopped for user %s", self.user_id)
-            raise
+            return self._poll()
+        finally:
+            if self.last_error != error:
+                self.db.touch_state(self.user_id, "status")
+
+    def _poll(self) -> Optional[float]:
+        try:
+            self._cycle()
+        except SpotifyAuthError:
+            log.warning("User %s must reconnect Spotify; stopping tracker", self.user_id)
+            self.last_error = "Spotify access was revoked. Log in again to resume."
+            self.now_playing = None
+            return None
+        except spotipy.SpotifyException as exc:
+            wait = retry_after_seconds(exc)
+            if wait:
+                # Fixed, except when Spotify itself tells us to slow down.
+                log.warning("Rate limited for user %s, waiting %ss", self.user_id, wait)
+                self.last_error = "Rate limited by Spotify; retrying shortly."
+                return wait
+            log.warning("Spotify error for user %s: %s", self.user_id, exc)
+            self.last_error = f"Spotify error: {exc.msg or exc.http_status}"
+        except Exception as exc:
+            log.warning("Tracker error for user %s: %s", self.user_id, exc)
+            self.last_error = str(exc)
+        return POLL_INTERVAL_SECONDS
 
 
 class TrackerManager:
-    """Owns one asyncio task per connected user."""
+    """Owns one UserTracker per connected user, the one scheduler that polls them, and
+    the pool their discovery sweeps run on."""
 
-    def __init__(self, db: Database, spotify: SpotifyService, blocklist: AiBlocklist):
+    def __init__(
+        self,
+        db: Database,
+        spotify: SpotifyService,
+        blocklist: AiBlocklist,
+        events: Optional[EventHub] = None,
+    ):
         self.db = db
         self.spotify = spotify
         self.blocklist = blocklist
+        self.events = events
         self.trackers: dict[int, UserTracker] = {}
+        self.scheduler = PollScheduler(POLL_INTERVAL_SECONDS)
+        self.sweeps = SweepPool()
 
     def get(self, user_id: int) -> UserTracker:
         tracker = self.trackers.get(user_id)
         if not tracker:
-            tracker = UserTracker(user_id, self.db, self.spotify, self.blocklist)
+            tracker = UserTracker(
+                user_id, self.db, self.spotify, self.blocklist, self.events, self.sweeps
+            )
             self.trackers[user_id] = tracker
         return tracker
 
+    def cache_stats(self) -> dict[str, int]:
+        """Every user's playlist cache, added up."""
+        totals: dict[str, int] = {}
+        for tracker in list(self.trackers.values()):
+            for name, value in tracker.cache.stats().items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
     def is_running(self, user_id: int) -> bool:
-        tracker = self.trackers.get(user_id)
-        return bool(tracker and tracker.task and not tracker.task.done())
+        return user_id in self.scheduler
 
     async def start(self, user_id: int) -> None:
         tracker = self.get(user_id)
-        if tracker.task and not tracker.task.done():
+        if user_id in self.scheduler:
             return
         self.db.update_settings(user_id, {"tracker_running": True})
-        tracker.task = asyncio.create_task(tracker.run(), name=f"tracker-{user_id}")
+        self.scheduler.add(user_id, tracker.poll)
+        self.db.touch_state(user_id, "status")
+        log.info("Tracker started for user %s", user_id)
 
     async def stop(self, user_id: int, persist: bool = True) -> None:
-        # persist=False is for process shutdown: cancel the task without recording the
+        # persist=False is for process shutdown: stop polling without recording the
         # user as paused, or nobody's tracker would come back after a restart.
         if persist:
             self.db.update_settings(user_id, {"tracker_running": False})
         tracker = self.trackers.get(user_id)
-        if not tracker or not tracker.task:
+        if not tracker:
             return
-        task, tracker.task = tracker.task, None
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+        if user_id in self.scheduler:
+            await self.scheduler.remove(user_id)
+            self.db.touch_state(user_id, "status")
+            log.info("Tracker stopped for user %s", user_id)
+        # Also after the scheduler dropped it itself (a revoked grant): the listen that
+        # was open at the time still gets closed at what it reached.
         await asyncio.to_thread(tracker.flush)
         tracker.now_playing = None
 
@@ -455,3 +555,5 @@ class TrackerManager:
     async def stop_all(self) -> None:
         for user_id in list(self.trackers):
             await self.stop(user_id, persist=False)
+        await self.scheduler.close()
+        self.sweeps.close()
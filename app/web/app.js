@@ -1,6 +1,7 @@
 "use strict";
 
 const POLL_MS = 5000;
+const REFETCH_DEBOUNCE_MS = 250;
 const SEARCH_DEBOUNCE_MS = 250;
 const HISTORY_PAGE = 50;
 
@@ -332,6 +333,12 @@ async function loadHistory({ reset = false } = {}) {
   const params = new URLSearchParams();
   const q = $("history-q").value.trim();
   if (q) params.set("q", q);
+  // The export links download what the list shows: the same search, every page of it.
+  for (const link of document.querySelectorAll(".history-export")) {
+    const exportParams = new URLSearchParams(params);
+    exportParams.set("format", link.dataset.format);
+    link.href = `/api/history/export?${exportParams}`;
+  }
   params.set("limit", String(HISTORY_PAGE));
   if (hist.cursor) params.set("cursor", hist.cursor);
 
@@ -402,13 +409,82 @@ function selectedTracks() {
 
 async function refresh() {
   try {
-    render(await api("/api/state"));
+    // An unchanged state comes back as the browser's cached copy (ETag + 304), so
+    // the live panel is fetched on its own every time.
+    const [next, live] = await Promise.all([api("/api/state"), api("/api/now-playing")]);
+    render({ ...next, now_playing: live.now_playing });
     document.body.classList.remove("stale");
+    if (next.connected && (!stream || stream.readyState === EventSource.CLOSED)) watch();
   } catch (error) {
     document.body.classList.add("stale");
   }
 }
 
+// ------------------------------------------------------------------- stream
+
+// Changes arrive over /api/stream; the state is only polled while that is down --
+// signed out (it answers 401 and stays closed) or between reconnects. A pushed change
+// refetches just the sections of the state it touched.
+const SECTIONS_FOR = {
+  listen: ["favorites", "stats"],
+  favorites: ["favorites"],
+  sweep: ["discovery"],
+};
+
+let stream = null;
+let pollTimer = null;
+let refetchTimer = null;
+let wanted = new Set();
+
+function schedulePoll() {
+  clearTimeout(pollTimer);
+  pollTimer = setTimeout(async () => {
+    await refresh();
+    schedulePoll();
+  }, POLL_MS);
+}
+
+async function refreshWanted() {
+  const sections = [...wanted];
+  wanted = new Set();
+  if (!state || sections.includes("*")) return refresh();
+  try {
+    const part = await api(`/api/state?sections=${sections.join(",")}`);
+    if (!part.connected) return refresh();
+    render({ ...state, ...part });
+  } catch (error) {
+    document.body.classList.add("stale");
+  }
+}
+
+function refetchSoon(sections) {
+  for (const section of sections) wanted.add(section);
+  clearTimeout(refetchTimer);
+  refetchTimer = setTimeout(refreshWanted, REFETCH_DEBOUNCE_MS);
+}
+
+function watch() {
+  if (stream) stream.close();
+  stream = new EventSource("/api/stream");
+  stream.onopen = () => {
+    clearTimeout(pollTimer);
+    refresh();
+  };
+  stream.onerror = schedulePoll;
+  stream.addEventListener("now_playing", (event) => {
+    if (!state) return;
+    state = { ...state, now_playing: JSON.parse(event.data) };
+    renderNowPlaying(state.now_playing);
+  });
+  stream.addEventListener("state", (event) => {
+    const data = JSON.parse(event.data);
+    refetchSoon(data.resync || !data.sections ? ["*"] : data.sections);
+  });
+  for (const [name, sections] of Object.entries(SECTIONS_FOR)) {
+    stream.addEventListener(name, () => refetchSoon(sections));
+  }
+}
+
 async function act(work) {
   try {
     await work();
@@ -557,5 +633,6 @@ if (loginError) {
   window.history.replaceState({}, "", "/");
 }
 
-refresh();
-setInterval(refresh, POLL_MS);
+refresh().then(() => {
+  if (!stream) schedulePoll();
+});
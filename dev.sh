@@ -9,7 +9,7 @@ cleanup() {
 trap cleanup INT TERM
 
 echo "Starting backend on :8000 ..."
-.venv/bin/uvicorn app.main:app --reload --port 8000 &
+.venv/bin/uvicorn app.main:app --reload --port 8000 --timeout-graceful-shutdown 5 &
 BACKEND_PID=$!
 
 echo "Starting frontend on :5173 ..."
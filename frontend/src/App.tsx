@@ -1,6 +1,6 @@
 import { useEffect, useState, useRef, useCallback } from "react"
 import type { AppState } from "@/types"
-import { fetchState, pollState } from "@/api"
+import { fetchState, watchState } from "@/api"
 import { LoginPage } from "@/components/LoginPage"
 import { Dashboard } from "@/components/Dashboard"
 
@@ -21,8 +21,10 @@ export default function App() {
   useEffect(() => {
     if (!mounted.current) {
       mounted.current = true
-      refresh()
-      return pollState((s) => { setState(s); setStale(false) })
+      return watchState(
+        (s) => { setState(s); setStale(false) },
+        () => setStale(true),
+      )
     }
   }, [refresh])
 
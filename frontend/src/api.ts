@@ -3,7 +3,19 @@ import type { AppState, HistoryPage, HistorySummary, StatsPayload } from "@/type
 const POLL_MS = 5000
 
 export async function fetchState(): Promise<AppState> {
-  const res = await fetch("/api/state")
+  // The state is revalidated by ETag, so an unchanged poll is an empty 304 and the
+  // browser hands back its cached copy -- whose now_playing is as old as the copy.
+  // The live panel comes from its own endpoint on every poll instead.
+  const [res, live] = await Promise.all([fetch("/api/state"), fetch("/api/now-playing")])
+  if (!res.ok) throw new Error("Failed to fetch state")
+  const state: AppState = await res.json()
+  if (live.ok) state.now_playing = (await live.json()).now_playing
+  return state
+}
+
+// Only the named sections of the state, to merge into a copy already held.
+export async function fetchSections(sections: string[]): Promise<Partial<AppState>> {
+  const res = await fetch(`/api/state?sections=${sections.join(",")}`)
   if (!res.ok) throw new Error("Failed to fetch state")
   return res.json()
 }
@@ -53,17 +65,91 @@ export async function del(path: string): Promise<void> {
   await fetch(path, { method: "DELETE" })
 }
 
-export function pollState(cb: (state: AppState) => void): () => void {
+// The state sections each pushed event moves. A `state` event names its own.
+const SECTIONS_FOR: Record<string, string[]> = {
+  listen: ["favorites", "stats"],
+  favorites: ["favorites"],
+  sweep: ["discovery"],
+}
+const REFETCH_DEBOUNCE_MS = 250
+
+// Follows the state over /api/stream, polling only while the stream is down -- signed
+// out (the stream answers 401 and stays closed) or between reconnects. Pushed changes
+// refetch just the sections they touched.
+export function watchState(
+  cb: (state: AppState) => void,
+  onError: () => void,
+): () => void {
   let active = true
-  async function tick() {
-    if (!active) return
+  let current: AppState | null = null
+  let source: EventSource | null = null
+  let poll: ReturnType<typeof setTimeout> | undefined
+  let pending: ReturnType<typeof setTimeout> | undefined
+  let wanted = new Set<string>()
+
+  function emit(state: AppState) {
+    current = state
+    if (active) cb(state)
+  }
+
+  async function refetch() {
     try {
-      cb(await fetchState())
-    } catch { /* stale class handled in component */ }
-    if (active) setTimeout(tick, POLL_MS)
+      const state = await fetchState()
+      emit(state)
+      if (state.connected && (!source || source.readyState === EventSource.CLOSED)) open()
+    } catch {
+      if (active) onError()
+    }
+  }
+
+  async function refetchWanted() {
+    const sections = [...wanted]
+    wanted = new Set()
+    if (!current || sections.includes("*")) return refetch()
+    try {
+      const part = await fetchSections(sections)
+      if (!part.connected) return refetch()
+      emit({ ...current, ...part })
+    } catch {
+      if (active) onError()
+    }
+  }
+
+  function want(sections: string[]) {
+    for (const section of sections) wanted.add(section)
+    clearTimeout(pending)
+    pending = setTimeout(refetchWanted, REFETCH_DEBOUNCE_MS)
+  }
+
+  function schedulePoll() {
+    clearTimeout(poll)
+    if (active) poll = setTimeout(async () => { await refetch(); schedulePoll() }, POLL_MS)
+  }
+
+  function open() {
+    source?.close()
+    source = new EventSource("/api/stream")
+    source.onopen = () => { clearTimeout(poll); refetch() }
+    source.onerror = () => schedulePoll()
+    source.addEventListener("now_playing", (e) => {
+      if (current) emit({ ...current, now_playing: JSON.parse((e as MessageEvent).data) })
+    })
+    source.addEventListener("state", (e) => {
+      const data = JSON.parse((e as MessageEvent).data)
+      want(data.resync || !data.sections ? ["*"] : data.sections)
+    })
+    for (const [name, sections] of Object.entries(SECTIONS_FOR)) {
+      source.addEventListener(name, () => want(sections))
+    }
+  }
+
+  refetch().then(() => { if (!source) schedulePoll() })
+  return () => {
+    active = false
+    source?.close()
+    clearTimeout(poll)
+    clearTimeout(pending)
   }
-  tick()
-  return () => { active = false }
 }
 
 export async function fetchStats(): Promise<StatsPayload> {
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""How long a history page takes while trackers are writing.
+
+Stocks a throwaway database with a long history, starts N threads that behave like
+`UserTracker._measure` -- open a listen, rewrite it every poll, close it -- plus one
+that keeps loading the stats page, and times `Database.history` (what `/api/history`
+calls) from another thread while they run. Each configuration runs twice: once with every read behind the writer's lock, the way
+the database used to work, and once on the reader pool.
+
+    bench_history.py [--writers 8] [--listens 50000] [--seconds 10] [--poll-ms 50]
+
+The poll is compressed from five seconds to `--poll-ms` so a few seconds of wall clock
+carry the write load of many users.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.db import READER_POOL_SIZE, Database  # noqa: E402
+
+FERNET_KEY = b"cGxhY2Vob2xkZXJfa2V5X2Zvcl90ZXN0c19vbmx5ISE="
+BASE = 1_700_000_000_000
+ARTISTS = ["Radiohead", "Boards of Canada", "Sigur Rós", "Aphex Twin", "Slowdive"]
+
+
+def stock(db: Database, user_id: int, listens: int) -> None:
+    """Bulk-load closed listens straight through the writer, as a long history would be."""
+    with db.lock:
+        db.conn.executemany(
+            "INSERT OR IGNORE INTO tracks (track_id, name, artist) VALUES (?, ?, ?)",
+            ((f"t{i}", f"Song {i}", ARTISTS[i % len(ARTISTS)]) for i in range(min(listens, 5000))),
+        )
+        db.conn.executemany(
+            """
+            INSERT INTO listens
+                (user_id, track_key, played_at, duration_ms, listened_ms,
+                 completion_ratio, qualified, is_open)
+            SELECT ?, key, ?, 200000, 200000, 1.0, 1, 0 FROM tracks WHERE track_id = ?
+            """,
+            ((user_id, BASE + i * 60_000, f"t{i % 5000}") for i in range(listens)),
+        )
+        db.conn.commit()
+
+
+def writer(db: Database, user_id: int, poll_ms: int, stop: threading.Event) -> None:
+    rng = random.Random(user_id)
+    while not stop.is_set():
+        track_id = f"w{rng.randrange(1000)}"
+        started = int(time.time() * 1000)
+        row_id = db.open_listen(user_id, track_id, "Song", "Artist", started, 200_000, None)
+        for poll in range(1, rng.randrange(3, 12)):
+            if stop.wait(poll_ms / 1000):
+                break
+            db.update_open_listen(row_id, poll * 5_000, poll * 5_000 / 200_000, 200_000)
+        db.close_listen(
+            row_id=row_id, user_id=user_id, track_id=track_id, name="Song", artist="Artist",
+            played_at=started, duration_ms=200_000, listened_ms=150_000,
+            completion_ratio=0.75, qualified=False,
+        )
+
+
+def stats(db: Database, user_id: int, stop: threading.Event) -> None:
+    """The neighbour that keeps loading the stats page alongside the history."""
+    while not stop.is_set():
+        db.get_all_stats(user_id, 5)
+        stop.wait(0.05)
+
+
+def run(readers: int, args: argparse.Namespace) -> list[float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"), FERNET_KEY, "Favourite Songs", readers)
+        try:
+            reader_id = db.upsert_user("reader", "Reader")
+            stock(db, reader_id, args.listens)
+            writer_ids = [db.upsert_user(f"writer{i}", f"Writer {i}") for i in range(args.writers)]
+
+            stop = threading.Event()
+            threads = [
+                threading.Thread(target=writer, args=(db, uid, args.poll_ms, stop), daemon=True)
+                for uid in writer_ids
+            ]
+            threads.append(threading.Thread(target=stats, args=(db, reader_id, stop), daemon=True))
+            for thread in threads:
+                thread.start()
+
+            samples: list[float] = []
+            deadline = time.perf_counter() + args.seconds
+            cursor = None
+            while time.perf_counter() < deadline:
+                began = time.perf_counter()
+                page = db.history(reader_id, cursor=cursor, limit=50)
+                samples.append((time.perf_counter() - began) * 1000)
+                cursor = page["next_cursor"] if random.random() < 0.9 else None
+
+            stop.set()
+            for thread in threads:
+                thread.join()
+            return samples
+        finally:
+            db.close()
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--listens", type=int, default=50_000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--poll-ms", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.listens:,} listens, {args.seconds:.0f}s per run")
+    print(f"{'reads':<22}{'pages':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for label, readers in (("behind writer lock", 0), (f"pool of {READER_POOL_SIZE}", READER_POOL_SIZE)):
+        samples = run(readers, args)
+        print(
+            f"{label:<22}{len(samples):>8}{statistics.median(samples):>10.2f}"
+            f"{percentile(samples, 99):>10.2f}{max(samples):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
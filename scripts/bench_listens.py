@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""The session measurement engine, replayed: polls per second, allocation and DB time.
+
+Every poll of every user goes through `observation_from_playback`, then
+`UserTracker._measure` -- `continues`, `observe` or `start_session`, and `finalize` with
+`close_listen` when a track ends. This generates synthetic playback for N users --
+tracks played through, skipped, seeked forwards and back, paused, replayed from the top,
+playback stopping, podcasts and private sessions -- and replays it a five-second tick
+at a time, every user once per tick, against a throwaway database. Open listens are
+flushed once per tick, as the flusher does every five seconds.
+
+Reported per poll:
+
+  polls/s      wall clock for the whole replay
+  DB ms        time inside the Database calls a poll makes, flushes included
+  statements   SQL statements the writer ran -- machine-independent
+  alloc bytes  Python allocation high-water during a poll, from a separate traced run
+  retained     bytes still allocated after it
+
+and for the engine alone -- `observation_from_playback` and the session functions, no
+tracker and no database, each payload decoded afresh as the HTTP client would -- polls
+per second, the size of one `Observation`, and the bytes an open `Session` holds.
+
+The trace is seeded, so the listens it closes are the same on every run; their digest
+is reported too. `--save-baseline PATH` writes the figures for tests/test_bench_listens.py
+to compare against; `--check PATH` does that comparison here.
+
+    bench_listens.py [--users 2000] [--polls 120] [--traced-users 50] [--seed 0]
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Iterator, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import listens  # noqa: E402
+from app.db import Database  # noqa: E402
+from app.tracker import POLL_INTERVAL_SECONDS, UserTracker  # noqa: E402
+
+FERNET_KEY = b"cGxhY2Vob2xkZXJfa2V5X2Zvcl90ZXN0c19vbmx5ISE="
+BASE = 1_700_000_000_000
+TICK_MS = POLL_INTERVAL_SECONDS * 1000
+ARTISTS = ["Radiohead", "Boards of Canada", "Sigur Rós", "Aphex Twin", "Slowdive"]
+CATALOGUE = 400
+
+# What a seeded replay must reproduce exactly on any machine and any interpreter: the
+# listens it closes, and the SQL it ran to record them. The test suite checks these.
+EXACT = ("polls", "listens", "qualified", "digest", "statements_per_poll")
+
+# How far a measured cost may move from the baseline before `--check` calls it a
+# regression. Sizes and allocation depend on the interpreter the baseline was saved
+# with; wall-clock figures move with the machine, so they're only caught when something
+# got several times slower. Only `--check` compares these, on the machine that saved it.
+TOLERANCE = {
+    "alloc_bytes_per_poll": 1.25,
+    "db_ms_per_poll": 4.0,
+    "polls_per_second": 4.0,
+    "engine_polls_per_second": 4.0,
+    "observation_bytes": 1.0,
+    "session_bytes": 1.25,
+}
+
+# Keyword arguments `replay` takes, saved with the baseline so it is replayed the same.
+CONFIG_KEYS = ("users", "polls", "traced_users", "seed")
+
+# What each of a user's tracks does, and how often.
+BEHAVIOURS = (
+    ("through", 40),
+    ("skip", 20),
+    ("seek_forward", 8),
+    ("seek_back", 6),
+    ("pause", 8),
+    ("replay", 5),
+    ("stop", 5),
+    ("episode", 4),
+    ("private", 4),
+)
+
+
+def _track(rng: random.Random) -> dict[str, Any]:
+    index = rng.randrange(CATALOGUE)
+    return {
+        "id": f"track{index:05d}",
+        "type": "track",
+        "name": f"Song {index}",
+        "duration_ms": 120_000 + (index * 7919) % 300_000,
+        "artists": [{"id": f"artist{index % 5}", "name": ARTISTS[index % len(ARTISTS)]}],
+    }
+
+
+def _playback(item: Optional[dict[str, Any]], progress: int, playing: bool) -> dict[str, Any]:
+    return {
+        "is_playing": playing,
+        "progress_ms": progress,
+        "context": {"uri": "spotify:playlist:37i9dQZEVXcQ9COmYvdajy"},
+        "item": item,
+    }
+
+
+def trace(seed: int) -> Iterator[Optional[dict[str, Any]]]:
+    """One user's `GET /me/player` payloads, a tick apart, forever."""
+    rng = random.Random(seed)
+    names, weights = zip(*BEHAVIOURS)
+    while True:
+        behaviour = rng.choices(names, weights)[0]
+        item = _track(rng)
+        duration = item["duration_ms"]
+        progress = rng.randrange(0, 4_000)
+
+        if behaviour == "stop":
+            for _ in range(rng.randrange(1, 12)):
+                yield None
+            continue
+        if behaviour == "private":
+            for _ in range(rng.randrange(1, 4)):
+                yield _playback(None, 0, True)
+            continue
+        if behaviour == "episode":
+            item = {**item, "id": f"episode{rng.randrange(50)}", "type": "episode"}
+
+        stop_at = duration
+        if behaviour == "skip":
+            stop_at = rng.randrange(5_000, duration)
+        plays = 2 if behaviour == "replay" else 1
+        pause_at = rng.randrange(duration) if behaviour == "pause" else -1
+        seek_at = rng.randrange(duration // 2) if behaviour.startswith("seek") else -1
+
+        for _ in range(plays):
+            while progress < stop_at:
+                yield _playback(item, progress, True)
+                if 0 <= pause_at <= progress:
+                    for _ in range(rng.randrange(1, 20)):
+                        yield _playback(item, progress, False)
+                    pause_at = -1
+                progress += TICK_MS + rng.randrange(-150, 150)
+                if 0 <= seek_at <= progress:
+                    jump = rng.randrange(20_000, 90_000)
+                    progress = (
+                        min(progress + jump, duration - 1)
+                        if behaviour == "seek_forward"
+                        else max(0, progress - jump)
+                    )
+                    seek_at = -1
+            progress = rng.randrange(0, 4_000)
+
+
+class TimedDatabase(Database):
+    """The Database, keeping count of the time spent in the calls a poll makes."""
+
+    TIMED = (
+        "settings", "open_listen", "update_open_listen", "flush_open_listens", "close_listen"
+    )
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.seconds = 0.0
+        self.statements = 0
+        self._depth = 0
+        for name in self.TIMED:
+            setattr(self, name, self._timed(getattr(self, name)))
+
+    def _timed(self, call):
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            # `close_listen` flushes first; that time is counted once, not twice.
+            self._depth += 1
+            began = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self.seconds += time.perf_counter() - began
+
+        return timed
+
+    def count_statement(self, _: str) -> None:
+        self.statements += 1
+
+
+class _NoSpotify:
+    """Stands in for the SpotifyService. With auto-add off, the client is never used."""
+
+    _client: Any = object()
+
+    def client(self, user_id: int) -> Any:
+        return self._client
+
+
+def _setup(db: Database, users: int, seed: int) -> list[tuple[UserTracker, Iterator]]:
+    players = []
+    for index in range(users):
+        user_id = db.upsert_user(f"bench{index}", f"Bench {index}")
+        # Nothing to file anything with: this measures the measuring.
+        db.update_settings(user_id, {"auto_add_enabled": False})
+        tracker = UserTracker(user_id, db, _NoSpotify(), None)  # type: ignore[arg-type]
+        players.append((tracker, trace(seed * 1_000_003 + index)))
+    return players
+
+
+def _poll(tracker: UserTracker, playback: Optional[dict[str, Any]], at: int) -> None:
+    """What `UserTracker._live_poll` does with a payload, less the now-playing summary."""
+    settings = tracker.db.settings(tracker.user_id)
+    obs = listens.observation_from_playback(playback, at)
+    tracker._measure(obs, settings, tracker.spotify.client(tracker.user_id))
+
+
+def digest(db: Database) -> str:
+    """A fingerprint of every listen the replay closed."""
+    rows = db.conn.execute(
+        """
+        SELECT l.user_id, t.track_id, l.played_at, l.duration_ms, l.listened_ms,
+               ROUND(l.completion_ratio, 6), l.qualified
+          FROM listens l JOIN tracks t ON t.key = l.track_key
+         WHERE l.is_open = 0
+         ORDER BY l.user_id, l.played_at, t.track_id
+        """
+    )
+    return hashlib.sha256(repr([tuple(row) for row in rows]).encode()).hexdigest()[:16]
+
+
+def _timed_run(users: int, polls: int, seed: int) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        # The flusher's thread never fires here; the loop flushes once a tick instead,
+        # so the statement count doesn't depend on how fast the machine is.
+        db = TimedDatabase(
+            os.path.join(tmp, "bench.db"), FERNET_KEY, "Favourite Songs", flush_interval=3600
+        )
+        try:
+            players = _setup(db, users, seed)
+            db.seconds = 0.0
+            db.conn.set_trace_callback(db.count_statement)
+            began = time.perf_counter()
+            for tick in range(polls):
+                at = BASE + tick * TICK_MS
+                for tracker, payloads in players:
+                    _poll(tracker, next(payloads), at)
+                db.flush_open_listens()
+            for tracker, _ in players:
+                tracker.flush()
+            wall = time.perf_counter() - began
+            db.conn.set_trace_callback(None)
+
+            total = users * polls
+            closed, qualified = db.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(qualified), 0) FROM listens WHERE is_open = 0"
+            ).fetchone()
+            return {
+                "polls": total,
+                "listens": closed,
+                "qualified": qualified,
+                "digest": digest(db),
+                "polls_per_second": round(total / wall),
+                "db_ms_per_poll": round(db.seconds / total * 1000, 4),
+                "statements_per_poll": round(db.statements / total, 4),
+            }
+        finally:
+            db.close()
+
+
+def _traced_run(users: int, polls: int, seed: int) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(
+            os.path.join(tmp, "bench.db"), FERNET_KEY, "Favourite Songs", flush_interval=3600
+        )
+        try:
+            players = _setup(db, users, seed)
+            # Warm up first, so caches filling once don't count against every poll.
+            for tracker, payloads in players:
+                _poll(tracker, next(payloads), BASE)
+            gc.collect()
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                high = 0
+                for tick in range(1, polls):
+                    at = BASE + tick * TICK_MS
+                    for tracker, payloads in players:
+                        playback = next(payloads)
+                        tracemalloc.reset_peak()
+                        before = tracemalloc.get_traced_memory()[0]
+                        _poll(tracker, playback, at)
+                        high += tracemalloc.get_traced_memory()[1] - before
+                    db.flush_open_listens()
+                gc.collect()
+                retained = tracemalloc.get_traced_memory()[0] - start
+            finally:
+                tracemalloc.stop()
+            total = users * (polls - 1)
+            return {
+                "alloc_bytes_per_poll": round(high / total),
+                "retained_bytes_per_poll": round(retained / total, 2),
+            }
+        finally:
+            db.close()
+
+
+def _engine(users: int, polls: int, seed: int) -> tuple[float, list]:
+    """The engine alone: no tracker, no database. Returns the seconds it spent and the
+    sessions still open at the end."""
+    traces = [trace(seed * 1_000_003 + index) for index in range(users)]
+    sessions: list[Optional[listens.Session]] = [None] * users
+    busy = 0.0
+    for tick in range(polls):
+        at = BASE + tick * TICK_MS
+        # Decoded afresh, untimed, as the HTTP client hands each poll over: no string is
+        # shared with the last poll's.
+        batch = [json.loads(json.dumps(next(payloads))) for payloads in traces]
+        began = time.perf_counter()
+        for index, playback in enumerate(batch):
+            obs = listens.observation_from_playback(playback, at)
+            session = sessions[index]
+            if session is not None and (obs is None or not listens.continues(session, obs)):
+                listens.finalize(session, at)
+                session = None
+            if obs is not None:
+                if session is None:
+                    session = listens.start_session(obs)
+                else:
+                    listens.observe(session, obs)
+            sessions[index] = session
+        busy += time.perf_counter() - began
+    return busy, sessions
+
+
+def _size(instance: Any) -> int:
+    return sys.getsizeof(instance) + sys.getsizeof(getattr(instance, "__dict__", None) or ())
+
+
+def _engine_run(users: int, polls: int, seed: int) -> dict[str, Any]:
+    busy, sessions = _engine(users, polls, seed)
+    open_sessions = [session for session in sessions if session is not None]
+    obs = listens.observation_from_playback(next(trace(seed)), BASE)
+
+    # Again, traced, to see what the sessions left open hold between polls -- their
+    # strings included, less whatever they share with each other.
+    del sessions, open_sessions
+    gc.collect()
+    tracemalloc.start()
+    try:
+        _, sessions = _engine(users, polls, seed)
+        open_count = sum(session is not None for session in sessions)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0]
+        del sessions
+        gc.collect()
+        held -= tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {
+        "engine_polls_per_second": round(users * polls / busy),
+        "observation_bytes": _size(obs),
+        "session_bytes": round(held / max(open_count, 1)),
+    }
+
+
+def replay(users: int, polls: int, traced_users: int, seed: int = 0) -> dict[str, Any]:
+    """Replay `polls` ticks of `users` users, plus a traced run of `traced_users`, plus
+    the engine on its own."""
+    return {
+        **_timed_run(users, polls, seed),
+        **_traced_run(min(users, traced_users), polls, seed),
+        **_engine_run(users, polls, seed),
+    }
+
+
+def mismatches(measured: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+    """Which of the `EXACT` figures differ from `baseline`. Empty if none do."""
+    return [
+        f"{key}: {measured[key]!r}, baseline {baseline[key]!r}"
+        for key in EXACT
+        if measured[key] != baseline[key]
+    ]
+
+
+def regressions(measured: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+    """How `measured` differs from `baseline`, or costs more beyond `TOLERANCE`."""
+    found = mismatches(measured, baseline)
+    for key, factor in TOLERANCE.items():
+        worse = (
+            measured[key] * factor < baseline[key]
+            if key == "polls_per_second"
+            else measured[key] > baseline[key] * factor
+        )
+        if worse:
+            found.append(f"{key}: {measured[key]}, baseline {baseline[key]} (x{factor} allowed)")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--polls", type=int, default=120)
+    parser.add_argument("--traced-users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--check", metavar="PATH", help="compare with a saved baseline")
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in CONFIG_KEYS}
+    if args.check:
+        with open(args.check, encoding="utf-8") as handle:
+            saved = json.load(handle)
+        config = saved["config"]
+    measured = replay(**config)
+
+    print(
+        f"{config['users']} users x {config['polls']} polls, "
+        f"{measured['listens']} listens closed ({measured['qualified']} qualified)"
+    )
+    print(f"{'polls/s':>10}{'DB ms':>9}{'statements':>12}{'alloc bytes':>13}{'retained':>10}")
+    print(
+        f"{measured['polls_per_second']:>10}{measured['db_ms_per_poll']:>9.3f}"
+        f"{measured['statements_per_poll']:>12.2f}{measured['alloc_bytes_per_poll']:>13}"
+        f"{measured['retained_bytes_per_poll']:>10.1f}"
+    )
+    print(f"{'engine alone':<14}{'polls/s':>10}{'Observation':>13}{'open Session':>14}")
+    print(
+        f"{'':<14}{measured['engine_polls_per_second']:>10}"
+        f"{measured['observation_bytes']:>13}{measured['session_bytes']:>14}"
+    )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as handle:
+            json.dump({"config": config, "metrics": measured}, handle, indent=2)
+            handle.write("\n")
+        print(f"baseline saved to {args.save_baseline}")
+    if args.check:
+        found = regressions(measured, saved["metrics"])
+        for line in found:
+            print(f"regression: {line}")
+        if found:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
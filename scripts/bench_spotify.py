@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Playback polls per second against a local fake Spotify, with and without pooling.
+
+Starts a TLS server in a separate process that answers `GET /v1/me/player` the way
+Spotify does, then drives it from a handful of threads standing in for the poll
+scheduler's workers, each polling on behalf of several users:
+
+  fresh client   a new spotipy client per poll, as `SpotifyService.client` used to
+                 build -- so a new session, and a new TCP + TLS handshake, every time
+  pooled client  `SpotifyService.client` now: one client per user on a shared
+                 keep-alive session
+
+CPU per poll is this process's CPU time only; the server's is not counted.
+
+    bench_spotify.py [--users 50] [--workers 8] [--seconds 5]
+"""
+
+import argparse
+import datetime
+import ipaddress
+import json
+import multiprocessing
+import os
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import spotipy  # noqa: E402
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+from app.spotify import REQUEST_TIMEOUT, SpotifyService  # noqa: E402
+
+PLAYBACK = json.dumps(
+    {
+        "is_playing": True,
+        "progress_ms": 61_000,
+        "context": {"uri": "spotify:playlist:37i9dQZEVXcQ9COmYvdajy"},
+        "item": {
+            "id": "4iV5W9uYEdYUVa79Axb7Rh",
+            "type": "track",
+            "name": "Weird Fishes / Arpeggi",
+            "duration_ms": 318_000,
+            "artists": [{"id": "4Z8W4fKeB5YxbusRsdQVPb", "name": "Radiohead"}],
+        },
+    }
+).encode()
+
+
+def self_signed(directory: str) -> tuple[str, str]:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(hours=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as handle:
+        handle.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as handle:
+        handle.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+class FakeSpotify(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real API offers
+
+    def do_GET(self) -> None:  # noqa: N802 -- http.server's naming
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(PLAYBACK)))
+        self.end_headers()
+        self.wfile.write(PLAYBACK)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def serve(cert_path: str, key_path: str, port: "multiprocessing.Value") -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSpotify)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+class BenchService(SpotifyService):
+    """The real client cache and session, with the token lookup stubbed out."""
+
+    def __init__(self, prefix: str, cert_path: str) -> None:
+        super().__init__(config=None, db=None)  # type: ignore[arg-type]
+        self.session.verify = cert_path
+        self.prefix = prefix
+
+    def access_token(self, user_id: int) -> str:
+        return f"token-{user_id}"
+
+    def client(self, user_id: int) -> spotipy.Spotify:
+        client = super().client(user_id)
+        client.prefix = self.prefix
+        return client
+
+
+def fresh_client(prefix: str):
+    def client(user_id: int) -> spotipy.Spotify:
+        instance = spotipy.Spotify(auth=f"token-{user_id}", requests_timeout=REQUEST_TIMEOUT, retries=0)
+        instance.prefix = prefix
+        return instance
+
+    return client
+
+
+def run(client_for, args: argparse.Namespace) -> tuple[int, float, float]:
+    stop = threading.Event()
+    counts = [0] * args.workers
+
+    def worker(index: int) -> None:
+        users = list(range(index, args.users, args.workers))
+        while not stop.is_set():
+            for user_id in users:
+                client_for(user_id).current_playback()
+                counts[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.workers)]
+    cpu, wall = time.process_time(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    polls = sum(counts)
+    return polls, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_path, key_path = self_signed(tmp)
+        port = multiprocessing.Value("i", 0)
+        server = multiprocessing.Process(target=serve, args=(cert_path, key_path, port), daemon=True)
+        server.start()
+        try:
+            while not port.value:
+                time.sleep(0.01)
+            prefix = f"https://127.0.0.1:{port.value}/v1/"
+            # The fresh clients build their own sessions, which only trust the CA bundle.
+            os.environ["REQUESTS_CA_BUNDLE"] = cert_path
+
+            print(f"{args.users} users, {args.workers} workers, {args.seconds:.0f}s per run")
+            print(f"{'':<16}{'polls':>8}{'polls/s':>10}{'CPU ms/poll':>13}")
+            for label, client_for in (
+                ("fresh client", fresh_client(prefix)),
+                ("pooled client", BenchService(prefix, cert_path).client),
+            ):
+                polls, wall, cpu = run(client_for, args)
+                print(f"{label:<16}{polls:>8}{polls / wall:>10.0f}{cpu / polls * 1000:>13.3f}")
+        finally:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,10 @@ downtime, and produces a standalone file with no sidecars.
     dbtool.py backup  --db PATH --into DIR [--keep N]   # prints the backup path
     dbtool.py check   --db PATH                         # prints a JSON summary
     dbtool.py restore --backup PATH --db PATH
+    dbtool.py rebuild-stats --db PATH [--user ID]       # recompute the stats rollup
+    dbtool.py import-history --db PATH --user ID FILE...  # Spotify streaming-history JSON
+    dbtool.py verify-counts --db PATH [--repair]        # play_counts against listens
+    dbtool.py rebuild-counts --db PATH                  # recount play_counts online
 """
 
 import argparse
@@ -24,6 +28,10 @@ import sys
 import time
 from pathlib import Path
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import importer, stats, tally  # noqa: E402 -- stdlib-only, like this script
+
 # What must survive an update no matter what. Listens can be re-accumulated and the
 # discovery archive can be re-swept, but a lost token means every user re-authorises,
 # and a lost user row means their history is orphaned.
@@ -145,6 +153,88 @@ def cmd_restore(args: argparse.Namespace) -> None:
     log(f"restored {db} from {backup.name} ({summary['counts']})")
 
 
+def cmd_rebuild_stats(args: argparse.Namespace) -> None:
+    if not Path(args.db).exists():
+        raise SystemExit(f"no database at {args.db}")
+    # The app may be running: wait for its writer rather than failing on a busy database.
+    # One transaction, so the pages being served never see the rollup half-rebuilt.
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        with conn:
+            users = stats.rebuild(conn, args.user)
+    except sqlite3.OperationalError as exc:
+        # Most likely a database from before the rollup, which the app builds on start.
+        raise SystemExit(f"cannot rebuild stats in {args.db}: {exc}") from exc
+    finally:
+        conn.close()
+    log(f"rebuilt the stats rollup for {users} user(s)")
+
+
+def cmd_import_history(args: argparse.Namespace) -> None:
+    if not Path(args.db).exists():
+        raise SystemExit(f"no database at {args.db}")
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        if not conn.execute("SELECT 1 FROM users WHERE id = ?", (args.user,)).fetchone():
+            raise SystemExit(f"no user {args.user} in {args.db}")
+        # No Web API here: plays of a track with no known length are kept but not counted.
+        summary = {"entries": 0, "plays": 0, "imported": 0}
+        for path in args.files:
+            with open(path, "rb") as stream:
+                result = importer.import_streams(conn, args.user, [stream])
+            log(f"{path}: {result}")
+            for key in summary:
+                summary[key] += result[key]
+    except sqlite3.OperationalError as exc:
+        # Most likely a database the app hasn't migrated to `origin` yet.
+        raise SystemExit(f"cannot import into {args.db}: {exc}") from exc
+    except ValueError as exc:
+        raise SystemExit(f"cannot import: {exc}") from exc
+    finally:
+        conn.close()
+    print(json.dumps(summary))
+
+
+def cmd_verify_counts(args: argparse.Namespace) -> None:
+    if not Path(args.db).exists():
+        raise SystemExit(f"no database at {args.db}")
+    # Autocommit, so each chunk's BEGIN is its own snapshot and nothing else is held.
+    conn = sqlite3.connect(args.db, timeout=30, isolation_level=None)
+    try:
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        drifted = []
+        for start in range(0, len(user_ids), tally.VERIFY_CHUNK_USERS):
+            conn.execute("BEGIN")
+            try:
+                drifted += tally.drifted(conn, user_ids[start : start + tally.VERIFY_CHUNK_USERS])
+            finally:
+                conn.execute("ROLLBACK")
+        summary = {"users": len(user_ids), "drifted": drifted}
+        if args.repair and drifted:
+            summary["rows"] = tally.repair(conn, drifted)
+    except sqlite3.OperationalError as exc:
+        raise SystemExit(f"cannot verify play counts in {args.db}: {exc}") from exc
+    finally:
+        conn.close()
+    print(json.dumps(summary))
+    if drifted and not args.repair:
+        raise SystemExit(f"play counts disagree with listens for {len(drifted)} user(s)")
+
+
+def cmd_rebuild_counts(args: argparse.Namespace) -> None:
+    if not Path(args.db).exists():
+        raise SystemExit(f"no database at {args.db}")
+    # A chunk of users per transaction: the app, if it's running, writes in between.
+    conn = sqlite3.connect(args.db, timeout=30, isolation_level=None)
+    try:
+        rows = tally.rebuild(conn)
+    except sqlite3.OperationalError as exc:
+        raise SystemExit(f"cannot rebuild play counts in {args.db}: {exc}") from exc
+    finally:
+        conn.close()
+    log(f"recounted {rows} play count row(s)")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description=__doc__)
     sub = parser.add_subparsers(dest="command", required=True)
@@ -164,6 +254,26 @@ def main() -> None:
     restore.add_argument("--db", required=True)
     restore.set_defaults(func=cmd_restore)
 
+    rebuild = sub.add_parser("rebuild-stats")
+    rebuild.add_argument("--db", required=True)
+    rebuild.add_argument("--user", type=int, help="one user's id; everyone by default")
+    rebuild.set_defaults(func=cmd_rebuild_stats)
+
+    imports = sub.add_parser("import-history")
+    imports.add_argument("--db", required=True)
+    imports.add_argument("--user", type=int, required=True, help="the user's id")
+    imports.add_argument("files", nargs="+", help="Streaming_History_Audio_*.json")
+    imports.set_defaults(func=cmd_import_history)
+
+    verify = sub.add_parser("verify-counts")
+    verify.add_argument("--db", required=True)
+    verify.add_argument("--repair", action="store_true", help="recount the users that drifted")
+    verify.set_defaults(func=cmd_verify_counts)
+
+    recount = sub.add_parser("rebuild-counts")
+    recount.add_argument("--db", required=True)
+    recount.set_defaults(func=cmd_rebuild_counts)
+
     args = parser.parse_args()
     args.func(args)
 
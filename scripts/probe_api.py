@@ -129,6 +129,20 @@ def main() -> int:
                 f"to confirm discovery capture can see it."
             )
 
+    if seed_track:
+        print("\nAI filtering")
+        single = session.get(f"{API}/tracks/{seed_track}", timeout=20)
+        check("GET /tracks/{id}", single, {200})
+        several = session.get(f"{API}/tracks", params={"ids": seed_track}, timeout=20)
+        check(
+            "GET /tracks?ids=",
+            several,
+            {200, 403},
+            "403: the sweep will resolve artists one track at a time instead."
+            if several.status_code == 403
+            else "",
+        )
+
     print("\nPlaylists")
     mine = session.get(f"{API}/me/playlists", params={"limit": 50}, timeout=20)
     check("GET /me/playlists", mine, {200})
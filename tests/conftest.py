@@ -9,6 +9,8 @@ import pytest
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
+from app import discovery as discovery_mod  # noqa: E402
+from app import sweeps as sweeps_mod  # noqa: E402
 from app import tracker as tracker_mod  # noqa: E402
 from app.aiblocklist import AiBlocklist  # noqa: E402
 from app.db import Database  # noqa: E402
@@ -121,6 +123,13 @@ class FakeSpotify:
 
     def track(self, track_id, market=None):
         self.calls.append("track")
+        return self._track(track_id)
+
+    def tracks(self, tracks, market=None):
+        self.calls.append("tracks")
+        return {"tracks": [self._track(track_id) for track_id in tracks]}
+
+    def _track(self, track_id):
         ids = self.track_artists.get(track_id, [f"artist-of-{track_id}"])
         return {"id": track_id, "artists": [{"id": i, "name": i} for i in ids]}
 
@@ -162,6 +171,19 @@ class FakeSpotify:
         self.playlists[pid] = {"name": name, "public": public, "tracks": []}
         return {"id": pid, "name": name}
 
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=("track",)):
+        self.calls.append("playlist")
+        return {"snapshot_id": self.snapshot(playlist_id)}
+
+    def snapshot(self, playlist_id) -> str:
+        return f"snap{self.playlists[playlist_id].get('version', 0)}"
+
+    def edited(self, playlist_id) -> dict:
+        """Record an edit the way Spotify does: a new snapshot, which the response carries."""
+        data = self.playlists[playlist_id]
+        data["version"] = data.get("version", 0) + 1
+        return {"snapshot_id": self.snapshot(playlist_id)}
+
     def playlist_items(self, playlist_id, fields=None, limit=50, offset=0, market=None,
                        additional_types=("track", "episode")):
         self.calls.append("playlist_items")
@@ -176,14 +198,14 @@ class FakeSpotify:
         data = self.playlists[playlist_id]
         ids = [i.split(":")[-1] for i in items]
         data["tracks"] = (ids + data["tracks"]) if position == 0 else (data["tracks"] + ids)
-        return {"snapshot_id": "x"}
+        return self.edited(playlist_id)
 
     def playlist_remove_all_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
         self.calls.append("playlist_remove")
         ids = {i.split(":")[-1] for i in items}
         data = self.playlists[playlist_id]
         data["tracks"] = [tid for tid in data["tracks"] if tid not in ids]
-        return {"snapshot_id": "x"}
+        return self.edited(playlist_id)
 
     def next(self, result):
         return None
@@ -197,6 +219,22 @@ class FakeService(SpotifyService):
         return self.fake
 
 
+@pytest.fixture(autouse=True)
+def fresh_embed_cache():
+    """The embed cache is process-wide; no test should see a page another one read."""
+    discovery_mod.embed_cache.clear()
+    yield
+    discovery_mod.embed_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def unpaced_budget(monkeypatch) -> "sweeps_mod.RateBudget":
+    """A budget of its own for each test, counted as usual but never slept off."""
+    budget = sweeps_mod.RateBudget(sleep=lambda seconds: None)
+    monkeypatch.setattr(sweeps_mod, "budget", budget)
+    return budget
+
+
 @pytest.fixture
 def db(tmp_path) -> Database:
     database = Database(str(tmp_path / "test.db"), FERNET_KEY, "Favourite Songs")
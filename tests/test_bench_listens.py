@@ -0,0 +1,49 @@
+"""The session measurement engine against its saved baseline (scripts/bench_listens.py).
+
+The replay is seeded, so what it closes is compared exactly: a change to the numbers a
+listen is recorded with shows up as a different digest, whether or not it was meant
+to, and a change to the SQL a poll runs as a different statement count. Timings, sizes
+and allocation depend on the machine and the interpreter, so they aren't compared
+here; `scripts/bench_listens.py --check tests/baselines/bench_listens.json` does that,
+on the machine the baseline was saved on. After a deliberate change, refresh it:
+
+    scripts/bench_listens.py --users 100 --polls 120 --traced-users 30 \\
+        --save-baseline tests/baselines/bench_listens.json
+"""
+
+import importlib.util
+import itertools
+import json
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / "baselines" / "bench_listens.json"
+
+_spec = importlib.util.spec_from_file_location(
+    "bench_listens", REPO / "scripts" / "bench_listens.py"
+)
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+
+def test_the_trace_has_every_kind_of_playback():
+    payloads = list(itertools.islice(bench.trace(0), 5000))
+    items = [p["item"] for p in payloads if p]
+
+    assert None in payloads  # playback stopped
+    assert any(item is None for item in items)  # a private session
+    assert any(item and item["type"] == "episode" for item in items)
+    assert any(p and not p["is_playing"] for p in payloads)
+    steps = [
+        b["progress_ms"] - a["progress_ms"]
+        for a, b in zip(payloads, payloads[1:])
+        if a and b and a["item"] and b["item"] and a["item"]["id"] == b["item"]["id"]
+    ]
+    assert max(steps) > 20_000  # seeked forward
+    assert min(steps) < -20_000  # seeked back, or replayed from the top
+
+
+def test_the_replay_records_the_same_listens_with_the_same_statements():
+    saved = json.loads(BASELINE.read_text(encoding="utf-8"))
+    measured = bench.replay(**saved["config"])
+    assert bench.mismatches(measured, saved["metrics"]) == []
@@ -7,6 +7,7 @@ Spotify's public embed page and falls back to capturing what actually gets playe
 import json
 
 import pytest
+import spotipy
 
 from app import discovery as discovery_mod
 from app.discovery import (
@@ -17,6 +18,8 @@ from app.discovery import (
     playlist_id_from_link,
     read_playlist_embed,
 )
+from app.tracker import UserTracker
+from conftest import FakeService
 
 
 def embed_html(name="Discover Weekly", tracks=(("t1", "Song One", "Band One"),)):
@@ -50,9 +53,10 @@ def embed_html(name="Discover Weekly", tracks=(("t1", "Song One", "Band One"),))
 
 
 class FakeResponse:
-    def __init__(self, text, status=200):
+    def __init__(self, text, status=200, headers=None):
         self.text = text
         self.status_code = status
+        self.headers = headers or {}
 
     def raise_for_status(self):
         if self.status_code >= 400:
@@ -128,9 +132,96 @@ def test_read_playlist_embed_raises_when_the_page_changes(monkeypatch, body, mat
         read_playlist_embed("dw123")
 
 
+def test_an_embed_read_is_shared_until_it_goes_stale(monkeypatch):
+    html = embed_html(tracks=[("t1", "Song", "Band")])
+    requests_seen = []
+
+    def get(url, **kwargs):
+        requests_seen.append(kwargs["headers"])
+        if kwargs["headers"].get("If-None-Match") == '"v1"':
+            return FakeResponse("", status=304)
+        return FakeResponse(html, headers={"ETag": '"v1"'})
+
+    monkeypatch.setattr(discovery_mod.requests, "get", get)
+    first = read_playlist_embed("dw123")
+    assert read_playlist_embed("dw123") is first
+    assert len(requests_seen) == 1
+
+    # Stale: revalidated with the ETag, and the 304 keeps the parsed copy.
+    monkeypatch.setattr(discovery_mod, "EMBED_TTL_SECONDS", 0)
+    assert read_playlist_embed("dw123") is first
+    assert requests_seen[-1]["If-None-Match"] == '"v1"'
+    assert first["digest"] == discovery_mod.tracks_digest(first["tracks"])
+
+
 # ------------------------------------------------------------------- sweep
 
 
+def test_an_unchanged_source_skips_the_whole_pipeline(tracker, spotify, db, user_id, monkeypatch):
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["t1", "t2"]))
+    assert tracker.sweep_sources(spotify)["archived"] == 2
+
+    checked = []
+    original = db.unseen_this_month
+    monkeypatch.setattr(
+        db, "unseen_this_month", lambda *args: checked.append(args[2]) or original(*args)
+    )
+    assert tracker.sweep_sources(spotify)["archived"] == 0
+    assert checked == []
+
+    # A new list is worked through again -- only its new track is archived.
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["t1", "t2", "t3"]))
+    assert tracker.sweep_sources(spotify)["archived"] == 1
+    assert checked == [["t1", "t2", "t3"]]
+
+
+class CountingLock:
+    def __init__(self, lock):
+        self.lock = lock
+        self.acquired = 0
+
+    def __enter__(self):
+        self.acquired += 1
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc):
+        return self.lock.__exit__(*exc)
+
+
+def test_a_sweep_takes_the_writer_a_fixed_number_of_times(
+    tracker, spotify, db, user_id, monkeypatch
+):
+    """However long the list, the ledgers are checked in one query and written in one
+    transaction each -- not a lock and a commit per track."""
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    spotify.track_artists = {f"bot{i}": ["aiartist-known"] for i in range(5)}
+
+    db.lock = CountingLock(db.lock)
+
+    def sweep_of(count, month):
+        ids = [f"{month}-{i}" for i in range(count)] + [f"bot{i}" for i in range(5)]
+        monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(ids))
+        monkeypatch.setattr(discovery_mod, "month_key", lambda: month)
+        before = db.lock.acquired
+        summary = tracker.sweep_sources(spotify)
+        assert summary["archived"] == count and summary["blocked"] == 5
+        return db.lock.acquired - before
+
+    assert sweep_of(3, "2099-01") == sweep_of(40, "2099-02")
+
+
+def test_the_digest_only_holds_for_the_month_it_was_swept_into(
+    tracker, spotify, db, user_id, monkeypatch
+):
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["t1"]))
+    tracker.sweep_sources(spotify)
+
+    monkeypatch.setattr(discovery_mod, "month_key", lambda: "2099-01")
+    assert tracker.sweep_sources(spotify)["archived"] == 1
+
+
 def test_sweep_archives_every_track_from_the_source(tracker, spotify, db, user_id, monkeypatch):
     db.add_discovery_source(user_id, "dw123", "Discover Weekly")
     monkeypatch.setattr(
@@ -170,6 +261,61 @@ def test_sweep_is_idempotent(tracker, spotify, db, user_id, monkeypatch):
     assert next(iter(spotify.playlists.values()))["tracks"] == ["t1"]
 
 
+def lookup_calls(spotify) -> int:
+    return spotify.calls.count("track") + spotify.calls.count("tracks")
+
+
+def weekly(tracks):
+    return lambda pid: {
+        "name": "Discover Weekly",
+        "tracks": [{"track_id": t, "name": f"Song {t}", "artist": f"Band {t}"} for t in tracks],
+    }
+
+
+def test_artists_are_resolved_fifty_tracks_to_a_request(tracker, spotify, db, user_id, monkeypatch):
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(f"t{i}" for i in range(60)))
+
+    assert tracker.sweep_sources(spotify)["archived"] == 60
+    assert spotify.calls.count("tracks") == 2
+    assert spotify.calls.count("track") == 0
+
+
+def test_a_track_is_resolved_once_for_everyone(db, spotify, blocklist, monkeypatch):
+    """Two people with the same track in their Discover Weekly cost one lookup."""
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["shared", "own"]))
+    for n in range(2):
+        user_id = db.upsert_user(f"u{n}", f"User {n}")
+        db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+        UserTracker(user_id, db, FakeService(spotify), blocklist).sweep_sources(spotify)
+        monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["shared", "theirs"]))
+
+    assert lookup_calls(spotify) == 2
+    assert set(db.track_artists(["shared", "own", "theirs"])) == {"shared", "own", "theirs"}
+
+
+def test_without_the_batch_endpoint_tracks_are_resolved_one_by_one(
+    tracker, spotify, db, user_id, monkeypatch
+):
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    spotify.track_artists = {"bot": ["aiartist-known"]}
+
+    def gone(track_ids, market=None):
+        spotify.calls.append("tracks")
+        raise spotipy.SpotifyException(403, -1, "Forbidden")
+
+    monkeypatch.setattr(spotify, "tracks", gone)
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["good", "bot"]))
+
+    assert tracker.sweep_sources(spotify)["blocked"] == 1
+    assert spotify.calls.count("track") == 2
+
+    # Once refused, the batch endpoint isn't asked again.
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", weekly(["next"]))
+    tracker.sweep_sources(spotify)
+    assert spotify.calls.count("tracks") == 1
+
+
 def test_sweep_filters_ai_artists_by_id(tracker, spotify, db, user_id, monkeypatch):
     db.add_discovery_source(user_id, "dw123", "Discover Weekly")
     spotify.track_artists = {
@@ -213,9 +359,10 @@ def test_a_blocked_track_is_not_re_checked_next_sweep(tracker, spotify, db, user
     )
 
     tracker.sweep_sources(spotify)
-    lookups = spotify.calls.count("track")
+    lookups = lookup_calls(spotify)
+    assert lookups == 1
     tracker.sweep_sources(spotify)
-    assert spotify.calls.count("track") == lookups
+    assert lookup_calls(spotify) == lookups
 
 
 def test_name_match_catches_tracks_whose_artists_cannot_be_resolved(
@@ -223,10 +370,11 @@ def test_name_match_catches_tracks_whose_artists_cannot_be_resolved(
 ):
     db.add_discovery_source(user_id, "dw123", "Discover Weekly")
 
-    def unresolvable(track_id, market=None):
+    def unresolvable(track_ids, market=None):
         raise RuntimeError("track lookup failed")
 
     monkeypatch.setattr(spotify, "track", unresolvable)
+    monkeypatch.setattr(spotify, "tracks", unresolvable)
     monkeypatch.setattr(
         discovery_mod,
         "read_playlist_embed",
@@ -0,0 +1,213 @@
+"""Pushed changes: the hub's fan-out and coalescing, and what the tracker publishes."""
+
+import asyncio
+
+import pytest
+
+from app import events as events_mod
+from app.events import EventHub, Subscriber, format_event
+
+from conftest import playback
+
+
+class RecordingHub:
+    """Stands in for the hub where only what was published matters."""
+
+    def __init__(self) -> None:
+        self.published: list[tuple[int, str, object]] = []
+
+    def publish(self, user_id, event, data=None) -> None:
+        self.published.append((user_id, event, data))
+
+    def names(self) -> list[str]:
+        return [event for _, event, _ in self.published]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+# ----------------------------------------------------------------------- hub
+
+
+def test_every_tab_a_user_has_open_gets_the_event():
+    async def scenario():
+        hub = EventHub()
+        hub.bind(asyncio.get_running_loop())
+        async with hub.subscribe(1) as a, hub.subscribe(1) as b, hub.subscribe(2) as other:
+            hub.publish(1, "listen", {"track_id": "t1"})
+            await asyncio.sleep(0)
+            assert await a.next() == ("listen", {"track_id": "t1"})
+            assert await b.next() == ("listen", {"track_id": "t1"})
+            assert other.queue.empty()
+            assert hub.stats() == {"users": 2, "streams": 3}
+        assert hub.stats() == {"users": 0, "streams": 0}
+
+    run(scenario())
+
+
+def test_publishing_from_a_worker_thread_reaches_the_loop():
+    async def scenario():
+        hub = EventHub()
+        hub.bind(asyncio.get_running_loop())
+        async with hub.subscribe(1) as tab:
+            await asyncio.to_thread(hub.publish, 1, "sweep", {"archived": 2})
+            assert await asyncio.wait_for(tab.next(), 1) == ("sweep", {"archived": 2})
+
+    run(scenario())
+
+
+def test_a_newer_now_playing_replaces_one_still_queued():
+    tab = Subscriber(1, asyncio.Queue(events_mod.QUEUE_SIZE))
+    tab.deliver("now_playing", {"progress_ms": 1000})
+    tab.deliver("listen", {"track_id": "t1"})
+    tab.deliver("now_playing", {"progress_ms": 2000})
+
+    assert tab.queue.qsize() == 2
+    assert run(tab.next()) == ("now_playing", {"progress_ms": 2000})
+    assert run(tab.next()) == ("listen", {"track_id": "t1"})
+
+
+def test_coalesced_state_touches_keep_every_section_named():
+    tab = Subscriber(1, asyncio.Queue(events_mod.QUEUE_SIZE))
+    tab.deliver("state", {"version": 4, "sections": ["favorites"]})
+    tab.deliver("state", {"version": 5, "sections": ["discovery", "favorites"]})
+
+    assert tab.queue.qsize() == 1
+    assert run(tab.next()) == ("state", {"version": 5, "sections": ["favorites", "discovery"]})
+
+
+def test_a_resync_wins_the_merge_and_stays_won():
+    tab = Subscriber(1, asyncio.Queue(events_mod.QUEUE_SIZE))
+    tab.deliver("state", {"version": 4, "sections": ["favorites"]})
+    tab.deliver("state", {"resync": True})
+    tab.deliver("state", {"version": 6, "sections": ["stats"]})
+
+    assert run(tab.next()) == ("state", {"resync": True})
+
+
+def test_a_touch_naming_no_sections_means_all_of_them():
+    tab = Subscriber(1, asyncio.Queue(events_mod.QUEUE_SIZE))
+    tab.deliver("state", {"version": 4, "sections": ["favorites"]})
+    tab.deliver("state", {"version": 5})
+
+    assert run(tab.next()) == ("state", {"version": 5})
+
+
+def test_a_tab_too_far_behind_is_told_to_resync():
+    tab = Subscriber(1, asyncio.Queue(3))
+    for i in range(4):
+        tab.deliver("listen", {"n": i})
+
+    assert tab.queue.qsize() == 1
+    assert run(tab.next()) == ("state", {"resync": True})
+
+
+def test_closing_the_hub_ends_the_stream():
+    async def scenario():
+        hub = EventHub()
+        hub.bind(asyncio.get_running_loop())
+        body = events_mod.stream(hub, 1, ("now_playing", None))
+        assert await body.__anext__() == f"retry: {events_mod.RETRY_MS}\n\n"
+        assert await body.__anext__() == format_event("now_playing", None)
+
+        hub.publish(1, "favorites", {"added": 1})
+        assert await body.__anext__() == 'event: favorites\ndata: {"added":1}\n\n'
+        hub.close()
+        with pytest.raises(StopAsyncIteration):
+            await body.__anext__()
+        assert hub.stats()["streams"] == 0
+
+    run(scenario())
+
+
+def test_an_idle_stream_sends_keepalives(monkeypatch):
+    monkeypatch.setattr(events_mod, "KEEPALIVE_SECONDS", 0.01)
+
+    async def scenario():
+        hub = EventHub()
+        hub.bind(asyncio.get_running_loop())
+        body = events_mod.stream(hub, 1)
+        await body.__anext__()
+        assert await body.__anext__() == ": keepalive\n\n"
+        await body.aclose()
+
+    run(scenario())
+
+
+def test_a_keepalive_leaves_the_wait_for_the_next_event_running(monkeypatch):
+    monkeypatch.setattr(events_mod, "KEEPALIVE_SECONDS", 0.01)
+    waits = []
+    next_event = Subscriber.next
+
+    def counted(self):
+        waits.append(self)
+        return next_event(self)
+
+    monkeypatch.setattr(Subscriber, "next", counted)
+
+    async def scenario():
+        hub = EventHub()
+        hub.bind(asyncio.get_running_loop())
+        body = events_mod.stream(hub, 1)
+        await body.__anext__()
+        for _ in range(3):
+            assert await body.__anext__() == ": keepalive\n\n"
+        hub.publish(1, "listen", {"track_id": "t1"})
+        assert await body.__anext__() == 'event: listen\ndata: {"track_id":"t1"}\n\n'
+        await body.aclose()
+
+    run(scenario())
+    assert len(waits) == 1
+
+
+def test_nothing_is_sent_before_the_hub_is_bound():
+    hub = EventHub()
+    hub.publish(1, "listen", {})  # no loop yet: dropped, not raised
+
+
+# ------------------------------------------------------------------- tracker
+
+
+@pytest.fixture
+def hub(tracker) -> RecordingHub:
+    tracker.events = RecordingHub()
+    return tracker.events
+
+
+def test_a_closed_listen_is_published_with_its_counts(player, hub, user_id):
+    player.listen("t1")
+
+    listens = [data for uid, event, data in hub.published if event == "listen"]
+    assert len(listens) == 1
+    assert listens[0]["track_id"] == "t1"
+    assert listens[0]["qualified"] is True
+    assert listens[0]["qualified_plays"] == 1
+    assert all(uid == user_id for uid, _, _ in hub.published)
+
+
+def test_now_playing_is_published_only_when_it_changes(player, hub):
+    player.poll(playback("t1", 0))
+    player.poll(playback("t1", 0))
+    player.poll(None, after_ms=1000)
+
+    names = hub.names()
+    assert names.count("now_playing") == 2
+    assert [data for _, event, data in hub.published if event == "now_playing"][-1] is None
+
+
+def test_reaching_the_threshold_publishes_the_addition(player, hub, db, user_id):
+    db.update_settings(user_id, {"favorite_threshold": 1})
+    player.listen("t1")
+
+    names = hub.names()
+    assert names.index("favorites") > names.index("listen")
+    assert [data for _, event, data in hub.published if event == "favorites"] == [{"added": 1}]
+
+
+def test_state_changes_reach_the_hook(db, user_id):
+    seen = []
+    db.on_state_change = lambda uid, version, sections: seen.append((uid, version, sections))
+    db.update_settings(user_id, {"favorite_threshold": 4})
+
+    assert seen == [(user_id, db.state_version(user_id), ("settings", "favorites", "stats"))]
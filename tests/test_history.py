@@ -4,11 +4,12 @@ Everything here is about the queries staying cheap and exact as it does -- keyse
 that doesn't walk what came before, and a search that doesn't scan.
 """
 
+import shutil
 import sqlite3
 
 import pytest
 
-from app.db import SCHEMA_VERSION, Database, fts_query
+from app.db import LISTENS_DDL, SCHEMA_VERSION, Database, fts_query
 
 FERNET_KEY = b"cGxhY2Vob2xkZXJfa2V5X2Zvcl90ZXN0c19vbmx5ISE="
 
@@ -307,28 +308,86 @@ def test_a_fresh_database_needs_no_migration(db, user_id):
 # --- from the intermediate schema, which mixed measured and backfilled rows ---
 
 
+# `listens` as schema 5 and everything before it had it: the track and context strings on
+# every row, and a search index over the rows themselves.
+V5_LISTENS = """
+CREATE TABLE listens (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                    track_id TEXT NOT NULL, name TEXT NOT NULL, artist TEXT NOT NULL,
+                    played_at INTEGER NOT NULL, duration_ms INTEGER NOT NULL DEFAULT 0,
+                    listened_ms INTEGER NOT NULL DEFAULT 0, completion_ratio REAL NOT NULL DEFAULT 0,
+                    qualified INTEGER NOT NULL DEFAULT 0, context_uri TEXT,
+                    is_open INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX idx_listens_user_time ON listens (user_id, played_at DESC, id DESC);
+CREATE INDEX idx_listens_user_qualified_time ON listens (user_id, qualified, played_at DESC, id DESC);
+CREATE INDEX idx_listens_user_track ON listens (user_id, track_id, played_at DESC);
+CREATE VIRTUAL TABLE listens_fts USING fts5(name, artist, content='listens', content_rowid='id',
+                    tokenize="unicode61 remove_diacritics 2", prefix='2 3 4');
+CREATE TRIGGER listens_fts_insert AFTER INSERT ON listens BEGIN
+    INSERT INTO listens_fts (rowid, name, artist) VALUES (new.id, new.name, new.artist);
+END;
+"""
+
+V5_INSERT = """
+INSERT INTO listens (user_id, track_id, name, artist, played_at, duration_ms, listened_ms,
+                     completion_ratio, qualified, context_uri, is_open)
+VALUES (?, ?, ?, ?, ?, 200000, ?, ?, ?, ?, ?)
+"""
+
+
+def v5_database(path, rows, version="5", extra=""):
+    """A database whose `listens` is in the schema-5 shape, holding `rows` of
+    (track_id, name, artist, played_at, qualified, context_uri, is_open) for user 1."""
+    Database(path, FERNET_KEY, "Favourite Songs").close()
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO users VALUES (1, 'u1', 'Nick', 1000)")
+    conn.execute("INSERT INTO settings (user_id, playlist_name) VALUES (1, 'Favourite Songs')")
+    conn.execute("DROP TABLE listens")
+    conn.executescript(V5_LISTENS + extra)
+    conn.executemany(
+        V5_INSERT,
+        [
+            (1, track_id, name, artist, played_at, 200_000 if qualified else 20_000,
+             1.0 if qualified else 0.1, int(qualified), context_uri, int(is_open))
+            for track_id, name, artist, played_at, qualified, context_uri, is_open in rows
+        ],
+    )
+    if version is None:
+        conn.execute("DELETE FROM meta WHERE key = 'schema_version'")
+    else:
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'schema_version'", (version,))
+    conn.commit()
+    conn.close()
+    return path
+
+
 @pytest.fixture
 def v2_db_path(tmp_path):
     """A database from the build that recorded Spotify's history alongside measured
     listens, tagged by `source`."""
-    path = str(tmp_path / "v2.db")
-    db = Database(path, FERNET_KEY, "Favourite Songs")
-    user_id = db.upsert_user("u1", "Nick")
-    add(db, user_id, "t1", "Measured", "Artist", BASE)
-    add(db, user_id, "t2", "Also Measured", "Artist", BASE + 1000, qualified=False)
-    db.conn.execute("ALTER TABLE listens ADD COLUMN source TEXT NOT NULL DEFAULT 'live'")
-    db.conn.execute("ALTER TABLE listens ADD COLUMN history_played_at INTEGER")
-    db.conn.execute(
+    path = v5_database(
+        str(tmp_path / "v2.db"),
+        [
+            ("t1", "Measured", "Artist", BASE, True, None, False),
+            ("t2", "Also Measured", "Artist", BASE + 1000, False, None, False),
+        ],
+        version=None,
+        extra="""
+        ALTER TABLE listens ADD COLUMN source TEXT NOT NULL DEFAULT 'live';
+        ALTER TABLE listens ADD COLUMN history_played_at INTEGER;
+        """,
+    )
+    conn = sqlite3.connect(path)
+    conn.execute(
         """
         INSERT INTO listens (user_id, track_id, name, artist, played_at, duration_ms,
                              listened_ms, completion_ratio, qualified, is_open, source)
-        VALUES (?, 't3', 'Backfilled', 'Artist', ?, 0, 0, 0, 0, 0, 'history')
+        VALUES (1, 't3', 'Backfilled', 'Artist', ?, 0, 0, 0, 0, 0, 'history')
         """,
-        (user_id, BASE + 2000),
+        (BASE + 2000,),
     )
-    db.conn.execute("DELETE FROM meta WHERE key = 'schema_version'")
-    db.conn.commit()
-    db.close()
+    conn.commit()
+    conn.close()
     return path
 
 
@@ -353,3 +412,223 @@ def test_v2_counts_match_the_surviving_history(v2_db_path):
         assert db.history_summary(1)["qualified"] == 1
     finally:
         db.close()
+
+
+# --- from schema 5, which kept every string on every row ---
+
+
+@pytest.fixture
+def v5_db_path(tmp_path):
+    return v5_database(
+        str(tmp_path / "v5.db"),
+        [
+            ("t1", "Weird Fishes", "Radiohead", BASE, True, "spotify:playlist:p1", False),
+            ("t2", "Roygbiv", "Boards of Canada", BASE + DAY, False, None, False),
+            ("t1", "Weird Fishes/Arpeggi", "Radiohead", BASE + 2 * DAY, True,
+             "spotify:playlist:p1", False),
+            ("t3", "Svefn-g-englar", "Sigur Rós", BASE + 3 * DAY, False, "spotify:album:a1", True),
+        ],
+    )
+
+
+def test_v5_listens_keep_their_history_as_keys(v5_db_path):
+    db = Database(v5_db_path, FERNET_KEY, "Favourite Songs")
+    try:
+        items = db.history(1)["items"]
+        assert [(row["id"], row["track_id"], row["name"]) for row in items] == [
+            (4, "t3", "Svefn-g-englar"),
+            (3, "t1", "Weird Fishes/Arpeggi"),
+            (2, "t2", "Roygbiv"),
+            # A rename between plays: every play shows the latest name, as the tally does.
+            (1, "t1", "Weird Fishes/Arpeggi"),
+        ]
+        assert [row["is_open"] for row in items] == [True, False, False, False]
+        assert {"track_id", "name", "artist", "context_uri"}.isdisjoint(db._columns("listens"))
+        assert db.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 3
+        assert db.conn.execute("SELECT COUNT(*) FROM contexts").fetchone()[0] == 2
+        assert not db._table_exists("listens_fts") and not db._table_exists("listens_v5")
+        assert [row["id"] for row in db.history(1, query="sigur ros")["items"]] == [4]
+    finally:
+        db.close()
+
+
+def test_v5_migration_picks_up_after_an_interrupted_copy(v5_db_path):
+    # As a crash would leave it: the old table renamed, the new one half-filled.
+    conn = sqlite3.connect(v5_db_path)
+    conn.execute("DROP TRIGGER listens_fts_insert")
+    conn.execute("ALTER TABLE listens RENAME TO listens_v5")
+    conn.executescript(LISTENS_DDL)
+    conn.execute("INSERT INTO listens (user_id, track_key, played_at) VALUES (1, 99, ?)", (BASE,))
+    conn.execute("DELETE FROM meta")
+    conn.commit()
+    conn.close()
+
+    for _ in range(2):
+        db = Database(v5_db_path, FERNET_KEY, "Favourite Songs")
+        try:
+            assert [row["id"] for row in db.history(1)["items"]] == [4, 3, 2, 1]
+        finally:
+            db.close()
+
+
+def test_a_new_listen_reuses_its_track_and_context(db, user_id):
+    for i in range(3):
+        row_id = db.open_listen(
+            user_id, "t1", "Song", "Artist", BASE + i, 200_000, "spotify:playlist:p1"
+        )
+        db.close_listen(
+            row_id, user_id, "t1", "Song", "Artist", BASE + i, 200_000, 200_000, 1.0, True
+        )
+    db.open_listen(user_id, "t1", "Song (Remastered)", "Artist", BASE + 9, 200_000, None)
+
+    assert db.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 1
+    assert db.conn.execute("SELECT COUNT(*) FROM contexts").fetchone()[0] == 1
+    assert {row["name"] for row in db.history(user_id)["items"]} == {"Song (Remastered)"}
+    assert db.history(user_id, query="remastered")["items"]
+
+
+def test_a_deleted_user_takes_their_tracks_along(db, user_id):
+    other = db.upsert_user("u2", "Other")
+    add(db, user_id, "t1", "Weird Fishes", "Radiohead", BASE)
+    add(db, other, "t2", "Roygbiv", "Boards of Canada", BASE)
+    db.delete_user(user_id)
+
+    assert [row[0] for row in db.conn.execute("SELECT track_id FROM tracks")] == ["t2"]
+
+
+# ------------------------------------------------------------------ storage
+
+
+def long_history(listens, tracks=400, contexts=20):
+    """A year or so of plays with real-looking ids and names, for the size benchmarks."""
+    artists = ["Radiohead", "Boards of Canada", "Sigur Rós", "Aphex Twin", "Slowdive"]
+    return [
+        (
+            f"{i % tracks:022d}",
+            f"A Song With a Fairly Ordinary Title {i % tracks}",
+            artists[i % tracks % len(artists)],
+            BASE + i * 60_000,
+            i % 4 != 0,
+            f"spotify:playlist:{i % contexts:022d}",
+            False,
+        )
+        for i in range(listens)
+    ]
+
+
+def pages(path, *prefixes):
+    """Pages held by the tables and indexes whose names start with any of `prefixes`."""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT name, pagetype, ncell FROM dbstat").fetchall()
+    except sqlite3.OperationalError:
+        pytest.skip("this SQLite was built without the dbstat table")
+    finally:
+        conn.close()
+    return [row for row in rows if row[0].startswith(prefixes)]
+
+
+@pytest.fixture
+def before_and_after(tmp_path):
+    """The same 20,000 listens in the schema-5 shape and after the move to keys, each
+    vacuumed so neither is flattered by free pages."""
+    before = v5_database(str(tmp_path / "before.db"), long_history(20_000))
+    after = str(tmp_path / "after.db")
+    shutil.copy(before, after)
+    Database(after, FERNET_KEY, "Favourite Songs").close()
+    for path in (before, after):
+        conn = sqlite3.connect(path)
+        conn.execute("VACUUM")
+        conn.close()
+    return before, after
+
+
+def test_the_history_takes_a_fraction_of_the_space(before_and_after):
+    before, after = before_and_after
+    # Everything the history costs: the rows, their indexes, the search index and, after,
+    # the dimension tables the rows now point into.
+    history = ("listens", "idx_listens", "sqlite_autoindex_tracks", "sqlite_autoindex_contexts",
+               "tracks", "contexts")
+    before_pages, after_pages = len(pages(before, *history)), len(pages(after, *history))
+
+    assert after_pages < before_pages / 2
+
+    def file_pages(path):
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            conn.close()
+
+    assert file_pages(after) < file_pages(before) / 2
+
+
+def test_a_page_of_history_reads_fewer_pages(before_and_after):
+    """A page of 50 plays is 50 neighbouring rows of `listens`: how many leaf pages they
+    span is how many pages the read touches beyond the index seek. The track names a page
+    shows come from `tracks`, a few hundred rows that stay in the cache."""
+    spans = []
+    for path in before_and_after:
+        leaves = [
+            ncell
+            for name, pagetype, ncell in pages(path, "listens")
+            if name == "listens" and pagetype == "leaf"
+        ]
+        rows_per_leaf = sum(leaves) / len(leaves)
+        spans.append(50 / rows_per_leaf)
+
+    before, after = spans
+    assert after < before / 2
+
+    db = Database(before_and_after[1], FERNET_KEY, "Favourite Songs")
+    try:
+        page = db.history(1, limit=50)["items"]
+        assert len(page) == 50 and page[0]["name"].startswith("A Song With")
+    finally:
+        db.close()
+
+
+# ------------------------------------------------------------------ readers
+
+
+def test_a_read_does_not_wait_for_the_writer(stocked, user_id):
+    """History and stats read from their own connections. Holding the writer's lock --
+    which is what a tracker does for every commit -- must not stall a page."""
+    import threading
+
+    result = {}
+    with stocked.lock:
+        reader = threading.Thread(
+            target=lambda: result.update(page=stocked.history(user_id)), daemon=True
+        )
+        reader.start()
+        reader.join(timeout=5)
+        assert not reader.is_alive()
+
+    assert len(result["page"]["items"]) == 3
+
+
+def test_a_committed_write_is_visible_to_the_next_read(db, user_id):
+    add(db, user_id, "t1", "Weird Fishes", "Radiohead", BASE)
+    assert db.history_summary(user_id)["listens"] == 1
+
+    add(db, user_id, "t2", "Roygbiv", "Boards of Canada", BASE + DAY)
+    assert db.history_summary(user_id)["listens"] == 2
+
+
+def test_readers_cannot_write(db):
+    with db._reader() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM users")
+
+
+def test_without_readers_everything_shares_the_writer(tmp_path):
+    db = Database(str(tmp_path / "single.db"), FERNET_KEY, "Favourite Songs", readers=0)
+    try:
+        user_id = db.upsert_user("u1", "Nick")
+        add(db, user_id, "t1", "Weird Fishes", "Radiohead", BASE)
+        with db._reader() as conn:
+            assert conn is db.conn
+        assert db.history_summary(user_id)["listens"] == 1
+    finally:
+        db.close()
@@ -0,0 +1,179 @@
+"""Importing Spotify's streaming-history export: parsed as it's read, judged like a live
+listen, and safe to run twice."""
+
+import io
+import json
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+from app import importer
+
+from test_history import BASE, DAY, add
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def entry(track, ended_at, ms_played, reason_end="trackdone", name=None):
+    return {
+        "ts": datetime.fromtimestamp(ended_at / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "ms_played": ms_played,
+        "master_metadata_track_name": name or f"Song {track}",
+        "master_metadata_album_artist_name": "Boards of Canada",
+        "spotify_track_uri": f"spotify:track:{track}" if track else None,
+        "episode_name": None if track else "A Podcast",
+        "reason_end": reason_end,
+    }
+
+
+def dump(*entries):
+    return io.BytesIO(json.dumps(list(entries), indent=1).encode())
+
+
+@pytest.fixture
+def history():
+    """Three weeks before the app was connected, and one play after."""
+    old = BASE - 30 * DAY
+    return [
+        entry("a", old + 200_000, 200_000),  # heard to the end: a's length is 200 s
+        entry("a", old + DAY + 100_000, 100_000, "fwdbtn"),  # half of it
+        entry("a", old + 2 * DAY + 190_000, 190_000, "endplay"),  # 95%
+        entry("b", old + 3 * DAY + 30_000, 30_000, "fwdbtn"),  # length unknown
+        entry(None, old + 4 * DAY, 1_000_000),  # a podcast
+        entry("a", BASE + DAY + 200_000, 200_000),  # after the first live listen
+    ]
+
+
+# ------------------------------------------------------------------ parsing
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_entries_are_read_across_any_chunk_boundary(history, chunk_size):
+    raw = b"\xef\xbb\xbf" + json.dumps(history, ensure_ascii=False).encode()
+    assert list(importer.read_streams(io.BytesIO(raw), chunk_size)) == history
+
+
+def test_a_truncated_file_is_refused():
+    raw = json.dumps([entry("a", BASE, 1000)] * 3).encode()
+    with pytest.raises(ValueError):
+        list(importer.read_streams(io.BytesIO(raw[:-40]), chunk_size=16))
+    with pytest.raises(ValueError):
+        list(importer.read_streams(io.BytesIO(b'{"not": "an array"}')))
+
+
+# ------------------------------------------------------------------ merging
+
+
+def test_plays_are_judged_like_live_listens(db, user_id, history):
+    add(db, user_id, "live", "Live", "Artist", BASE)
+    summary = db.import_history(user_id, [dump(*history)])
+
+    assert summary == {
+        "entries": 6, "plays": 5, "imported": 4, "before_tracking": 4, "duplicates": 0,
+        "unmeasured": 1,
+    }
+    rows = {
+        (row["track_id"], round(row["completion_ratio"], 2), row["qualified"])
+        for row in db.history(user_id)["items"]
+        if row["track_id"] != "live"
+    }
+    assert rows == {("a", 1.0, True), ("a", 0.5, False), ("a", 0.95, True), ("b", 0.0, False)}
+
+    counts = db.play_counts(user_id)
+    assert (counts["a"]["qualified_plays"], counts["a"]["total_plays"]) == (2, 3)
+    assert db.history_summary(user_id)["first_played"] == BASE - 30 * DAY
+    assert db.history_summary(user_id)["tracks"] == 3
+
+
+def test_a_live_length_or_the_api_measures_what_the_export_cannot(db, user_id, history):
+    row_id = db.open_listen(user_id, "b", "Song b", "Boards of Canada", BASE, 60_000, None)
+    db.close_listen(row_id, user_id, "b", "Song b", "Boards of Canada", BASE, 60_000,
+                    60_000, 1.0, True)
+    asked = []
+
+    def resolve(track_ids):
+        asked.extend(track_ids)
+        return {track_id: 100_000 for track_id in track_ids}
+
+    db.import_history(user_id, [dump(*history)], resolve)
+    assert asked == []  # a's length came from the export, b's from the live listen
+    b = [row for row in db.history(user_id)["items"] if row["track_id"] == "b"]
+    assert sorted(row["completion_ratio"] for row in b) == [0.5, 1.0]
+
+
+def test_importing_twice_adds_nothing(db, user_id, history):
+    first = db.import_history(user_id, [dump(*history)], lambda ids: {})
+    counts = db.play_counts(user_id)
+    again = db.import_history(user_id, [dump(*history)], lambda ids: {})
+
+    assert first["imported"] == 5 and again["imported"] == 0
+    assert again["duplicates"] == 5
+    assert db.play_counts(user_id) == counts
+    assert db.conn.execute("SELECT COUNT(*) FROM import_staging").fetchone()[0] == 0
+
+
+def test_a_renamed_track_keeps_the_name_of_its_latest_play(db, user_id):
+    old = BASE - 30 * DAY
+    newest = entry("a", old + 2 * DAY, 1000, name="Alpha (Remastered)")
+    older = [entry("a", old, 1000, name="Zulu"), entry("a", old + DAY, 1000, name="Alpha")]
+    db.import_history(user_id, [dump(newest), dump(*older)], lambda ids: {})
+
+    name = db.conn.execute("SELECT name FROM tracks WHERE track_id = 'a'").fetchone()[0]
+    assert name == "Alpha (Remastered)"
+
+
+def test_the_rollup_agrees_with_a_rebuild(db, user_id, history, monkeypatch):
+    from app import stats
+    from test_stats import rollup_rows
+
+    monkeypatch.setattr(importer, "STAGING_BATCH", 2)
+    monkeypatch.setattr(importer, "MERGE_BATCH", 1)
+    add(db, user_id, "a", "Song a", "Boards of Canada", BASE)
+    db.import_history(user_id, [dump(*history)])
+    imported = rollup_rows(db)
+    with db.lock:
+        stats.rebuild(db.conn)
+        db.conn.commit()
+    assert rollup_rows(db) == imported
+    assert db.get_all_stats(user_id, 5)
+    assert db.drifted_play_counts() == []
+
+
+def test_the_api_is_asked_with_the_lock_let_go(db, user_id, history):
+    held = []
+
+    def resolve(track_ids):
+        held.append(db.lock.acquire(blocking=False))
+        if held[-1]:
+            db.lock.release()
+        return {}
+
+    db.import_history(user_id, [dump(*history)], resolve)
+    assert held == [True]
+
+
+def test_a_user_leaving_mid_import_keeps_the_tracks_it_has_yet_to_merge(db, user_id, history):
+    other = db.upsert_user("someone-else", "Other")
+
+    def resolve(track_ids):
+        db.delete_user(other)  # while the import's tracks have no listens pointing at them
+        return {}
+
+    summary = db.import_history(user_id, [dump(*history)], resolve)
+    assert summary["imported"] == 5
+    assert {row["track_id"] for row in db.history(user_id)["items"]} == {"a", "b"}
+
+
+def test_dbtool_imports_without_the_app(db, user_id, history, tmp_path):
+    path = tmp_path / "Streaming_History_Audio_2019.json"
+    path.write_text(json.dumps(history))
+    result = subprocess.run(
+        [sys.executable, str(REPO / "scripts" / "dbtool.py"), "import-history",
+         "--db", db.db_path, "--user", str(user_id), str(path)],
+        capture_output=True, text=True, check=True,
+    )
+    assert json.loads(result.stdout) == {"entries": 6, "plays": 5, "imported": 5}
+    assert len(db.history(user_id)["items"]) == 5
@@ -5,8 +5,11 @@ cases that matter are the ones where playback position and audio heard disagree
 seeking, pausing, and the gap between the last poll and the end of the track.
 """
 
+import json
+
 from pytest import approx
 
+from app import listens
 from app.listens import (
     Observation,
     continues,
@@ -143,3 +146,37 @@ def test_episodes_are_not_listens():
 def test_nothing_playing_is_no_observation():
     assert observation_from_playback(None, 1) is None
     assert observation_from_playback({"item": None}, 1) is None
+
+
+def test_each_poll_reuses_the_strings_of_the_last():
+    """Every poll decodes fresh copies of the same strings; the observation holds one."""
+
+    def poll():
+        return json.loads(
+            '{"is_playing": true, "progress_ms": 5000,'
+            ' "context": {"uri": "spotify:playlist:p1"},'
+            ' "item": {"id": "t1", "type": "track", "name": "Weird Fishes",'
+            ' "duration_ms": 318000, "artists": [{"name": "Radiohead"}]}}'
+        )
+
+    first, second = observation_from_playback(poll(), 1), observation_from_playback(poll(), 2)
+    for field in ("track_id", "name", "artist", "context_uri"):
+        assert getattr(first, field) is getattr(second, field)
+    assert not hasattr(first, "__dict__")
+
+
+def test_the_shared_strings_are_bounded(monkeypatch):
+    monkeypatch.setattr(listens, "_strings", {})
+    monkeypatch.setattr(listens, "SHARED_STRINGS", 3)
+    for n in range(10):
+        listens.shared(f"track-{n}")
+        assert len(listens._strings) <= 3
+    first = listens.shared("".join(["track-", "9"]))
+    assert first is listens.shared("".join(["track-", "9"]))
+
+
+def test_missing_fields_read_as_unknown():
+    obs = observation_from_playback({"item": {"id": "t1", "artists": [None]}}, 1)
+    assert (obs.name, obs.artist, obs.duration_ms, obs.context_uri) == (
+        "Unknown Track", "Unknown Artist", 0, None
+    )
@@ -0,0 +1,95 @@
+"""Query plans for everything the stats page and the history header run.
+
+`test_a_page_does_not_scan_what_came_before_it` pins one statement by hand. This pins
+all of them, without listing them: each entry point runs against a real database with
+every statement it issues captured, and each one is put through EXPLAIN QUERY PLAN. A
+new query that scans a table, or a stats query on `listens` that has to leave the
+index for the table, fails here rather than on a decade of history.
+"""
+
+import pytest
+
+from app import stats
+from app.db import Database
+
+from test_history import BASE, DAY, FERNET_KEY, add
+
+
+@pytest.fixture
+def traced(tmp_path):
+    # readers=0: every query goes through the writer, where the trace is installed.
+    db = Database(str(tmp_path / "plans.db"), FERNET_KEY, "Favourite Songs", readers=0)
+    user_id = db.upsert_user("u1", "Nick")
+    for i in range(10):
+        add(db, user_id, f"t{i % 4}", f"Song {i % 4}", "Radiohead", BASE + i * DAY)
+    db.note_seen_context(user_id, "p1", "t1")
+    yield db, user_id
+    db.close()
+
+
+def statements(db, call):
+    """The statements `call` runs, with their parameters bound in, less the BEGINs and
+    COMMITs around them."""
+    seen = []
+    db.conn.set_trace_callback(seen.append)
+    try:
+        call()
+    finally:
+        db.conn.set_trace_callback(None)
+    return [sql for sql in seen if not sql.lstrip().upper().startswith(("BEGIN", "COMMIT"))]
+
+
+def plan(db, sql):
+    return [row["detail"] for row in db.conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+ENTRY_POINTS = {
+    "get_all_stats": lambda db, user_id: db.get_all_stats(user_id, 3),
+    "history_summary": lambda db, user_id: db.history_summary(user_id),
+    "count_listens_since": lambda db, user_id: db.count_listens_since(user_id, BASE),
+    "tracked_track_count": lambda db, user_id: db.tracked_track_count(user_id),
+    "next_favorite_candidate": lambda db, user_id: db.next_favorite_candidate(user_id, 3),
+    "play_counts_over": lambda db, user_id: db.play_counts_over(user_id, 3),
+    "history": lambda db, user_id: db.history(user_id, limit=5),
+    "history_by_track": lambda db, user_id: db.history(
+        user_id, favorites_only=True, favorite_track_ids=frozenset({"t1"})
+    ),
+    "rebuild_one_user": lambda db, user_id: stats.rebuild(db.conn, user_id),
+}
+
+
+@pytest.mark.parametrize("entry", sorted(ENTRY_POINTS))
+def test_nothing_scans_a_table(traced, entry):
+    db, user_id = traced
+    issued = statements(db, lambda: ENTRY_POINTS[entry](db, user_id))
+    assert issued
+
+    # Scanning a subquery's own result, or the `json_each` of a bound list, is fine;
+    # scanning a stored table or index from the start is not.
+    harmless = ("SCAN json_each", "SCAN (subquery")
+    for sql in issued:
+        scans = [step for step in plan(db, sql) if step.startswith("SCAN")]
+        assert [step for step in scans if not step.startswith(harmless)] == [], sql
+
+
+@pytest.mark.parametrize("entry", ["get_all_stats", "history_summary", "count_listens_since"])
+def test_stats_over_listens_read_the_index_alone(traced, entry):
+    """The figures added up over a range of listens come from the index's own columns:
+    a week of plays costs a range of index pages, not a table lookup per play."""
+    db, user_id = traced
+    on_listens = [
+        sql for sql in statements(db, lambda: ENTRY_POINTS[entry](db, user_id))
+        if "FROM listens" in sql
+    ]
+    assert on_listens
+
+    for sql in on_listens:
+        assert any("USING COVERING INDEX" in step for step in plan(db, sql)), sql
+
+
+def test_the_stats_never_convert_a_timestamp_per_row(traced):
+    """Local days and hours are stored with the listen; the rollup rebuild groups on them."""
+    db, user_id = traced
+    issued = statements(db, lambda: stats.rebuild(db.conn, user_id))
+    issued += statements(db, lambda: db.get_all_stats(user_id, 3))
+    assert not [sql for sql in issued if "localtime" in sql]
@@ -0,0 +1,159 @@
+"""The shared poll scheduler.
+
+Every user polls on the same fixed five-second grid, spread across it rather than all at
+once, and a slow poll must neither drift later ones nor overlap itself.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.scheduler import PollScheduler, next_due, phase_for
+
+INTERVAL = 5.0
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 3, 7, 20, 200])
+def test_jobs_are_spread_across_the_interval(jobs):
+    phases = sorted(phase_for(slot, INTERVAL) for slot in range(jobs))
+    gaps = [b - a for a, b in zip(phases, phases[1:])] + [INTERVAL - phases[-1] + phases[0]]
+
+    assert all(0 <= phase < INTERVAL for phase in phases)
+    assert max(gaps) <= 3 * INTERVAL / jobs
+
+
+def test_the_next_poll_stays_on_the_grid():
+    """Due at 10, finished at 12.5: the next is at 15, not 17.5."""
+    assert next_due(10.0, 12.5, INTERVAL) == (15.0, 0)
+
+
+def test_an_overrun_is_followed_at_once_but_not_made_up_in_a_burst():
+    assert next_due(10.0, 16.0, INTERVAL) == (15.0, 0)
+    assert next_due(10.0, 27.0, INTERVAL) == (25.0, 2)
+
+
+def run_for(seconds, setup):
+    async def main():
+        scheduler = PollScheduler(interval=0.05, workers=4)
+        result = setup(scheduler)
+        await asyncio.sleep(seconds)
+        stats = scheduler.stats()
+        await scheduler.close()
+        return result, stats
+
+    return asyncio.run(main())
+
+
+def test_every_job_polls_on_the_cadence():
+    def setup(scheduler):
+        calls = {key: 0 for key in range(3)}
+
+        def poll_for(key):
+            def poll():
+                calls[key] += 1
+                return 0.05
+            return poll
+
+        for key in calls:
+            scheduler.add(key, poll_for(key))
+        return calls
+
+    calls, stats = run_for(0.5, setup)
+
+    assert all(7 <= n <= 11 for n in calls.values()), calls
+    assert set(stats["users"]) == {"0", "1", "2"}
+
+
+def test_a_slow_poll_never_overlaps_itself():
+    def setup(scheduler):
+        state = {"inside": 0, "overlapped": False, "polls": 0}
+        lock = threading.Lock()
+
+        def poll():
+            with lock:
+                state["inside"] += 1
+                state["overlapped"] |= state["inside"] > 1
+            time.sleep(0.12)  # more than two intervals
+            with lock:
+                state["inside"] -= 1
+                state["polls"] += 1
+            return 0.05
+
+        scheduler.add(1, poll)
+        return state
+
+    state, stats = run_for(0.6, setup)
+
+    assert not state["overlapped"]
+    assert state["polls"] >= 3
+    assert stats["users"]["1"]["missed"] > 0
+
+
+def test_stats_can_be_narrowed_to_one_job():
+    async def main():
+        scheduler = PollScheduler(interval=0.05, workers=2)
+        for key in (1, 2):
+            scheduler.add(key, lambda: 0.05)
+        narrowed = [set(scheduler.stats(key)["users"]) for key in (None, 2, 3)]
+        await scheduler.close()
+        return narrowed
+
+    assert asyncio.run(main()) == [{"1", "2"}, {"2"}, set()]
+
+
+def test_a_poll_that_returns_none_stops_polling():
+    def setup(scheduler):
+        calls = []
+        scheduler.add(1, lambda: calls.append(1))
+        return calls, scheduler
+
+    (calls, scheduler), stats = run_for(0.3, setup)
+
+    assert calls == [1]
+    assert 1 not in scheduler and stats["users"] == {}
+
+
+def test_removing_a_job_waits_for_its_poll_to_finish():
+    async def main():
+        scheduler = PollScheduler(interval=0.05, workers=2)
+        started, finished = threading.Event(), threading.Event()
+
+        def poll():
+            started.set()
+            time.sleep(0.1)
+            finished.set()
+            return 0.05
+
+        scheduler.add(1, poll)
+        while not started.is_set():
+            await asyncio.sleep(0.005)
+        await scheduler.remove(1)
+        done = finished.is_set()
+        await scheduler.close()
+        return done
+
+    assert asyncio.run(main())
+
+
+def test_closing_as_a_job_is_rescheduled_still_stops_the_loop():
+    """The wake and the cancellation land in the same tick: the loop must not take the
+    one for a reason to carry on and drop the other."""
+
+    async def main():
+        scheduler = PollScheduler(interval=60.0, workers=1)
+        scheduler.add(1, lambda: 0.05)
+        for _ in range(3):
+            await asyncio.sleep(0)  # the loop is now waiting for the job to fall due
+        scheduler._wake.set()
+        task = scheduler._task
+        task.cancel()
+        await asyncio.wait([task], timeout=1.0)
+        stopped = task.done()
+        if not stopped:
+            task.cancel()
+        await scheduler.close()
+        return stopped
+
+    assert asyncio.run(main())
@@ -0,0 +1,282 @@
+"""The stats rollup: folded in as listens close, and always equal to recomputing it."""
+
+import random
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app import stats
+from app.db import Database
+
+from test_history import BASE, DAY, FERNET_KEY, add
+
+HOUR = 3_600_000
+
+
+def rollup_rows(db):
+    """Every rollup row, in a form two databases can be compared by. Floats are rounded:
+    the completion sum is added up in a different order by a fold and a rebuild."""
+    return {
+        table: sorted(
+            tuple(round(v, 9) if isinstance(v, float) else v for v in row)
+            for row in db.conn.execute(f"SELECT * FROM {table}")
+        )
+        for table in stats.ROLLUP_TABLES
+    }
+
+
+def close_random_listens(db, user_ids, count, seed=7):
+    rng = random.Random(seed)
+    artists = ["Radiohead", "Boards of Canada", "Sigur Rós", "Slowdive"]
+    for _ in range(count):
+        ratio = rng.choice([0.1, 0.5, 0.85, 1.0])
+        # A track has one artist: `tracks` keeps a single name and artist per track.
+        track = rng.randrange(20)
+        row_id = db.open_listen(
+            rng.choice(user_ids), f"t{track}", "Song", artists[track % len(artists)],
+            BASE + rng.randrange(40) * DAY + rng.randrange(24) * HOUR, 200_000, None,
+        )
+        row = db.conn.execute(
+            "SELECT l.*, t.track_id, t.artist FROM listens l"
+            " JOIN tracks t ON t.key = l.track_key WHERE l.id = ?",
+            (row_id,),
+        ).fetchone()
+        db.close_listen(
+            row_id=row_id, user_id=row["user_id"], track_id=row["track_id"], name="Song",
+            artist=row["artist"], played_at=row["played_at"], duration_ms=200_000,
+            listened_ms=int(200_000 * ratio), completion_ratio=ratio, qualified=ratio >= 0.8,
+        )
+
+
+# ------------------------------------------------------------------- folding
+
+
+def test_folding_agrees_with_a_rebuild(db):
+    """Listens closed in any order -- days out of sequence included -- leave exactly the
+    rollup a rebuild from `listens` produces."""
+    users = [db.upsert_user(f"u{i}", f"User {i}") for i in range(3)]
+    close_random_listens(db, users, 300)
+    folded = rollup_rows(db)
+
+    with db.lock:
+        assert stats.rebuild(db.conn) == 3
+        db.conn.commit()
+    assert rollup_rows(db) == folded
+    for user_id in users:
+        assert db.tracked_track_count(user_id) == len(db.play_counts(user_id))
+
+
+def test_a_rebuild_keeps_the_days_the_listens_were_heard_on(db, monkeypatch):
+    """Each listen stores its local day and hour when it's written, so a rebuild after the
+    host's timezone changes still agrees with what was folded."""
+    if not hasattr(time, "tzset"):
+        pytest.skip("no tzset on this platform")
+    users = [db.upsert_user("u1", "Nick")]
+    monkeypatch.setenv("TZ", "America/Los_Angeles")
+    time.tzset()
+    try:
+        close_random_listens(db, users, 100)
+        folded = rollup_rows(db)
+        monkeypatch.setenv("TZ", "Asia/Tokyo")
+        time.tzset()
+        with db.lock:
+            stats.rebuild(db.conn)
+            db.conn.commit()
+        assert rollup_rows(db) == folded
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_orphaned_listens_are_folded_too(db, user_id):
+    db.update_settings(user_id, {"min_completion_ratio": 0.5})
+    row_id = db.open_listen(user_id, "t1", "Song", "Radiohead", BASE, 200_000, None)
+    db.update_open_listen(row_id, 150_000, 0.75, 200_000)
+    db.close_orphaned_listens()
+
+    snap = db_snapshot(db, user_id)
+    assert snap["listens"] == 1 and snap["skipped"] == 0
+    assert snap["listened_ms"] == 150_000
+    assert snap["top_artist"] == ("Radiohead", 1)
+
+
+def test_the_rollup_goes_with_the_user(db, user_id):
+    add(db, user_id, "t1", "Weird Fishes", "Radiohead", BASE)
+    db.delete_user(user_id)
+    assert all(rows == [] for rows in rollup_rows(db).values())
+
+
+# ------------------------------------------------------------------- streaks
+
+
+def day_at(day: date, hour: int = 12) -> int:
+    return int(datetime(day.year, day.month, day.day, hour).timestamp() * 1000)
+
+
+def db_snapshot(db, user_id, today=None):
+    with db._reader() as conn:
+        return stats.snapshot(conn, user_id, today=today)
+
+
+def test_streaks_follow_consecutive_local_days(db, user_id):
+    start = date(2027, 3, 1)
+    for offset in (0, 1, 2, 5, 6):
+        add(db, user_id, "t1", "Song", "Artist", day_at(start + timedelta(days=offset)))
+        add(db, user_id, "t2", "Song", "Artist", day_at(start + timedelta(days=offset), 20))
+
+    snap = db_snapshot(db, user_id, today=(start + timedelta(days=6)).isoformat())
+    assert (snap["current_streak"], snap["longest_streak"]) == (2, 3)
+    # The run ended yesterday or earlier: nothing current about it.
+    snap = db_snapshot(db, user_id, today=(start + timedelta(days=7)).isoformat())
+    assert (snap["current_streak"], snap["longest_streak"]) == (0, 3)
+
+
+def test_a_late_day_that_fills_a_gap_joins_the_runs(db, user_id):
+    start = date(2027, 3, 1)
+    for offset in (0, 1, 3, 4, 5):
+        add(db, user_id, "t1", "Song", "Artist", day_at(start + timedelta(days=offset)))
+    add(db, user_id, "t1", "Song", "Artist", day_at(start + timedelta(days=2)))
+
+    snap = db_snapshot(db, user_id, today=(start + timedelta(days=5)).isoformat())
+    assert (snap["current_streak"], snap["longest_streak"]) == (6, 6)
+
+
+# --------------------------------------------------------------- the page
+
+
+def by_id(items):
+    return {item["id"]: item for item in items}
+
+
+def test_the_page_reads_the_rollup(db, user_id):
+    monday_late = day_at(date(2027, 3, 1), 2)
+    add(db, user_id, "t1", "Weird Fishes", "Radiohead", monday_late)
+    add(db, user_id, "t2", "Reckoner", "Radiohead", monday_late + HOUR)
+    add(db, user_id, "t3", "Roygbiv", "Boards of Canada", monday_late + 2 * HOUR, qualified=False)
+
+    page = by_id(db.get_all_stats(user_id, 5))
+    assert page["total_listens"]["value"] == "3"
+    assert page["total_artists"]["value"] == "2"
+    assert page["top_artist"]["value"] == "Radiohead"
+    assert page["top_artist"]["subtitle"] == "2 counted plays"
+    assert page["peak_hour"]["value"] in {"2:00", "3:00", "4:00"}
+    assert page["top_day"]["value"] == "Monday"
+    assert page["night_owl"]["subtitle"].startswith("100%")
+    assert page["skip_rate"]["value"] == "33%"
+    assert page["perfect_listens"]["value"] == "2"
+    assert page["avg_completion"]["value"] == "70%"
+    assert page["longest_streak"]["value"] == "1 day"
+
+
+def test_the_page_never_aggregates_the_whole_history(tmp_path):
+    """Whatever still reads `listens` has to be bounded by `played_at`, so the page costs
+    the same however long the history is."""
+    db = Database(str(tmp_path / "trace.db"), FERNET_KEY, "Favourite Songs", readers=0)
+    try:
+        user_id = db.upsert_user("u1", "Nick")
+        add(db, user_id, "t1", "Weird Fishes", "Radiohead", BASE)
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        db.get_all_stats(user_id, 5)
+        db.conn.set_trace_callback(None)
+
+        on_listens = [sql for sql in statements if "FROM listens" in sql]
+        assert on_listens
+        assert all("played_at >=" in sql for sql in on_listens)
+    finally:
+        db.close()
+
+
+# ----------------------------------------------------------------- migration
+
+
+def test_upgrading_from_v3_builds_the_rollup(tmp_path):
+    path = str(tmp_path / "v3.db")
+    db = Database(path, FERNET_KEY, "Favourite Songs")
+    user_id = db.upsert_user("u1", "Nick")
+    for i in range(5):
+        add(db, user_id, f"t{i}", "Song", "Radiohead", BASE + i * DAY)
+    expected = rollup_rows(db)
+    # As a v3 build left it: the history, and no rollup.
+    with db.lock:
+        for table in stats.ROLLUP_TABLES:
+            db.conn.execute(f"DROP TABLE {table}")
+        db.conn.execute("UPDATE meta SET value = '3' WHERE key = 'schema_version'")
+        db.conn.commit()
+    db.close()
+
+    db = Database(path, FERNET_KEY, "Favourite Songs")
+    try:
+        assert rollup_rows(db) == expected
+        assert db.play_counts(user_id)["t0"]["total_plays"] == 1
+    finally:
+        db.close()
+
+
+def test_upgrading_from_v4_counts_the_tracks(tmp_path):
+    path = str(tmp_path / "v4.db")
+    db = Database(path, FERNET_KEY, "Favourite Songs")
+    user_id = db.upsert_user("u1", "Nick")
+    for i in range(5):
+        add(db, user_id, f"t{i % 3}", "Song", "Radiohead", BASE + i * DAY)
+    with db.lock:
+        db.conn.execute("ALTER TABLE user_stats DROP COLUMN tracks")
+        db.conn.execute("UPDATE meta SET value = '4' WHERE key = 'schema_version'")
+        db.conn.commit()
+    db.close()
+
+    db = Database(path, FERNET_KEY, "Favourite Songs")
+    try:
+        assert db.tracked_track_count(user_id) == 3
+        assert db.history_summary(user_id)["tracks"] == 3
+    finally:
+        db.close()
+
+
+def test_rebuild_for_one_user_leaves_the_others_alone(db):
+    users = [db.upsert_user(f"u{i}", f"User {i}") for i in range(2)]
+    close_random_listens(db, users, 50)
+    before = rollup_rows(db)
+    with db.lock:
+        db.conn.execute("UPDATE user_stats SET listens = 0")
+        assert stats.rebuild(db.conn, users[0]) == 1
+        db.conn.commit()
+
+    after = rollup_rows(db)
+    assert after["user_stats"] != before["user_stats"]
+    restored = [row for row in after["user_stats"] if row[0] == users[0]]
+    assert restored == [row for row in before["user_stats"] if row[0] == users[0]]
+
+
+def test_rebuild_needs_no_more_than_sqlite(tmp_path):
+    """dbtool.py runs it on the host, without the app's dependencies."""
+    conn = sqlite3.connect(str(tmp_path / "bare.db"))
+    conn.executescript(
+        "CREATE TABLE users (id INTEGER PRIMARY KEY);"
+        "CREATE TABLE tracks (key INTEGER PRIMARY KEY, track_id TEXT, name TEXT, artist TEXT);"
+        "CREATE TABLE listens (user_id INTEGER, track_key INTEGER, played_at INTEGER,"
+        " listened_ms INTEGER, completion_ratio REAL, qualified INTEGER, is_open INTEGER,"
+        " local_day TEXT NOT NULL DEFAULT '', local_hour INTEGER NOT NULL DEFAULT 0);"
+        + stats.SCHEMA
+    )
+    conn.execute("INSERT INTO users VALUES (1)")
+    conn.execute("INSERT INTO tracks VALUES (1, 't1', 'Weird Fishes', 'Radiohead')")
+    conn.execute("INSERT INTO listens VALUES (1, 1, ?, 1000, 1.0, 1, 0, '', 0)", (BASE,))
+    assert stats.fill_local_slots(conn) == 1
+    assert stats.rebuild(conn) == 1
+    assert stats.snapshot(conn, 1)["listens"] == 1
+    conn.close()
+
+
+@pytest.mark.parametrize("played_at", [BASE, BASE + 13 * HOUR, BASE + 200 * DAY])
+def test_local_slots_match_sqlite(played_at):
+    conn = sqlite3.connect(":memory:")
+    day, weekday, hour = conn.execute(
+        "SELECT DATE(?1 / 1000, 'unixepoch', 'localtime'),"
+        " CAST(STRFTIME('%w', ?1 / 1000, 'unixepoch', 'localtime') AS INTEGER),"
+        " CAST(STRFTIME('%H', ?1 / 1000, 'unixepoch', 'localtime') AS INTEGER)",
+        (played_at,),
+    ).fetchone()
+    assert stats.local_slot(played_at) == (day, weekday, hour)
@@ -0,0 +1,160 @@
+"""Sweeps off the poll path: the shared budget, the pool, and what a poll waits for."""
+
+import threading
+
+import pytest
+
+from app import discovery as discovery_mod
+from app import importer as importer_mod
+from app import sweeps as sweeps_mod
+from app.db import now_seconds
+from app.sweeps import SweepPool, TokenBucket
+from app.tracker import SOURCE_SWEEP_CHECK_SECONDS, SOURCE_SWEEP_RETRY_SECONDS, UserTracker
+
+from conftest import FakeService
+from test_discovery import FakeResponse, embed_html, weekly
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def pool():
+    pool = SweepPool(workers=2)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def pooled(db, user_id, spotify, blocklist, pool) -> UserTracker:
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    return UserTracker(user_id, db, FakeService(spotify), blocklist, sweeps=pool)
+
+
+# ------------------------------------------------------------------ budget
+
+
+def test_the_bucket_allows_a_burst_then_paces():
+    clock = Clock()
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock, sleep=clock.sleep)
+
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    assert bucket.take() == pytest.approx(0.5)
+
+    # A long lull refills it to the burst, never past it.
+    clock.now += 60
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    assert bucket.stats()["taken"] == 9
+
+
+def test_a_sweep_draws_every_request_from_the_budget(
+    tracker, spotify, db, user_id, monkeypatch, unpaced_budget
+):
+    db.add_discovery_source(user_id, "dw123", "Discover Weekly")
+    html = embed_html(tracks=[("t1", "Song", "Band"), ("t2", "Song", "Band")])
+    monkeypatch.setattr(discovery_mod.requests, "get", lambda *a, **k: FakeResponse(html))
+    spotify.calls.clear()
+
+    assert tracker.sweep_sources(spotify)["archived"] == 2
+    assert unpaced_budget.embed.taken == 1
+    assert unpaced_budget.spotify.taken >= len(spotify.calls) > 0
+
+    # Served from the embed cache: nothing to send, nothing spent.
+    tracker.sweep_sources(spotify)
+    assert unpaced_budget.embed.taken == 1
+
+
+def test_the_live_poll_spends_nothing(player, unpaced_budget):
+    player.listen("t1")
+    assert unpaced_budget.stats()["spotify"]["taken"] == 0
+
+
+def test_an_import_spends_its_own_bucket_not_the_sweeps(unpaced_budget):
+    class Tracks:
+        def tracks(self, ids):
+            return {"tracks": [{"id": i, "duration_ms": 1000} for i in ids]}
+
+    client = unpaced_budget.client(Tracks(), unpaced_budget.imports)
+    found = importer_mod.spotify_durations(client)([f"t{i}" for i in range(120)])
+
+    assert len(found) == 120
+    assert unpaced_budget.imports.taken == 3
+    assert unpaced_budget.spotify.taken == 0
+
+
+# -------------------------------------------------------------------- pool
+
+
+def test_one_sweep_per_user_at_a_time(pool):
+    release = threading.Event()
+    runs = []
+
+    def sweep():
+        runs.append(1)
+        release.wait(5)
+        return len(runs)
+
+    first = pool.submit(1, sweep)
+    assert pool.submit(1, sweep) is first
+    other = pool.submit(2, sweep)
+    assert 1 in pool and 2 in pool
+
+    release.set()
+    assert first.result(5) in (1, 2) and other.result(5) in (1, 2)
+    assert len(runs) == 2
+    stats = pool.stats()
+    assert (stats["completed"], stats["joined"], stats["in_flight"]) == (2, 1, 0)
+
+
+def test_a_poll_never_waits_on_its_sweep(pooled, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_page(playlist_id):
+        started.set()
+        release.wait(5)
+        return weekly(["t1"])(playlist_id)
+
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", slow_page)
+    pooled._maybe_sweep_sources()
+    assert started.wait(5)
+    # Still running, and the next poll's check returns at once instead of starting another.
+    pooled._maybe_sweep_sources()
+    assert pooled.last_sweep is None
+    running = pooled.request_sweep()  # what "sweep now" does: joins it
+    assert pooled.sweeps.stats()["joined"] == 1
+
+    release.set()
+    assert running.result(5)["archived"] == 1
+    assert pooled.last_sweep["archived"] == 1
+
+
+def test_a_failed_sweep_is_retried_later(pooled, db, user_id, monkeypatch):
+    def broken(playlist_id):
+        raise RuntimeError("embed host down")
+
+    monkeypatch.setattr(discovery_mod, "read_playlist_embed", broken)
+    with pytest.raises(RuntimeError):
+        pooled.request_sweep().result(5)
+
+    retry_at = db.last_source_sweep(user_id) + SOURCE_SWEEP_CHECK_SECONDS
+    assert retry_at - now_seconds() == pytest.approx(SOURCE_SWEEP_RETRY_SECONDS, abs=5)
+
+
+def test_pages_are_fetched_side_by_side():
+    both_started = threading.Barrier(2, timeout=5)
+
+    def fetch(key):
+        both_started.wait()  # only returns once the other fetch is in flight too
+        return key.upper()
+
+    assert sweeps_mod.fetch_all(fetch, ["a", "b", "a"]) == {"a": "A", "b": "B"}
@@ -0,0 +1,172 @@
+"""The per-track tally checked against the history, repaired, and recounted online."""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from app import tally
+from app.db import Database
+
+from test_history import BASE, DAY, FERNET_KEY, add
+from test_stats import close_random_listens
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def users(db):
+    user_ids = [db.upsert_user(f"u{i}", f"User {i}") for i in range(4)]
+    close_random_listens(db, user_ids, 120)
+    return user_ids
+
+
+def tallies(db):
+    return sorted(tuple(row) for row in db.conn.execute("SELECT * FROM play_counts"))
+
+
+def index_table(db):
+    row = db.conn.execute(
+        "SELECT tbl_name FROM sqlite_master WHERE name = 'idx_play_counts_qualified'"
+    ).fetchone()
+    return row and row[0]
+
+
+class Between:
+    """A stand-in for the writer's lock that runs `action` as its nth holder lets go --
+    how the app's writes look from inside a recount."""
+
+    def __init__(self, n, action):
+        self.n, self.action, self.entered = n, action, 0
+
+    def __enter__(self):
+        self.entered += 1
+
+    def __exit__(self, *exc):
+        if self.entered == self.n and exc[0] is None:
+            self.action()
+
+
+# -------------------------------------------------------------- verifying
+
+
+def test_a_tally_kept_by_folding_matches_its_listens(db, users):
+    assert db.drifted_play_counts() == []
+
+
+@pytest.mark.parametrize(
+    "tamper",
+    [
+        "UPDATE play_counts SET total_plays = total_plays + 1 WHERE user_id = {user}",
+        "UPDATE play_counts SET last_played = last_played - 1 WHERE user_id = {user}",
+        "DELETE FROM play_counts WHERE user_id = {user} AND track_id = 't3'",
+        "INSERT INTO play_counts VALUES ({user}, 'ghost', 'Ghost', 'Nobody', 1, 1, 0)",
+    ],
+)
+def test_any_drift_is_found_for_the_user_it_touches(db, users, tamper):
+    db.conn.execute(tamper.format(user=users[1]))
+    db.conn.commit()
+    assert db.drifted_play_counts() == [users[1]]
+
+
+def test_plays_moved_between_tracks_are_drift(db, user_id):
+    """The same totals, differently assigned, still disagree."""
+    add(db, user_id, "t1", "One", "Artist", BASE)
+    add(db, user_id, "t2", "Two", "Artist", BASE + DAY, qualified=False)
+    db.conn.execute(
+        "UPDATE play_counts SET qualified_plays = 1 - qualified_plays WHERE user_id = ?",
+        (user_id,),
+    )
+    db.conn.commit()
+    assert db.drifted_play_counts([user_id]) == [user_id]
+
+
+# -------------------------------------------------------------- repairing
+
+
+def test_repair_recounts_only_who_it_is_told(db, users):
+    before = tallies(db)
+    db.conn.execute("UPDATE play_counts SET qualified_plays = 99")
+    db.conn.commit()
+
+    db.repair_play_counts(users[:2])
+    assert db.drifted_play_counts() == users[2:]
+    db.repair_play_counts(users[2:])
+    assert tallies(db) == before
+
+
+def test_an_online_recount_swaps_in_the_same_tally(db, users):
+    before = tallies(db)
+    db.conn.execute("DELETE FROM play_counts WHERE user_id = ?", (users[0],))
+    db.conn.commit()
+
+    assert db.recount_play_counts() == len(before)
+    assert tallies(db) == before
+    assert index_table(db) == "play_counts"
+    assert not db._table_exists(tally.SHADOW_TABLE)
+    assert not db._table_exists(tally.DIRTY_TABLE)
+
+
+def test_writes_during_an_online_recount_are_kept(db, users):
+    """A listen closed for a user whose chunk was already copied is recounted at the
+    swap, and so is a user who joined part-way through."""
+    late = []
+
+    def meanwhile():
+        add(db, users[0], "t1", "Song", "Radiohead", BASE + 90 * DAY)
+        late.append(db.upsert_user("late", "Late"))
+        add(db, late[0], "t2", "Song", "Boards of Canada", BASE)
+
+    written = tally.rebuild(db.conn, Between(2, meanwhile), chunk=1)
+
+    assert db.drifted_play_counts() == []
+    assert db.play_counts(late[0])["t2"]["total_plays"] == 1
+    assert written == db.conn.execute("SELECT COUNT(*) FROM play_counts").fetchone()[0]
+
+
+def test_a_recount_cut_short_is_cleared_on_start(db, users):
+    def crash():
+        raise RuntimeError("killed")
+
+    with pytest.raises(RuntimeError):
+        tally.rebuild(db.conn, Between(2, crash), chunk=1)
+    assert db._table_exists(tally.SHADOW_TABLE)
+    assert index_table(db) == tally.SHADOW_TABLE
+    before = tallies(db)
+    db.close()
+
+    reopened = Database(db.db_path, FERNET_KEY, "Favourite Songs")
+    try:
+        assert not reopened._table_exists(tally.SHADOW_TABLE)
+        assert index_table(reopened) == "play_counts"
+        assert tallies(reopened) == before
+        assert reopened.drifted_play_counts() == []
+    finally:
+        reopened.close()
+
+
+# ------------------------------------------------------------------ dbtool
+
+
+def dbtool(*args):
+    return subprocess.run(
+        [sys.executable, str(REPO / "scripts" / "dbtool.py"), *args],
+        capture_output=True, text=True,
+    )
+
+
+def test_dbtool_verifies_repairs_and_recounts(db, users):
+    db.conn.execute("UPDATE play_counts SET total_plays = 0 WHERE user_id = ?", (users[2],))
+    db.conn.commit()
+
+    found = dbtool("verify-counts", "--db", db.db_path)
+    assert found.returncode != 0
+    assert f'"drifted": [{users[2]}]' in found.stdout
+
+    assert dbtool("verify-counts", "--db", db.db_path, "--repair").returncode == 0
+    assert db.drifted_play_counts() == []
+
+    assert dbtool("rebuild-counts", "--db", db.db_path).returncode == 0
+    assert db.drifted_play_counts() == []
+    assert index_table(db) == "play_counts"
@@ -0,0 +1,103 @@
+"""The in-memory access-token cache: the store is only touched when a token changes."""
+
+import threading
+import time
+
+import pytest
+
+from app import spotify as spotify_mod
+from app.db import now_seconds
+from app.spotify import SpotifyAuthError, SpotifyService
+
+
+class RefreshingService(SpotifyService):
+    """The real cache, with Spotify's token endpoint replaced by a counter."""
+
+    def __init__(self, db, delay: float = 0.0) -> None:
+        super().__init__(config=None, db=db)  # type: ignore[arg-type]
+        self.delay = delay
+        self.refreshes = 0
+        self.reject = False
+
+    def _token_request(self, payload):
+        if self.reject:
+            raise SpotifyAuthError("Spotify rejected the grant")
+        time.sleep(self.delay)
+        self.refreshes += 1
+        return {"access_token": f"access-{self.refreshes}", "expires_in": 3600}
+
+
+@pytest.fixture
+def reads(db, monkeypatch):
+    calls = []
+    original = db.tokens
+
+    def counting(user_id):
+        calls.append(user_id)
+        return original(user_id)
+
+    monkeypatch.setattr(db, "tokens", counting)
+    return calls
+
+
+def test_fresh_token_is_served_from_memory(db, user_id, reads):
+    db.save_tokens(user_id, "stored", "refresh", now_seconds() + 3600)
+    service = RefreshingService(db)
+
+    assert [service.access_token(user_id) for _ in range(20)] == ["stored"] * 20
+    assert reads == [user_id]
+    assert service.refreshes == 0
+
+
+def test_token_is_refreshed_before_the_margin_and_persisted(db, user_id, reads):
+    soon = now_seconds() + spotify_mod.TOKEN_REFRESH_MARGIN_SECONDS - 5
+    db.save_tokens(user_id, "stale", "refresh", soon)
+    service = RefreshingService(db)
+
+    assert service.access_token(user_id) == "access-1"
+    assert service.access_token(user_id) == "access-1"
+    assert service.refreshes == 1
+    assert reads == [user_id]
+    # The refresh token wasn't rotated, so the old one is kept alongside the new access token.
+    assert db.tokens(user_id)["access_token"] == "access-1"
+    assert db.tokens(user_id)["refresh_token"] == "refresh"
+
+
+def test_concurrent_refreshes_for_one_user_share_one_request(db, user_id):
+    db.save_tokens(user_id, "stale", "refresh", now_seconds())
+    service = RefreshingService(db, delay=0.05)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(service.access_token(user_id)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["access-1"] * 8
+    assert service.refreshes == 1
+
+
+def test_rejected_refresh_clears_the_grant(db, user_id):
+    db.save_tokens(user_id, "stale", "refresh", now_seconds())
+    service = RefreshingService(db)
+    service.reject = True
+
+    with pytest.raises(SpotifyAuthError):
+        service.access_token(user_id)
+    assert db.tokens(user_id) is None
+    with pytest.raises(SpotifyAuthError):
+        service.access_token(user_id)
+
+
+def test_forget_drops_the_cached_grant(db, user_id):
+    db.save_tokens(user_id, "first", "refresh", now_seconds() + 3600)
+    service = RefreshingService(db)
+    assert service.access_token(user_id) == "first"
+
+    # A new sign-in stores fresh tokens; the cached ones must not shadow them.
+    db.save_tokens(user_id, "second", "refresh", now_seconds() + 3600)
+    service.forget(user_id)
+    assert service.access_token(user_id) == "second"
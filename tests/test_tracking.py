@@ -6,7 +6,12 @@ one way a play can enter the history: the live poll measured it.
 
 from datetime import timedelta
 
-from conftest import play, playback
+import pytest
+
+from app import playlists
+from app.db import STATE_SECTIONS
+from app.tracker import UserTracker
+from conftest import FakeService, play, playback
 
 TRACK_MS = 200_000
 
@@ -154,6 +159,38 @@ def test_stopping_the_tracker_closes_the_open_listen(player, db, user_id):
     assert db.history(user_id)["items"][0]["is_open"] is False
 
 
+def test_progress_rewrites_are_merged_into_one_commit(db, user_id):
+    """Every poll rewrites the open row. Those rewrites are queued and only the latest
+    per row is written, so a tick costs one commit however many users are playing."""
+    rows = [db.open_listen(user_id, f"t{i}", "Song", "Artist", i, TRACK_MS, None) for i in range(3)]
+    for poll in range(1, 5):
+        for row_id in rows:
+            db.update_open_listen(row_id, poll * 5_000, poll * 5_000 / TRACK_MS, TRACK_MS)
+
+    queued = db.metrics()["open_listens"]
+    assert (queued["open_updates"], queued["open_updates_merged"], queued["pending"]) == (12, 9, 3)
+
+    assert db.flush_open_listens() == 3
+    flushed = db.metrics()["open_listens"]
+    assert (flushed["open_flushes"], flushed["open_rows_flushed"], flushed["pending"]) == (1, 3, 0)
+    assert {row["listened_ms"] for row in db.history(user_id)["items"]} == {20_000}
+
+
+def test_a_late_flush_cannot_reopen_or_rewrite_a_closed_listen(db, user_id):
+    row_id = db.open_listen(user_id, "t1", "Song", "Artist", 0, TRACK_MS, None)
+    db.update_open_listen(row_id, 5_000, 0.025, TRACK_MS)
+    db.close_listen(
+        row_id=row_id, user_id=user_id, track_id="t1", name="Song", artist="Artist",
+        played_at=0, duration_ms=TRACK_MS, listened_ms=TRACK_MS, completion_ratio=1.0,
+        qualified=True,
+    )
+    db.update_open_listen(row_id, 10_000, 0.05, TRACK_MS)  # a straggler from the last poll
+    db.flush_open_listens()
+
+    row = db.history(user_id)["items"][0]
+    assert row["listened_ms"] == TRACK_MS and row["is_open"] is False
+
+
 # ------------------------------------------------ one way in, and one only
 
 
@@ -212,3 +249,351 @@ def test_five_second_steps_measure_the_tail(player, db, user_id):
     row = db.history(user_id)["items"][0]
     assert row["completion_ratio"] == 1.0
     assert row["qualified"] is True
+
+
+def test_a_poll_asks_for_the_next_one_on_the_fixed_interval(tracker, spotify):
+    from app.tracker import POLL_INTERVAL_SECONDS
+
+    spotify.playback = playback("t1", 0)
+    assert tracker.poll() == POLL_INTERVAL_SECONDS
+    assert tracker.last_error is None
+
+
+def test_a_revoked_grant_stops_polling(tracker, monkeypatch):
+    from app.spotify import SpotifyAuthError
+
+    def revoked(user_id):
+        raise SpotifyAuthError("gone")
+
+    monkeypatch.setattr(tracker.spotify, "client", revoked)
+    assert tracker.poll() is None
+    assert "Log in again" in tracker.last_error
+
+
+# ---------------------------------------------------------------- settings
+
+
+def test_settings_are_read_from_the_database_once(db, user_id, monkeypatch):
+    first = db.settings(user_id)
+
+    def no_reads():
+        raise AssertionError("settings went back to the database")
+
+    monkeypatch.setattr(db, "_reader", no_reads)
+    assert db.settings(user_id) is first
+
+
+def test_an_update_replaces_the_cached_settings(db, user_id):
+    before = db.settings(user_id)
+    after = db.update_settings(user_id, {"favorite_threshold": 7, "pinned_stats": ["streak"]})
+
+    assert db.settings(user_id) is after
+    assert after["favorite_threshold"] == 7 and after["pinned_stats"] == ["streak"]
+    # Whoever still holds the old dict -- a poll in progress -- sees it unchanged.
+    assert before["favorite_threshold"] != 7 and before["pinned_stats"] == []
+
+
+def test_deleting_a_user_drops_their_settings(db, user_id):
+    db.settings(user_id)
+    db.delete_user(user_id)
+    with pytest.raises(KeyError):
+        db.settings(user_id)
+
+
+# ------------------------------------------------------- favourites lookups
+
+
+def test_the_favourites_are_read_off_the_index(db, user_id):
+    """Assembling the favourites costs what the favourites number, not the library."""
+    for i, plays in enumerate((5, 3, 1, 0)):
+        for _ in range(max(plays, 1)):
+            row_id = db.open_listen(user_id, f"t{i}", "Song", "Artist", 1, TRACK_MS, None)
+            db.close_listen(
+                row_id=row_id, user_id=user_id, track_id=f"t{i}", name="Song", artist="Artist",
+                played_at=1, duration_ms=TRACK_MS, listened_ms=TRACK_MS,
+                completion_ratio=1.0, qualified=plays > 0,
+            )
+
+    assert set(db.play_counts_over(user_id, 3)) == {"t0", "t1"}
+    assert set(db.play_counts_for(user_id, ["t3", "t9"])) == {"t3"}
+    assert db.tracked_track_count(user_id) == 4
+
+    plan = db.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT track_id FROM play_counts"
+        " WHERE user_id = ? AND qualified_plays >= ?",
+        (user_id, 3),
+    ).fetchall()
+    detail = " ".join(row["detail"] for row in plan)
+    assert "idx_play_counts_qualified" in detail
+    assert "SCAN" not in detail
+
+
+def test_reconcile_only_considers_tracks_over_the_threshold(player, tracker, spotify, db, user_id):
+    db.update_settings(user_id, {"favorite_threshold": 5})
+    player.listen("t1")
+    player.listen("t1")
+    player.listen("t2")
+    db.update_settings(user_id, {"favorite_threshold": 2})
+
+    assert tracker.reconcile_favorites() == 1
+    playlist = next(iter(spotify.playlists.values()))
+    assert playlist["tracks"] == ["t1"]
+
+
+# ------------------------------------------------------ favourites membership
+
+
+@pytest.fixture
+def expired(monkeypatch):
+    """Every cached membership is past its TTL, so each read has to check the snapshot."""
+    monkeypatch.setattr(playlists, "MEMBERSHIP_TTL_SECONDS", -1)
+
+
+def test_an_unchanged_playlist_is_checked_not_re_read(tracker, spotify, expired):
+    tracker.add_to_favorites(spotify, ["t1", "t2"])
+    tracker.refresh_favorites(spotify)
+    spotify.calls.clear()
+
+    for _ in range(3):
+        tracker.refresh_favorites(spotify)
+    assert spotify.calls == ["playlist"] * 3
+    assert tracker.favorites_membership == {"t1", "t2"}
+
+
+def test_an_edit_made_in_spotify_is_read_in_full(tracker, spotify, expired):
+    tracker.add_to_favorites(spotify, ["t1", "t2"])
+    tracker.refresh_favorites(spotify)
+    playlist_id = next(iter(spotify.playlists))
+    spotify.playlists[playlist_id]["tracks"].remove("t1")
+    spotify.edited(playlist_id)
+    spotify.calls.clear()
+
+    tracker.refresh_favorites(spotify)
+    assert spotify.calls == ["playlist", "playlist_items"]
+    assert tracker.favorites_membership == {"t2"}
+
+
+def test_adding_and_removing_update_the_cached_copy(player, tracker, spotify, db, user_id):
+    db.update_settings(user_id, {"favorite_threshold": 1})
+    player.listen("t1")
+    tracker.refresh_favorites(spotify)
+    spotify.calls.clear()
+
+    player.listen("t2")
+    tracker.refresh_favorites(spotify)
+    assert "playlist_items" not in spotify.calls
+    # Named from the tally, the way a read of the playlist would have named it.
+    assert list(tracker.favorites_snapshot) == [
+        {"track_id": "t2", "name": "Song", "artist": "Artist"},
+        {"track_id": "t1", "name": "Song", "artist": "Artist"},
+    ]
+
+    assert tracker.remove_from_favorites(spotify, ["t1"]) == 1
+    tracker.refresh_favorites(spotify)
+    assert "playlist_items" not in spotify.calls
+    assert tracker.favorites_membership == {"t2"}
+    # And the copy is vouched for by the snapshot the last edit produced.
+    playlist_id = next(iter(spotify.playlists))
+    assert tracker.cache.snapshot(playlist_id) == spotify.snapshot(playlist_id)
+
+
+def test_a_restart_checks_the_mirror_instead_of_re_reading(
+    tracker, spotify, db, user_id, blocklist
+):
+    tracker.add_to_favorites(spotify, ["t1", "t2"])
+    tracker.refresh_favorites(spotify)
+    spotify.calls.clear()
+
+    restarted = UserTracker(user_id, db, FakeService(spotify), blocklist)
+    restarted.refresh_favorites(spotify)
+    assert spotify.calls == ["playlist"]
+    assert restarted.favorites_snapshot == tracker.favorites_snapshot
+
+
+def test_the_mirror_keeps_spotifys_order(tracker, spotify, db, user_id):
+    tracker.add_to_favorites(spotify, ["t1", "t2"])
+    tracker.add_to_favorites(spotify, ["t3", "t4"])
+    tracker.remove_from_favorites(spotify, ["t2"])
+    tracker.add_to_favorites(spotify, ["t5"])
+
+    playlist_id, playlist = next(iter(spotify.playlists.items()))
+    snapshot_id, tracks = db.playlist_mirror(user_id)[playlist_id]
+    assert [t["track_id"] for t in tracks] == playlist["tracks"] == ["t5", "t3", "t4", "t1"]
+    assert snapshot_id == spotify.snapshot(playlist_id)
+    positions = db.conn.execute(
+        "SELECT position FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+        (playlist_id,),
+    ).fetchall()
+    assert [row[0] for row in positions] == [0, 1, 2, 3]
+
+
+def test_an_add_works_out_its_diff_locally(tracker, spotify):
+    tracker.add_to_favorites(spotify, ["t1"])
+    tracker.refresh_favorites(spotify)
+    spotify.calls.clear()
+
+    assert tracker.add_to_favorites(spotify, ["t1", "t2"]) == 1
+    assert tracker.add_to_favorites(spotify, ["t2"]) == 0
+    assert spotify.calls == ["playlist_add_items"]
+
+
+def test_the_mirror_goes_with_the_user(tracker, spotify, db, user_id):
+    tracker.add_to_favorites(spotify, ["t1"])
+    db.delete_user(user_id)
+    assert db.conn.execute("SELECT COUNT(*) FROM playlist_tracks").fetchone()[0] == 0
+
+
+def tracks(*ids):
+    return playlists.PlaylistTracks.of(
+        {"track_id": i, "name": f"Song {i}", "artist": "Artist"} for i in ids
+    )
+
+
+def test_a_hit_hands_out_the_cached_tracks_not_a_copy():
+    cache = playlists.PlaylistCache()
+    cache.put("pl", tracks("t1", "t2"), "s1")
+
+    first, second = cache.get("pl"), cache.get("pl")
+    assert first is second
+    assert first[1] == {"track_id": "t2", "name": "Song t2", "artist": "Artist"}
+    assert first.members == {"t1", "t2"}
+    with pytest.raises(AttributeError):
+        first.ids = ()
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_the_least_recently_used_playlist_goes_first():
+    one = tracks(*(f"a{i}" for i in range(50)))
+    cache = playlists.PlaylistCache(max_bytes=int(one.footprint() * 2.5))
+    cache.put("old", one, "s1")
+    cache.put("used", tracks(*(f"b{i}" for i in range(50))), "s1")
+    cache.get("old")  # now the more recent of the two
+    cache.put("new", tracks(*(f"c{i}" for i in range(50))), "s1")
+
+    assert cache.get("used") is None
+    assert cache.get("old") is not None and cache.get("new") is not None
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["playlists"] == 2
+    assert stats["bytes"] <= cache.max_bytes
+
+
+def test_an_evicted_playlist_comes_back_from_the_mirror(db, user_id):
+    cache = playlists.PlaylistCache(db, user_id, max_bytes=1)
+    cache.put("first", tracks("t1"), "s1")
+    cache.put("second", tracks("t2"), "s1")
+    assert cache.stats()["evictions"] == 1
+
+    # Stale, so the next read checks its snapshot; but no full read is needed to know it.
+    assert cache.get("first") is None
+    assert cache.snapshot("first") == "s1"
+    assert list(cache.revalidated("first")) == list(tracks("t1"))
+
+
+
+def test_a_playlist_the_mirror_lacks_is_never_looked_up_there(db, user_id, monkeypatch):
+    cache = playlists.PlaylistCache(db, user_id, max_bytes=1)
+    cache.put("kept", tracks("t1"), "s1")
+    cache.put("evicts-kept", tracks("t2"), "s1")
+    reads = []
+
+    def counted(name):
+        method = getattr(db, name)
+
+        def read(*args):
+            reads.append(name)
+            return method(*args)
+
+        monkeypatch.setattr(db, name, read)
+
+    counted("playlist_mirror")
+    counted("mirrored_playlist_ids")
+
+    restarted = playlists.PlaylistCache(db, user_id)
+    for _ in range(3):
+        assert restarted.get("never-mirrored") is None
+    assert cache.snapshot("kept") == "s1"  # evicted, so read back from the mirror
+    cache.invalidate("kept")
+    assert cache.snapshot("kept") is None
+
+    assert reads == ["mirrored_playlist_ids", "mirrored_playlist_ids", "playlist_mirror"]
+
+# ----------------------------------------------------------- state version
+
+
+def test_progress_alone_leaves_the_state_version_alone(player, db, user_id):
+    """The browser revalidates its state every five seconds; a track playing on is
+    not a change to it -- only closing the listen is."""
+    player.poll(playback("t1", 0))
+    before = db.state_version(user_id)
+    player.poll(playback("t1", 30_000), after_ms=30_000)
+    player.poll(playback("t1", 60_000), after_ms=30_000)
+    assert db.state_version(user_id) == before
+
+    player.poll(None, after_ms=30_000)
+    assert db.state_version(user_id) > before
+
+
+def test_settings_and_discovery_writes_move_the_state_version(db, user_id):
+    seen = [db.state_version(user_id)]
+    db.update_settings(user_id, {"favorite_threshold": 4})
+    seen.append(db.state_version(user_id))
+    db.add_discovery_source(user_id, "pl1", "Discover Weekly")
+    seen.append(db.state_version(user_id))
+    assert db.archive_discovery(user_id, "2027-03", "t1", "Song", "Artist", "pl1")
+    seen.append(db.state_version(user_id))
+    assert seen == sorted(set(seen))
+
+    # Archiving the same track again changes nothing, so neither does the version.
+    assert not db.archive_discovery(user_id, "2027-03", "t1", "Song", "Artist", "pl1")
+    assert db.state_version(user_id) == seen[-1]
+
+
+def test_an_unchanged_favourites_playlist_leaves_the_state_version_alone(tracker, spotify, db, user_id):
+    tracker.add_to_favorites(spotify, ["t1"])
+    tracker.refresh_favorites(spotify)
+    before = db.state_version(user_id)
+    tracker.refresh_favorites(spotify)
+    assert db.state_version(user_id) == before
+
+    tracker.add_to_favorites(spotify, ["t2"])
+    tracker.refresh_favorites(spotify)
+    assert db.state_version(user_id) > before
+    assert tracker.favorites_membership == {"t1", "t2"}
+
+
+def test_a_new_error_moves_the_state_version(tracker, db, user_id, monkeypatch):
+    from app.spotify import SpotifyAuthError
+
+    before = db.state_version(user_id)
+
+    def revoked(user_id):
+        raise SpotifyAuthError("gone")
+
+    monkeypatch.setattr(tracker.spotify, "client", revoked)
+    tracker.poll()
+    assert db.state_version(user_id) > before
+
+
+def test_each_section_moves_only_with_its_own_writes(player, db, user_id):
+    """The state is cached section by section, so a write must not invalidate what it
+    never touched: a closed listen leaves discovery standing, a new source the stats."""
+    db.add_discovery_source(user_id, "pl1", "Discover Weekly")
+    discovery = db.state_version(user_id, "discovery")
+    stats = db.state_version(user_id, "stats")
+
+    player.listen("t1")
+    assert db.state_version(user_id, "discovery") == discovery
+    assert db.state_version(user_id, "stats") > stats
+    assert db.state_version(user_id, "favorites") == db.state_version(user_id, "stats")
+
+    stats = db.state_version(user_id, "stats")
+    db.remove_discovery_source(user_id, "pl1")
+    assert db.state_version(user_id, "stats") == stats
+    assert db.state_version(user_id) == db.state_version(user_id, "discovery")
+
+
+def test_a_threshold_change_moves_what_depends_on_it(db, user_id):
+    before = {section: db.state_version(user_id, section) for section in STATE_SECTIONS}
+    db.update_settings(user_id, {"favorite_threshold": 4})
+    moved = {s for s in STATE_SECTIONS if db.state_version(user_id, s) != before[s]}
+    assert moved == {"settings", "favorites", "stats"}